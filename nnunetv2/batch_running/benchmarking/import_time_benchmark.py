@@ -0,0 +1,92 @@
+import argparse
+import json
+import subprocess
+import sys
+from typing import List, Tuple
+
+import numpy as np
+
+# these are what the inference entry points need to import. They are checked against the budget below
+DEFAULT_MODULES = ('nnunetv2.inference.predict_from_raw_data', 'nnunetv2.inference.inference_package')
+# heavy dependencies that have no business being imported when all we want is to run inference
+DEFAULT_FORBIDDEN = ('pandas', 'sklearn', 'skimage', 'matplotlib', 'seaborn', 'torch._dynamo')
+
+
+def measure_import_times(module: str) -> List[Tuple[str, int, int]]:
+    """
+    imports module in a fresh interpreter with -X importtime. Returns [(module, self_us, cumulative_us), ...] for
+    everything that was imported, in import order
+    """
+    res = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], capture_output=True,
+                         text=True)
+    if res.returncode != 0:
+        raise RuntimeError(f'Importing {module} failed:\n{res.stderr}')
+    times = []
+    for line in res.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times.append((name.strip(), int(self_us), int(cumulative_us)))
+    return times
+
+
+def benchmark_imports(modules: Tuple[str, ...] = DEFAULT_MODULES, num_repeats: int = 5, top_k: int = 15,
+                      forbidden: Tuple[str, ...] = DEFAULT_FORBIDDEN) -> dict:
+    results = {}
+    for module in modules:
+        runs = [measure_import_times(module) for _ in range(num_repeats)]
+        # first run may suffer from cold file system caches, we report the median
+        totals = [[t for t in r if t[0] == module][0][2] for r in runs]
+        median_run = runs[int(np.argsort(totals)[len(totals) // 2])]
+        imported = set(t[0] for t in median_run)
+        slowest = sorted([t for t in median_run if t[0].startswith('nnunetv2')] +
+                         [t for t in median_run if '.' not in t[0]], key=lambda x: -x[2])[:top_k]
+        results[module] = {
+            'median_s': float(np.median(totals)) / 1e6,
+            'min_s': float(np.min(totals)) / 1e6,
+            'num_modules': len(imported),
+            'forbidden_imported': [f for f in forbidden if f in imported],
+            'slowest': [{'module': n, 'self_s': s / 1e6, 'cumulative_s': c / 1e6} for n, s, c in slowest]
+        }
+    return results
+
+
+def import_time_benchmark_entry_point():
+    parser = argparse.ArgumentParser(description='Measures how long it takes to import the nnU-Net inference entry '
+                                                 'points (each in a fresh interpreter) and which modules are '
+                                                 'responsible. Exit code 1 if a budget is exceeded or a forbidden '
+                                                 'module is imported, so this can be used to catch regressions')
+    parser.add_argument('-m', nargs='+', type=str, required=False, default=DEFAULT_MODULES,
+                        help=f'modules to import. Default: {DEFAULT_MODULES}')
+    parser.add_argument('-n', type=int, required=False, default=5,
+                        help='number of repetitions per module. We report the median. Default: 5')
+    parser.add_argument('-top_k', type=int, required=False, default=15,
+                        help='how many of the slowest (top level and nnunetv2) modules to show. Default: 15')
+    parser.add_argument('-budget_s', type=float, required=False, default=None,
+                        help='maximum median import time (seconds) per module. Default: no budget')
+    parser.add_argument('-forbidden', nargs='*', type=str, required=False, default=DEFAULT_FORBIDDEN,
+                        help=f'modules that must not be imported. Default: {DEFAULT_FORBIDDEN}')
+    parser.add_argument('-o', type=str, required=False, default=None,
+                        help='optional json file to save the results to')
+    args = parser.parse_args()
+
+    results = benchmark_imports(tuple(args.m), args.n, args.top_k, tuple(args.forbidden))
+    failed = False
+    for module, r in results.items():
+        print(f"\n{module}: median {r['median_s']:.3f} s (min {r['min_s']:.3f} s), {r['num_modules']} modules")
+        for s in r['slowest']:
+            print(f"    {s['cumulative_s']:8.3f} s cumulative {s['self_s']:8.3f} s self  {s['module']}")
+        if len(r['forbidden_imported']) > 0:
+            print(f"    FAILED: imports {r['forbidden_imported']}")
+            failed = True
+        if args.budget_s is not None and r['median_s'] > args.budget_s:
+            print(f"    FAILED: exceeds budget of {args.budget_s} s")
+            failed = True
+    if args.o is not None:
+        with open(args.o, 'w') as f:
+            json.dump(results, f, indent=4)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    import_time_benchmark_entry_point()
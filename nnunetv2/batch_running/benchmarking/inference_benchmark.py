@@ -0,0 +1,413 @@
+"""
+CPU inference benchmark that does not need a dataset or a trained model: synthetic images of several sizes are
+predicted with a small PlainConvUNet built from synthetic plans (random weights, fixed seeds). We time
+preprocessing, the sliding window (for different step sizes, mirroring, number of folds and tile batch sizes), the
+export resampling and the writing of the segmentation. Results go to a versioned json file. compare_benchmarks /
+nnUNetv2_compare_inference_benchmarks flags regressions between two such files.
+
+The sliding window settings are varied one at a time starting from BASELINE_SETTINGS (not all combinations), so the
+number of measurements grows linearly with the number of values per setting.
+
+Benchmarks are only comparable if they were run on the same machine with the same number of threads. Both are
+recorded and compare_benchmarks warns if they differ.
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from copy import deepcopy
+from time import perf_counter, strftime
+from typing import List, Tuple, Union, Callable
+
+import numpy as np
+import torch
+
+BENCHMARK_FORMAT_VERSION = 1
+# original image shapes (x, y, z) with spacing SYNTHETIC_IMAGE_SPACING
+SYNTHETIC_IMAGE_SIZES = {
+    'small': (48, 96, 96),
+    'medium': (64, 160, 160),
+    'large': (96, 256, 256),
+}
+SYNTHETIC_IMAGE_SPACING = (2.0, 0.8, 0.8)
+BASELINE_SETTINGS = {'tile_step_size': 0.5, 'use_mirroring': False, 'num_folds': 1, 'tile_batch_size': None}
+
+
+def get_synthetic_plans_and_dataset_json(configuration: str = '3d_fullres') -> Tuple[dict, dict]:
+    """
+    plans with a 4 stage PlainConvUNet (8 to 64 features) and the default preprocessing, resampling and normalization.
+    configuration can be 3d_fullres or 2d
+    """
+    assert configuration in ('3d_fullres', '2d'), f'configuration must be 3d_fullres or 2d, got {configuration}'
+    dim = 3 if configuration == '3d_fullres' else 2
+    resampling_kwargs = lambda is_seg, order: {'is_seg': is_seg, 'order': order, 'order_z': 0,
+                                               'force_separate_z': None}
+    architecture = {
+        'network_class_name': 'dynamic_network_architectures.architectures.unet.PlainConvUNet',
+        'arch_kwargs': {
+            'n_stages': 4,
+            'features_per_stage': [8, 16, 32, 64],
+            'conv_op': f'torch.nn.modules.conv.Conv{dim}d',
+            'kernel_sizes': [[3] * dim] * 4,
+            'strides': [[1] * dim] + [[2] * dim] * 3,
+            'n_conv_per_stage': [2, 2, 2, 2],
+            'n_conv_per_stage_decoder': [2, 2, 2],
+            'conv_bias': True,
+            'norm_op': f'torch.nn.modules.instancenorm.InstanceNorm{dim}d',
+            'norm_op_kwargs': {'eps': 1e-05, 'affine': True},
+            'dropout_op': None,
+            'dropout_op_kwargs': None,
+            'nonlin': 'torch.nn.LeakyReLU',
+            'nonlin_kwargs': {'inplace': True}
+        },
+        '_kw_requires_import': ['conv_op', 'norm_op', 'dropout_op', 'nonlin']
+    }
+    configuration_dict = {
+        'data_identifier': f'nnUNetPlans_{configuration}',
+        'preprocessor_name': 'DefaultPreprocessor',
+        'batch_size': 2 if dim == 3 else 12,
+        'patch_size': [64, 96, 96] if dim == 3 else [160, 160],
+        'median_image_size_in_voxels': [85, 128, 128] if dim == 3 else [128, 128],
+        'spacing': [1.5, 1.0, 1.0] if dim == 3 else [1.0, 1.0],
+        'normalization_schemes': ['ZScoreNormalization'],
+        'use_mask_for_norm': [False],
+        'resampling_fn_data': 'resample_data_or_seg_to_shape',
+        'resampling_fn_data_kwargs': resampling_kwargs(False, 3),
+        'resampling_fn_seg': 'resample_data_or_seg_to_shape',
+        'resampling_fn_seg_kwargs': resampling_kwargs(True, 1),
+        'resampling_fn_probabilities': 'resample_data_or_seg_to_shape',
+        'resampling_fn_probabilities_kwargs': resampling_kwargs(False, 1),
+        'architecture': architecture,
+        'batch_dice': False
+    }
+    plans = {
+        'dataset_name': 'Dataset000_SyntheticBenchmark',
+        'plans_name': 'nnUNetPlans',
+        'original_median_spacing_after_transp': list(SYNTHETIC_IMAGE_SPACING),
+        'original_median_shape_after_transp': list(SYNTHETIC_IMAGE_SIZES['small']),
+        'image_reader_writer': 'SimpleITKIO',
+        'transpose_forward': [0, 1, 2],
+        'transpose_backward': [0, 1, 2],
+        'experiment_planner_used': 'ExperimentPlanner',
+        'label_manager': 'LabelManager',
+        'foreground_intensity_properties_per_channel': {
+            '0': {'mean': 100.0, 'std': 50.0, 'percentile_00_5': 0.0, 'percentile_99_5': 300.0, 'median': 100.0,
+                  'min': 0.0, 'max': 400.0}
+        },
+        'configurations': {configuration: configuration_dict}
+    }
+    dataset_json = {'channel_names': {'0': 'CT'}, 'labels': {'background': 0, 'organ': 1, 'lesion': 2},
+                    'file_ending': '.nii.gz', 'numTraining': 0}
+    return plans, dataset_json
+
+
+def generate_synthetic_image(shape: Tuple[int, ...], seed: int = 1234) -> np.ndarray:
+    """
+    (1, x, y, z) float32: an ellipsoid 'body' with noise on a zero background (so that cropping has something to do)
+    and a bright sphere inside
+    """
+    rng = np.random.RandomState(seed)
+    grid = np.meshgrid(*[np.linspace(-1, 1, s, dtype=np.float32) for s in shape], indexing='ij')
+    image = np.zeros(shape, dtype=np.float32)
+    body = (grid[0] ** 2 / 0.8 + grid[1] ** 2 / 0.6 + grid[2] ** 2 / 0.7) < 1
+    image[body] = 100 + rng.randn(int(body.sum())).astype(np.float32) * 30
+    image[(grid[0] ** 2 + (grid[1] - 0.2) ** 2 + grid[2] ** 2) < 0.05] = 250
+    return image[None]
+
+
+def build_synthetic_predictor(plans: dict, dataset_json: dict, configuration: str, num_folds: int,
+                              tile_step_size: float, use_mirroring: bool, tile_batch_size: Union[int, None],
+                              seed: int = 1234):
+    """
+    nnUNetPredictor on cpu with num_folds randomly initialized (seeded) sets of weights
+    """
+    from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+    from nnunetv2.utilities.get_network_from_plans import get_network_from_plans
+    from nnunetv2.utilities.plans_handling.plans_handler import PlansManager
+
+    plans_manager = PlansManager(plans)
+    configuration_manager = plans_manager.get_configuration(configuration)
+    label_manager = plans_manager.get_label_manager(dataset_json)
+    parameters = []
+    for fold in range(num_folds):
+        torch.manual_seed(seed + fold)
+        network = get_network_from_plans(configuration_manager.network_arch_class_name,
+                                         configuration_manager.network_arch_init_kwargs,
+                                         configuration_manager.network_arch_init_kwargs_req_import,
+                                         len(dataset_json['channel_names']),
+                                         label_manager.num_segmentation_heads, deep_supervision=False)
+        parameters.append(deepcopy(network.state_dict()))
+    predictor = nnUNetPredictor(tile_step_size=tile_step_size, use_gaussian=True, use_mirroring=use_mirroring,
+                                perform_everything_on_device=False, device=torch.device('cpu'), verbose=False,
+                                verbose_preprocessing=False, allow_tqdm=False, tile_batch_size=tile_batch_size)
+    predictor.manual_initialization(network, plans_manager, configuration_manager, parameters, dataset_json,
+                                    'nnUNetTrainer', tuple(range(len(configuration_manager.patch_size))))
+    return predictor
+
+
+def time_function(fn: Callable, num_repeats: int, num_warmup: int = 1):
+    """
+    returns the result of the last call and the durations (seconds) of the num_repeats timed calls
+    """
+    ret = None
+    for _ in range(num_warmup):
+        ret = fn()
+    times = []
+    for _ in range(num_repeats):
+        start = perf_counter()
+        ret = fn()
+        times.append(perf_counter() - start)
+    return ret, times
+
+
+def _summarize_times(times: List[float], **extra) -> dict:
+    return dict({'median_s': float(np.median(times)), 'min_s': float(np.min(times)), 'max_s': float(np.max(times)),
+                 'times_s': [float(i) for i in times]}, **extra)
+
+
+def get_sliding_window_settings(step_sizes: List[float], mirroring: List[bool], num_folds: List[int],
+                                tile_batch_sizes: List[Union[int, None]]) -> List[dict]:
+    """
+    BASELINE_SETTINGS plus each value of each setting on its own (everything else at baseline)
+    """
+    settings = [dict(BASELINE_SETTINGS)]
+    for k, values in (('tile_step_size', step_sizes), ('use_mirroring', mirroring), ('num_folds', num_folds),
+                      ('tile_batch_size', tile_batch_sizes)):
+        for v in values:
+            s = dict(BASELINE_SETTINGS, **{k: v})
+            if s not in settings:
+                settings.append(s)
+    return settings
+
+
+def settings_to_str(settings: dict) -> str:
+    return f"step{settings['tile_step_size']}_mirror{int(settings['use_mirroring'])}_folds{settings['num_folds']}_" \
+           f"tbs{settings['tile_batch_size'] if settings['tile_batch_size'] is not None else 'auto'}"
+
+
+def get_environment_info() -> dict:
+    try:
+        from importlib.metadata import version
+        nnunet_version = version('nnunetv2')
+    except Exception:
+        nnunet_version = None
+    try:
+        git_commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, timeout=10,
+                                    cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except Exception:
+        git_commit = None
+    return {
+        'nnunetv2_version': nnunet_version,
+        'git_commit': git_commit,
+        'torch_version': torch.__version__,
+        'numpy_version': np.__version__,
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'torch_num_threads': torch.get_num_threads(),
+    }
+
+
+def run_inference_benchmark(sizes: List[str] = ('small', 'medium'), configuration: str = '3d_fullres',
+                            step_sizes: List[float] = (0.5, 0.75), mirroring: List[bool] = (False, True),
+                            num_folds: List[int] = (1, 3), tile_batch_sizes: List[Union[int, None]] = (None, 1),
+                            num_repeats: int = 3, num_threads: int = 4, seed: int = 1234) -> dict:
+    """
+    Returns {'format_version', 'created', 'environment', 'settings', 'results'}. results maps
+    '{stage}/{size}[/{sliding window settings}]' to timings (median_s, min_s, max_s, times_s) and, where it makes
+    sense, shapes and a checksum of the output. Checksums are there to notice if two runs did not compute the same
+    thing (then their timings are not comparable)
+    """
+    from nnunetv2.imageio.simpleitk_reader_writer import SimpleITKIO
+    from nnunetv2.inference.export_prediction import convert_predicted_logits_to_segmentation_with_correct_shape
+    from nnunetv2.preprocessing.preprocessors.default_preprocessor import DefaultPreprocessor
+    from nnunetv2.utilities.tracing import set_log_level
+
+    set_log_level('warning')
+    torch.set_num_threads(num_threads)
+    plans, dataset_json = get_synthetic_plans_and_dataset_json(configuration)
+    sw_settings = get_sliding_window_settings(list(step_sizes), list(mirroring), list(num_folds),
+                                              list(tile_batch_sizes))
+    predictors = {settings_to_str(s): build_synthetic_predictor(plans, dataset_json, configuration, s['num_folds'],
+                                                                s['tile_step_size'], s['use_mirroring'],
+                                                                s['tile_batch_size'], seed)
+                  for s in sw_settings}
+    baseline_predictor = predictors[settings_to_str(BASELINE_SETTINGS)]
+    preprocessor = DefaultPreprocessor(verbose=False)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            image = generate_synthetic_image(SYNTHETIC_IMAGE_SIZES[size], seed)
+            # same as what SimpleITKIO.read_images would give us (sitk has the axes in reverse order)
+            properties = {'spacing': list(SYNTHETIC_IMAGE_SPACING),
+                          'sitk_stuff': {'spacing': SYNTHETIC_IMAGE_SPACING[::-1], 'origin': (0., 0., 0.),
+                                         'direction': (1., 0., 0., 0., 1., 0., 0., 0., 1.)}}
+
+            print(f'{size}: preprocessing')
+            (data, _), times = time_function(
+                lambda: preprocessor.run_case_npy(image, None, deepcopy(properties),
+                                                  baseline_predictor.plans_manager,
+                                                  baseline_predictor.configuration_manager, dataset_json),
+                num_repeats)
+            # run_case_npy fills the properties we need for the export, so we do this once more
+            data_properties = deepcopy(properties)
+            preprocessor.run_case_npy(image, None, data_properties, baseline_predictor.plans_manager,
+                                      baseline_predictor.configuration_manager, dataset_json)
+            data = torch.from_numpy(data).contiguous()
+            results[f'preprocessing/{size}'] = _summarize_times(times, input_shape=list(image.shape),
+                                                                output_shape=list(data.shape))
+
+            logits = None
+            for s in sw_settings:
+                key = settings_to_str(s)
+                print(f'{size}: sliding window {key}')
+                predictor = predictors[key]
+                prediction, times = time_function(lambda: predictor.predict_logits_from_preprocessed_data(data),
+                                                  num_repeats)
+                results[f'sliding_window/{size}/{key}'] = _summarize_times(
+                    times, settings=s, checksum=hashlib.sha256(prediction.argmax(0).numpy().tobytes()).hexdigest())
+                if s == BASELINE_SETTINGS:
+                    logits = prediction
+
+            print(f'{size}: export resampling')
+            segmentation, times = time_function(
+                lambda: convert_predicted_logits_to_segmentation_with_correct_shape(
+                    logits, baseline_predictor.plans_manager, baseline_predictor.configuration_manager,
+                    baseline_predictor.label_manager, data_properties, num_threads_torch=num_threads),
+                num_repeats)
+            results[f'export_resampling/{size}'] = _summarize_times(
+                times, output_shape=list(segmentation.shape),
+                checksum=hashlib.sha256(np.ascontiguousarray(segmentation).tobytes()).hexdigest())
+
+            print(f'{size}: writing')
+            output_file = os.path.join(tmp, f'{size}{dataset_json["file_ending"]}')
+            _, times = time_function(lambda: SimpleITKIO().write_seg(segmentation, output_file, properties),
+                                     num_repeats)
+            results[f'write/{size}'] = _summarize_times(times, file_size=os.path.getsize(output_file))
+
+    return {
+        'format_version': BENCHMARK_FORMAT_VERSION,
+        'created': strftime('%Y-%m-%d %H:%M:%S'),
+        'environment': get_environment_info(),
+        'settings': {'sizes': {s: SYNTHETIC_IMAGE_SIZES[s] for s in sizes}, 'spacing': SYNTHETIC_IMAGE_SPACING,
+                     'configuration': configuration, 'sliding_window': sw_settings, 'num_repeats': num_repeats,
+                     'num_threads': num_threads, 'seed': seed},
+        'results': results
+    }
+
+
+def compare_benchmarks(baseline: dict, current: dict, threshold: float = 0.1, min_difference_s: float = 0.01,
+                       statistic: str = 'median_s') -> Tuple[List[dict], List[str]]:
+    """
+    Returns one row per benchmark present in both runs and a list of warnings (different format version,
+    environment, settings or output checksums). A row is a regression if current is more than threshold (relative)
+    AND more than min_difference_s (absolute, to ignore noise on tiny timings) slower than baseline, and an
+    improvement if it is faster by the same margins
+    """
+    warnings = []
+    if baseline.get('format_version') != current.get('format_version'):
+        warnings.append(f"format versions differ: {baseline.get('format_version')} vs "
+                        f"{current.get('format_version')}")
+    for k in ('processor', 'cpu_count', 'torch_num_threads', 'torch_version', 'numpy_version', 'platform'):
+        if baseline['environment'].get(k) != current['environment'].get(k):
+            warnings.append(f"environment differs in {k}: {baseline['environment'].get(k)} vs "
+                            f"{current['environment'].get(k)}")
+    for k in ('configuration', 'num_threads', 'seed', 'spacing'):
+        if baseline['settings'].get(k) != current['settings'].get(k):
+            warnings.append(f"settings differ in {k}: {baseline['settings'].get(k)} vs {current['settings'].get(k)}")
+    only_in_one = set(baseline['results'].keys()) ^ set(current['results'].keys())
+    if len(only_in_one) > 0:
+        warnings.append(f'{len(only_in_one)} benchmarks are only in one of the runs and are ignored')
+
+    rows = []
+    for key in [k for k in baseline['results'].keys() if k in current['results'].keys()]:
+        b, c = baseline['results'][key], current['results'][key]
+        if b.get('checksum') != c.get('checksum'):
+            warnings.append(f'{key}: output checksums differ, the runs did not compute the same thing')
+        diff = c[statistic] - b[statistic]
+        ratio = c[statistic] / max(b[statistic], 1e-9)
+        if diff > min_difference_s and ratio > 1 + threshold:
+            status = 'REGRESSION'
+        elif -diff > min_difference_s and ratio < 1 / (1 + threshold):
+            status = 'improvement'
+        else:
+            status = 'ok'
+        rows.append({'benchmark': key, 'baseline_s': b[statistic], 'current_s': c[statistic], 'ratio': ratio,
+                     'status': status})
+    return rows, warnings
+
+
+def inference_benchmark_entry_point():
+    parser = argparse.ArgumentParser(description='CPU inference benchmark with synthetic images and a synthetic '
+                                                 'model (no dataset or trained model needed). Times preprocessing, '
+                                                 'sliding window, export resampling and writing and saves the results '
+                                                 'as json. Compare two runs with nnUNetv2_compare_inference_benchmarks')
+    parser.add_argument('-o', type=str, required=True, help='output json file')
+    parser.add_argument('-sizes', nargs='+', type=str, required=False, default=['small', 'medium'],
+                        choices=list(SYNTHETIC_IMAGE_SIZES.keys()),
+                        help=f'image sizes to benchmark {SYNTHETIC_IMAGE_SIZES}. Default: small medium')
+    parser.add_argument('-c', type=str, required=False, default='3d_fullres', choices=['3d_fullres', '2d'],
+                        help='configuration of the synthetic model. Default: 3d_fullres')
+    parser.add_argument('-step_sizes', nargs='+', type=float, required=False, default=[0.5, 0.75],
+                        help='tile step sizes for the sliding window. Default: 0.5 0.75')
+    parser.add_argument('-num_folds', nargs='+', type=int, required=False, default=[1, 3],
+                        help='numbers of folds (ensembled) for the sliding window. Default: 1 3')
+    parser.add_argument('-tile_batch_sizes', nargs='+', type=str, required=False, default=['auto', '1'],
+                        help="tile batch sizes for the sliding window, 'auto' for the automatic choice. "
+                             "Default: auto 1")
+    parser.add_argument('--no_mirroring_benchmark', action='store_true',
+                        help='do not benchmark the sliding window with mirroring')
+    parser.add_argument('-n', type=int, required=False, default=3,
+                        help='number of timed repetitions (after one warmup). We compare medians. Default: 3')
+    parser.add_argument('-num_threads', type=int, required=False, default=4,
+                        help='torch threads. Keep this fixed for runs you want to compare. Default: 4')
+    parser.add_argument('-seed', type=int, required=False, default=1234,
+                        help='seed for the synthetic images and weights. Default: 1234')
+    args = parser.parse_args()
+
+    results = run_inference_benchmark(args.sizes, args.c, args.step_sizes,
+                                      [False] if args.no_mirroring_benchmark else [False, True], args.num_folds,
+                                      [None if i == 'auto' else int(i) for i in args.tile_batch_sizes], args.n,
+                                      args.num_threads, args.seed)
+    for key, r in results['results'].items():
+        print(f"{key:>60}: median {r['median_s']:8.4f} s (min {r['min_s']:8.4f} s)")
+    with open(args.o, 'w') as f:
+        json.dump(results, f, indent=4)
+
+
+def compare_inference_benchmarks_entry_point():
+    parser = argparse.ArgumentParser(description='Compares two json files written by nnUNetv2_benchmark_inference. '
+                                                 'Exit code 1 if there are regressions')
+    parser.add_argument('baseline', type=str, help='json of the reference run')
+    parser.add_argument('current', type=str, help='json of the run to check')
+    parser.add_argument('-threshold', type=float, required=False, default=0.1,
+                        help='relative slowdown that counts as regression. Default: 0.1 (10%%)')
+    parser.add_argument('-min_difference', type=float, required=False, default=0.01,
+                        help='slowdowns of less than this many seconds are never regressions (noise). Default: 0.01')
+    parser.add_argument('-statistic', type=str, required=False, default='median', choices=['median', 'min'],
+                        help='which statistic of the repetitions to compare. Default: median')
+    args = parser.parse_args()
+
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    with open(args.current, 'r') as f:
+        current = json.load(f)
+    rows, warnings = compare_benchmarks(baseline, current, args.threshold, args.min_difference,
+                                        args.statistic + '_s')
+    for w in warnings:
+        print(f'WARNING: {w}')
+    for r in rows:
+        print(f"{r['benchmark']:>60}: {r['baseline_s']:8.4f} s -> {r['current_s']:8.4f} s ({r['ratio']:5.2f}x) "
+              f"{r['status'] if r['status'] != 'ok' else ''}")
+    num_regressions = sum([r['status'] == 'REGRESSION' for r in rows])
+    print(f'{num_regressions} regressions, {sum([r["status"] == "improvement" for r in rows])} improvements')
+    sys.exit(1 if num_regressions > 0 else 0)
+
+
+if __name__ == '__main__':
+    inference_benchmark_entry_point()
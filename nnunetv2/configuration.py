@@ -7,4 +7,12 @@ default_num_processes = 8 if 'nnUNet_def_n_proc' not in os.environ else int(os.e
 ANISO_THRESHOLD = 3  # determines when a sample is considered anisotropic (3 means that the spacing in the low
 # resolution axis must be 3x as large as the next largest spacing)
 
-default_n_proc_DA = get_allowed_n_proc_DA()
+
+def __getattr__(name):
+    # default_n_proc_DA is only needed for training. Computing it may be slow (hostname lookup), so we only do it
+    # when someone asks for it
+    if name == 'default_n_proc_DA':
+        global default_n_proc_DA
+        default_n_proc_DA = get_allowed_n_proc_DA()
+        return default_n_proc_DA
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
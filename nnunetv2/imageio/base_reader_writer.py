@@ -68,6 +68,17 @@ class BaseReaderWriter(ABC):
         """
         pass
 
+    def read_image_shape_and_spacing(self, image_fname: str) -> Tuple[Tuple[int, ...], Tuple[float, ...]]:
+        """
+        Returns the spatial shape (x, y, z) and the spacing of the image, with the same conventions as read_images
+        (2D: x=1 and spacing 999 for it). Used to estimate how expensive an image is to predict before loading it,
+        see nnunetv2/inference/case_scheduling.py.
+
+        This default implementation reads the entire image. Override it if the format allows reading only the header
+        """
+        data, properties = self.read_images((image_fname, ))
+        return tuple(data.shape[1:]), tuple(properties['spacing'])
+
     @abstractmethod
     def read_seg(self, seg_fname: str) -> Tuple[np.ndarray, dict]:
         """
@@ -16,7 +16,6 @@
 from typing import Tuple, Union, List
 import numpy as np
 from nnunetv2.imageio.base_reader_writer import BaseReaderWriter
-from skimage import io
 
 
 class NaturalImage2DIO(BaseReaderWriter):
@@ -34,6 +33,8 @@ class NaturalImage2DIO(BaseReaderWriter):
     ]
 
     def read_images(self, image_fnames: Union[List[str], Tuple[str, ...]]) -> Tuple[np.ndarray, dict]:
+        # skimage is slow to import and this reader/writer is rarely used, so only import it when needed
+        from skimage import io
         images = []
         for f in image_fnames:
             npy_img = io.imread(f)
@@ -62,6 +63,7 @@ class NaturalImage2DIO(BaseReaderWriter):
         return self.read_images((seg_fname, ))
 
     def write_seg(self, seg: np.ndarray, output_fname: str, properties: dict) -> None:
+        from skimage import io
         io.imsave(output_fname, seg[0].astype(np.uint8, copy=False), check_contrast=False)
 
 
@@ -85,6 +85,12 @@ class NibabelIO(BaseReaderWriter):
         }
         return np.vstack(images, dtype=np.float32, casting='unsafe'), dict
 
+    def read_image_shape_and_spacing(self, image_fname: str) -> Tuple[Tuple[int, ...], Tuple[float, ...]]:
+        # nibabel.load only reads the header, the data is loaded on access
+        nib_image = nibabel.load(image_fname)
+        assert nib_image.ndim == 3, 'only 3d images are supported by NibabelIO'
+        return tuple(nib_image.shape[::-1]), tuple([float(i) for i in nib_image.header.get_zooms()[::-1]])
+
     def read_seg(self, seg_fname: str) -> Tuple[np.ndarray, dict]:
         return self.read_images((seg_fname, ))
 
@@ -166,6 +172,18 @@ class NibabelIOWithReorient(BaseReaderWriter):
         }
         return np.vstack(images, dtype=np.float32, casting='unsafe'), dict
 
+    def read_image_shape_and_spacing(self, image_fname: str) -> Tuple[Tuple[int, ...], Tuple[float, ...]]:
+        # nibabel.load only reads the header. Reorienting only permutes the axes (output axis ornt[i, 0] is input
+        # axis i), so we do that ourselves instead of as_reoriented, which would load the data
+        nib_image = nibabel.load(image_fname)
+        assert nib_image.ndim == 3, 'only 3d images are supported by NibabelIO'
+        ornt = io_orientation(nib_image.affine)
+        shape, zooms = [0] * 3, [0.] * 3
+        for i in range(3):
+            shape[int(ornt[i, 0])] = nib_image.shape[i]
+            zooms[int(ornt[i, 0])] = float(nib_image.header.get_zooms()[i])
+        return tuple(shape[::-1]), tuple(zooms[::-1])
+
     def read_seg(self, seg_fname: str) -> Tuple[np.ndarray, dict]:
         return self.read_images((seg_fname, ))
 
@@ -111,6 +111,20 @@ class SimpleITKIO(BaseReaderWriter):
         }
         return np.vstack(images, dtype=np.float32, casting='unsafe'), dict
 
+    def read_image_shape_and_spacing(self, image_fname: str) -> Tuple[Tuple[int, ...], Tuple[float, ...]]:
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(image_fname)
+        reader.ReadImageInformation()
+        if reader.GetNumberOfComponents() != 1:
+            return super().read_image_shape_and_spacing(image_fname)
+        # same axis order and 2d/4d handling as read_images
+        shape, spacing = reader.GetSize()[::-1], [abs(i) for i in reader.GetSpacing()[::-1]]
+        if len(shape) == 2:
+            return (1, *shape), (max(spacing) * 999, *spacing)
+        if len(shape) == 4:
+            return tuple(shape[1:]), tuple(spacing[1:])
+        return tuple(shape), tuple(spacing)
+
     def read_seg(self, seg_fname: str) -> Tuple[np.ndarray, dict]:
         return self.read_images((seg_fname, ))
 
@@ -0,0 +1,67 @@
+"""
+Size aware scheduling of the cases of a batch prediction (see nnUNetPredictor.predict_from_files,
+size_aware_scheduling=True).
+
+The cost of a case is estimated from the image header alone: shape and spacing -> shape after resampling to the target
+spacing -> number of sliding window tiles x folds x mirrored views, i.e. the number of tile predictions. Cropping to
+the nonzero region is not known at this point and ignored.
+
+Cases are predicted longest first so that a single huge scan does not end up at the end of the run when nothing else
+is left to overlap with it, and num_parts splits are balanced by estimated cost (greedy, the most expensive remaining
+case goes to the part with the least work so far) instead of by index. The split only depends on the file names and
+headers, so all parts compute the same split independently.
+"""
+from typing import List, Tuple
+
+import numpy as np
+
+from nnunetv2.inference.sliding_window_prediction import compute_steps_for_sliding_window
+from nnunetv2.preprocessing.resampling.default_resampling import compute_new_shape
+from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
+
+
+def estimate_prediction_cost(shape: Tuple[int, ...], spacing: Tuple[float, ...], plans_manager: PlansManager,
+                             configuration_manager: ConfigurationManager, tile_step_size: float, num_folds: int = 1,
+                             num_mirror_views: int = 1) -> int:
+    """
+    shape and spacing as returned by read_image_shape_and_spacing (x, y, z, before transpose_forward). Returns the
+    number of tile predictions (tiles x num_folds x num_mirror_views)
+    """
+    shape = [shape[i] for i in plans_manager.transpose_forward]
+    spacing = [spacing[i] for i in plans_manager.transpose_forward]
+    patch_size = configuration_manager.patch_size
+    target_spacing = configuration_manager.spacing
+    if len(target_spacing) < len(shape):
+        # 2d configuration: the spacing between slices does not change
+        target_spacing = [spacing[0], *target_spacing]
+    new_shape = compute_new_shape(shape, spacing, target_spacing)
+    in_plane = new_shape[len(new_shape) - len(patch_size):]
+    # images smaller than the patch size are padded
+    in_plane = [max(i, j) for i, j in zip(in_plane, patch_size)]
+    steps = compute_steps_for_sliding_window(in_plane, patch_size, tile_step_size)
+    num_tiles = int(np.prod([len(i) for i in steps]))
+    if len(patch_size) < len(new_shape):
+        num_tiles *= new_shape[0]
+    return num_tiles * num_folds * num_mirror_views
+
+
+def order_longest_first(costs: List[float]) -> List[int]:
+    """
+    indices of costs, most expensive first. Ties keep the input order
+    """
+    return sorted(range(len(costs)), key=lambda i: -costs[i])
+
+
+def split_into_balanced_parts(costs: List[float], num_parts: int) -> List[List[int]]:
+    """
+    Greedy longest processing time first: each case (most expensive first) goes to the part with the smallest total
+    cost so far (lowest part id on ties). Returns the indices of the cases of each part, most expensive first.
+    Deterministic
+    """
+    parts = [[] for _ in range(num_parts)]
+    loads = [0.] * num_parts
+    for i in order_longest_first(costs):
+        p = int(np.argmin(loads))
+        parts[p].append(i)
+        loads[p] += costs[i]
+    return parts
@@ -0,0 +1,312 @@
+"""
+Optional CPU inference engines for nnUNetPredictor (see the cpu_engine and cpu_engine_quantization arguments).
+
+The network is exported once per fold for the configuration's patch size and then run by a graph runtime instead of
+eager PyTorch:
+
+torchscript: traced + frozen TorchScript. No additional dependencies
+onnxruntime: ONNX export run by onnxruntime (pip install nnunetv2[onnx]). Threads are set up for intra-op
+             parallelism (one inference at a time, all threads on it)
+
+Quantization (int8):
+static: weights and activations are quantized. Activation ranges are calibrated on tiles of a few preprocessed cases,
+        see nnUNetPredictor.calibrate_cpu_engine. torchscript uses PyTorch FX graph mode quantization, onnxruntime its
+        own static quantization (QDQ, per channel weights)
+dynamic: weights are quantized, activation ranges are determined on the fly. Needs no calibration. Only supported by
+         onnxruntime because PyTorch's dynamic quantization does not handle convolutions
+
+Quantization costs accuracy. Use nnUNetv2_check_cpu_engine_accuracy to compare against the eager fp32 predictions
+before deploying a quantized model.
+"""
+import os
+import tempfile
+from contextlib import contextmanager
+from copy import deepcopy
+from typing import List, Tuple, Union
+
+import numpy as np
+import torch
+from torch import nn
+
+from nnunetv2.inference.sliding_window_prediction import compute_steps_for_sliding_window
+
+CPU_ENGINE_BACKENDS = ('torchscript', 'onnxruntime')
+CPU_ENGINE_QUANTIZATION = ('static', 'dynamic')
+
+
+def sample_calibration_tiles(list_of_data: List[torch.Tensor], patch_size: Tuple[int, ...],
+                             num_tiles_per_case: int = 8) -> List[torch.Tensor]:
+    """
+    list_of_data are preprocessed images (c, x, y(, z)). Returns up to num_tiles_per_case tiles (1, c, *patch_size)
+    per image, taken evenly from the positions the sliding window would predict so that calibration sees what the
+    network sees at inference time
+    """
+    from acvl_utils.cropping_and_padding.padding import pad_nd_image
+    tiles = []
+    for data in list_of_data:
+        data = pad_nd_image(data, patch_size, 'constant', {'value': 0}, False, None)
+        if len(patch_size) < len(data.shape[1:]):
+            # 2d configuration: tiles are slices
+            steps = [list(range(data.shape[1]))] + \
+                    compute_steps_for_sliding_window(data.shape[2:], patch_size, 0.5)
+            sizes = [1] + list(patch_size)
+        else:
+            steps = compute_steps_for_sliding_window(data.shape[1:], patch_size, 0.5)
+            sizes = list(patch_size)
+        positions = np.array(np.meshgrid(*steps, indexing='ij')).reshape(len(steps), -1).T
+        for p in positions[np.round(np.linspace(0, len(positions) - 1, min(num_tiles_per_case, len(positions))))
+                           .astype(int)]:
+            tile = data[(slice(None), *[slice(s, s + i) for s, i in zip(p, sizes)])]
+            if len(patch_size) < len(data.shape[1:]):
+                tile = tile[:, 0]
+            tiles.append(tile[None].float().contiguous())
+    return tiles
+
+
+def _get_quantized_engine() -> str:
+    return 'x86' if 'x86' in torch.backends.quantized.supported_engines else 'qnnpack'
+
+
+@contextmanager
+def _quantized_engine(engine: str):
+    """
+    torch.backends.quantized.engine is a global setting, so we only set it while we need it
+    """
+    previous_engine = torch.backends.quantized.engine
+    torch.backends.quantized.engine = engine
+    try:
+        yield
+    finally:
+        torch.backends.quantized.engine = previous_engine
+
+
+class QuantizedNetwork(nn.Module):
+    """
+    Runs a network that was quantized for engine (see _quantize_static_torch) with that engine, whatever the global
+    setting is
+    """
+    def __init__(self, network: nn.Module, engine: str):
+        super().__init__()
+        self.network = network
+        self.engine = engine
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        with _quantized_engine(self.engine):
+            return self.network(x)
+
+
+def _quantize_static_torch(network: nn.Module, example_input: torch.Tensor,
+                           calibration_tiles: List[torch.Tensor], engine: str) -> nn.Module:
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    qconfig_mapping = get_default_qconfig_mapping(engine)
+    # quantized transposed convolutions give wrong results with the x86 backend (3d). They are cheap compared to the
+    # rest of the network, so we keep them in fp32
+    for t in (nn.ConvTranspose1d, nn.ConvTranspose2d, nn.ConvTranspose3d):
+        qconfig_mapping = qconfig_mapping.set_object_type(t, None)
+    try:
+        prepared = prepare_fx(network, qconfig_mapping, (example_input,))
+    except Exception as e:
+        raise RuntimeError(f'Static quantization needs a network that can be symbolically traced with torch.fx. '
+                           f'{network.__class__.__name__} cannot: {e}')
+    with torch.no_grad():
+        for t in calibration_tiles:
+            prepared(t)
+    return convert_fx(prepared)
+
+
+class OnnxRuntimeNetwork(nn.Module):
+    """
+    Makes an onnxruntime session look like a network to nnUNetPredictor. Always runs on the CPU
+    """
+    def __init__(self, onnx_file: str, num_threads: int):
+        super().__init__()
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        options.inter_op_num_threads = 1
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(onnx_file, options, providers=['CPUExecutionProvider'])
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return torch.from_numpy(self.session.run(None, {'x': x.float().numpy()})[0])
+
+
+def _build_onnxruntime_network(network: nn.Module, example_input: torch.Tensor, quantization: Union[str, None],
+                               calibration_tiles: Union[List[torch.Tensor], None], num_threads: int) -> nn.Module:
+    with tempfile.TemporaryDirectory() as tmp:
+        onnx_file = os.path.join(tmp, 'network.onnx')
+        torch.onnx.export(network, (example_input,), onnx_file, input_names=['x'], output_names=['logits'],
+                          dynamic_axes={'x': {0: 'batch'}, 'logits': {0: 'batch'}})
+        if quantization is not None:
+            from onnxruntime.quantization import quantize_dynamic, quantize_static, QuantType, QuantFormat, \
+                CalibrationDataReader
+            from onnxruntime.quantization.shape_inference import quant_pre_process
+            pre_file = os.path.join(tmp, 'network_pre.onnx')
+            quant_pre_process(onnx_file, pre_file)
+            quantized_file = os.path.join(tmp, 'network_int8.onnx')
+            if quantization == 'dynamic':
+                quantize_dynamic(pre_file, quantized_file, weight_type=QuantType.QInt8)
+            else:
+                class _Reader(CalibrationDataReader):
+                    def __init__(self):
+                        self.tiles = iter(calibration_tiles)
+
+                    def get_next(self):
+                        t = next(self.tiles, None)
+                        return None if t is None else {'x': t.numpy()}
+                quantize_static(pre_file, quantized_file, _Reader(), quant_format=QuantFormat.QDQ, per_channel=True,
+                                activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+            onnx_file = quantized_file
+        # the session has read the model, the temporary files can go
+        return OnnxRuntimeNetwork(onnx_file, num_threads)
+
+
+def build_cpu_engine_network(network: nn.Module, example_input: torch.Tensor, backend: str = 'torchscript',
+                             quantization: Union[str, None] = None,
+                             calibration_tiles: Union[List[torch.Tensor], None] = None,
+                             num_threads: Union[int, None] = None) -> nn.Module:
+    """
+    network must have its weights loaded. example_input is (1, c, *patch_size). The network is not modified.
+    The returned module is only valid for CPU inference
+    """
+    assert backend in CPU_ENGINE_BACKENDS, f'backend must be one of {CPU_ENGINE_BACKENDS}, got {backend}'
+    assert quantization is None or quantization in CPU_ENGINE_QUANTIZATION, \
+        f'quantization must be None or one of {CPU_ENGINE_QUANTIZATION}, got {quantization}'
+    if quantization == 'static' and (calibration_tiles is None or len(calibration_tiles) == 0):
+        raise RuntimeError('Static quantization requires calibration data. Use nnUNetPredictor.calibrate_cpu_engine '
+                           'first')
+    if num_threads is None:
+        num_threads = torch.get_num_threads()
+    network = deepcopy(network).to('cpu').float().eval()
+
+    if backend == 'onnxruntime':
+        return _build_onnxruntime_network(network, example_input, quantization, calibration_tiles, num_threads)
+
+    if quantization == 'dynamic':
+        raise RuntimeError("PyTorch's dynamic quantization only covers linear layers, not convolutions. Use "
+                           "quantization 'static' or the onnxruntime backend")
+    with torch.no_grad():
+        if quantization == 'static':
+            engine = _get_quantized_engine()
+            with _quantized_engine(engine):
+                network = _quantize_static_torch(network, example_input, calibration_tiles, engine)
+                network = torch.jit.freeze(torch.jit.trace(network, example_input))
+            return QuantizedNetwork(network, engine)
+        traced = torch.jit.freeze(torch.jit.trace(network, example_input))
+        return torch.jit.optimize_for_inference(traced)
+
+
+def compute_dice_per_class(seg_ref: np.ndarray, seg_pred: np.ndarray,
+                           labels_or_regions: List[Union[int, Tuple[int, ...]]]) -> List[float]:
+    from nnunetv2.evaluation.evaluate_predictions import region_or_label_to_mask, compute_tp_fp_fn_tn
+    dice = []
+    for r in labels_or_regions:
+        tp, fp, fn, _ = compute_tp_fp_fn_tn(region_or_label_to_mask(seg_ref, r), region_or_label_to_mask(seg_pred, r))
+        dice.append(float(2 * tp / (2 * tp + fp + fn)) if tp + fp + fn > 0 else np.nan)
+    return dice
+
+
+def check_cpu_engine_accuracy(list_of_lists_or_source_folder: Union[str, List[List[str]]], model_folder: str,
+                              use_folds: Union[Tuple[Union[int, str], ...], None], checkpoint_name: str,
+                              cpu_engine: str, cpu_engine_quantization: Union[str, None],
+                              calibration_folder: Union[str, List[List[str]], None] = None,
+                              num_calibration_cases: int = 4, tile_step_size: float = 0.5,
+                              use_mirroring: bool = True) -> dict:
+    """
+    Predicts the given cases with the eager fp32 predictor and with the cpu engine and compares the resulting
+    segmentations (Dice per label/region, in the preprocessed space, reference is eager fp32). Also reports the
+    prediction times of both. Cascade is not supported
+    """
+    from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+    from nnunetv2.utilities.utils import create_lists_from_splitted_dataset_folder
+
+    predictors = {}
+    for name, kwargs in (('eager', {}),
+                         ('engine', {'cpu_engine': cpu_engine, 'cpu_engine_quantization': cpu_engine_quantization})):
+        predictor = nnUNetPredictor(tile_step_size=tile_step_size, use_mirroring=use_mirroring,
+                                    device=torch.device('cpu'), allow_tqdm=False, **kwargs)
+        predictor.initialize_from_trained_model_folder(model_folder, use_folds, checkpoint_name)
+        predictors[name] = predictor
+    if cpu_engine_quantization == 'static':
+        predictors['engine'].calibrate_cpu_engine(calibration_folder if calibration_folder is not None else
+                                                  list_of_lists_or_source_folder, num_calibration_cases)
+
+    eager = predictors['eager']
+    if isinstance(list_of_lists_or_source_folder, str):
+        list_of_lists_or_source_folder = create_lists_from_splitted_dataset_folder(
+            list_of_lists_or_source_folder, eager.dataset_json['file_ending'])
+    label_manager = eager.label_manager
+    labels_or_regions = label_manager.foreground_regions if label_manager.has_regions else \
+        label_manager.foreground_labels
+    preprocessor = eager.configuration_manager.preprocessor_class(verbose=False)
+
+    from time import time
+    results = {'cases': [], 'labels_or_regions': [str(i) for i in labels_or_regions]}
+    for files in list_of_lists_or_source_folder:
+        data, _, _ = preprocessor.run_case(files, None, eager.plans_manager, eager.configuration_manager,
+                                           eager.dataset_json)
+        data = torch.from_numpy(data)
+        segs, times = {}, {}
+        for name, predictor in predictors.items():
+            st = time()
+            logits = predictor.predict_logits_from_preprocessed_data(data)
+            times[name] = time() - st
+            segs[name] = label_manager.convert_logits_to_segmentation(logits).numpy()
+        dice = compute_dice_per_class(segs['eager'], segs['engine'], labels_or_regions)
+        results['cases'].append({'files': files, 'dice': dice, 'time_eager': times['eager'],
+                                 'time_engine': times['engine']})
+        print(f'{os.path.basename(files[0])}: Dice {np.round(dice, 4).tolist()}, eager {times["eager"]:.2f} s, '
+              f'engine {times["engine"]:.2f} s')
+    # the first case includes building the engine, leave it out of the timing if we can
+    timed = results['cases'][1:] if len(results['cases']) > 1 else results['cases']
+    results['mean_dice_per_class'] = np.nanmean([c['dice'] for c in results['cases']], 0).tolist()
+    results['mean_dice'] = float(np.nanmean(results['mean_dice_per_class']))
+    results['speedup'] = float(np.sum([c['time_eager'] for c in timed]) / np.sum([c['time_engine'] for c in timed]))
+    return results
+
+
+def check_cpu_engine_accuracy_entry_point():
+    import argparse
+    import json
+    parser = argparse.ArgumentParser(description='Compares the segmentations of a cpu engine (optionally quantized) '
+                                                 'with the regular eager fp32 prediction (Dice per label/region) '
+                                                 'and reports the speedup. Run this on representative cases before '
+                                                 'deploying a quantized model')
+    parser.add_argument('-i', type=str, required=True, help='input folder (same naming as for nnUNetv2_predict)')
+    parser.add_argument('-m', type=str, required=True, help='trained model folder (contains fold_X subfolders)')
+    parser.add_argument('-f', nargs='+', type=str, required=False, default=(0, 1, 2, 3, 4),
+                        help='folds. Default: (0, 1, 2, 3, 4)')
+    parser.add_argument('-chk', type=str, required=False, default='checkpoint_final.pth',
+                        help='checkpoint name. Default: checkpoint_final.pth')
+    parser.add_argument('-cpu_engine', type=str, required=False, default='torchscript', choices=CPU_ENGINE_BACKENDS,
+                        help='Default: torchscript')
+    parser.add_argument('-cpu_quantization', type=str, required=False, default=None,
+                        choices=CPU_ENGINE_QUANTIZATION, help='Default: None (fp32)')
+    parser.add_argument('-calibration_folder', type=str, required=False, default=None,
+                        help='images for static quantization calibration. Should not be the ones in -i. Default: '
+                             'use -i')
+    parser.add_argument('-num_calibration_cases', type=int, required=False, default=4,
+                        help='Default: 4')
+    parser.add_argument('-step_size', type=float, required=False, default=0.5, help='Default: 0.5')
+    parser.add_argument('--disable_tta', action='store_true', required=False, default=False,
+                        help='disable mirroring')
+    parser.add_argument('-min_dice', type=float, required=False, default=None,
+                        help='exit with code 1 if the mean Dice is below this value. Default: None')
+    parser.add_argument('-o', type=str, required=False, default=None, help='optional json output file')
+    args = parser.parse_args()
+
+    results = check_cpu_engine_accuracy(args.i, args.m, [i if i == 'all' else int(i) for i in args.f], args.chk,
+                                        args.cpu_engine, args.cpu_quantization, args.calibration_folder,
+                                        args.num_calibration_cases, args.step_size, not args.disable_tta)
+    dice_per_class = dict(zip(results['labels_or_regions'], np.round(results['mean_dice_per_class'], 4).tolist()))
+    print(f"mean Dice per label/region {dice_per_class}, mean Dice {results['mean_dice']:.4f}, "
+          f"speedup {results['speedup']:.2f}x")
+    if args.o is not None:
+        with open(args.o, 'w') as f:
+            json.dump(results, f, indent=4)
+    if args.min_dice is not None and results['mean_dice'] < args.min_dice:
+        print(f'FAILED: mean Dice {results["mean_dice"]:.4f} is below {args.min_dice}')
+        raise SystemExit(1)
@@ -1,5 +1,7 @@
 import multiprocessing
+import os
 import queue
+import threading
 from torch.multiprocessing import Pipe, Process, Manager, Event, Queue
 
 from time import sleep
@@ -12,6 +14,19 @@ from batchgenerators.dataloading.data_loader import DataLoader
 from nnunetv2.preprocessing.preprocessors.default_preprocessor import DefaultPreprocessor
 from nnunetv2.utilities.label_handling.label_handling import convert_labelmap_to_one_hot
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
+from nnunetv2.utilities.tracing import trace_span, trace_case, trace_peak_rss
+
+
+def _case_name(ofile: Union[str, None]) -> Union[str, None]:
+    return os.path.basename(ofile) if ofile is not None else None
+
+
+def get_nonzero_mask_from_seg(seg: np.ndarray) -> torch.Tensor:
+    """
+    crop_to_nonzero writes -1 into the (preprocessed) segmentation outside the nonzero mask of the image. This recovers
+    the mask (x, y(, z)) from it so that the prediction can skip tiles that only cover background
+    """
+    return torch.from_numpy(seg[0] >= 0)
 
 
 def preprocess_fromfiles_save_to_queue(list_of_lists: List[List[str]],
@@ -23,11 +38,17 @@ def preprocess_fromfiles_save_to_queue(list_of_lists: List[List[str]],
                                        target_queue: Queue,
                                        done_event: Event,
                                        abort_event: Event,
-                                       verbose: bool = False):
-    try:
-        label_manager = plans_manager.get_label_manager(dataset_json)
-        preprocessor = configuration_manager.preprocessor_class(verbose=verbose)
-        for idx in range(len(list_of_lists)):
+                                       verbose: bool = False,
+                                       return_nonzero_mask: bool = False):
+    """
+    Exceptions are raised and not handled here. preprocessing_iterator_fromfiles runs this through
+    _run_and_store_exception, which records the exception for the consumer before it sets abort_event
+    """
+    label_manager = plans_manager.get_label_manager(dataset_json)
+    preprocessor = configuration_manager.preprocessor_class(verbose=verbose)
+    for idx in range(len(list_of_lists)):
+        ofile = output_filenames_truncated[idx] if output_filenames_truncated is not None else None
+        with trace_case(_case_name(ofile)), trace_span('preprocess'):
             data, seg, data_properties = preprocessor.run_case(list_of_lists[idx],
                                                                list_of_segs_from_prev_stage_files[
                                                                    idx] if list_of_segs_from_prev_stage_files is not None else None,
@@ -40,9 +61,11 @@ def preprocess_fromfiles_save_to_queue(list_of_lists: List[List[str]],
 
             data = torch.from_numpy(data).to(dtype=torch.float32, memory_format=torch.contiguous_format)
 
-            item = {'data': data, 'data_properties': data_properties,
-                    'ofile': output_filenames_truncated[idx] if output_filenames_truncated is not None else None}
-            success = False
+        item = {'data': data, 'data_properties': data_properties, 'ofile': ofile}
+        if return_nonzero_mask:
+            item['nonzero_mask'] = get_nonzero_mask_from_seg(seg)
+        success = False
+        with trace_span('queue_put', case=_case_name(ofile)):
             while not success:
                 try:
                     if abort_event.is_set():
@@ -51,43 +74,20 @@ def preprocess_fromfiles_save_to_queue(list_of_lists: List[List[str]],
                     success = True
                 except queue.Full:
                     pass
-        done_event.set()
-    except Exception as e:
-        # print(Exception, e)
-        abort_event.set()
-        raise e
+    trace_peak_rss()
+    done_event.set()
 
 
-def preprocess_fromfiles_save(list_of_lists: List[List[str]],
-                                      list_of_segs_from_prev_stage_files: Union[None, List[str]],
-                                      output_filenames_truncated: Union[None, List[str]],
-                                      plans_manager: PlansManager,
-                                      dataset_json: dict,
-                                      configuration_manager: ConfigurationManager,
-                                      verbose: bool = False):
-    results = []
+def _run_and_store_exception(exceptions: List[Exception], abort_event: Event, target, *args):
+    """
+    The exception must be recorded before abort_event is set. Otherwise the consumer may see the abort without an
+    exception and raise a generic error, and the actual error is lost
+    """
     try:
-        label_manager = plans_manager.get_label_manager(dataset_json)
-        preprocessor = configuration_manager.preprocessor_class(verbose=verbose)
-        for idx in range(len(list_of_lists)):
-            data, seg, data_properties = preprocessor.run_case(list_of_lists[idx],
-                                                               list_of_segs_from_prev_stage_files[
-                                                                   idx] if list_of_segs_from_prev_stage_files is not None else None,
-                                                               plans_manager,
-                                                               configuration_manager,
-                                                               dataset_json)
-            if list_of_segs_from_prev_stage_files is not None and list_of_segs_from_prev_stage_files[idx] is not None:
-                seg_onehot = convert_labelmap_to_one_hot(seg[0], label_manager.foreground_labels, data.dtype)
-                data = np.vstack((data, seg_onehot))
-
-            data = torch.from_numpy(data).to(dtype=torch.float32, memory_format=torch.contiguous_format)
-
-            item = {'data': data, 'data_properties': data_properties,
-                    'ofile': output_filenames_truncated[idx] if output_filenames_truncated is not None else None}
-            results.append(item)
+        target(*args)
     except Exception as e:
-        raise e
-    return results
+        exceptions.append(e)
+        abort_event.set()
 
 
 def preprocessing_iterator_fromfiles(list_of_lists: List[List[str]],
@@ -98,74 +98,83 @@ def preprocessing_iterator_fromfiles(list_of_lists: List[List[str]],
                                      configuration_manager: ConfigurationManager,
                                      num_processes: int,
                                      pin_memory: bool = False,
-                                     verbose: bool = False):
+                                     verbose: bool = False,
+                                     queue_depth: int = 1,
+                                     return_nonzero_mask: bool = False):
+    """
+    Preprocesses the cases in background threads and yields them (in input order) as soon as they are ready, so
+    prediction of the first case can start while the others are still being preprocessed.
+
+    We use threads and not processes because this needs to run on AWS Lambda (no /dev/shm, no forking). Each worker
+    holds at most queue_depth preprocessed cases in its queue, so RAM usage is bounded by
+    num_processes * (queue_depth + 1) cases and does not grow with the number of cases.
+
+    If return_nonzero_mask, the items additionally contain the nonzero mask (see get_nonzero_mask_from_seg)
+    """
     assert len(list_of_lists) > 0
+    assert queue_depth >= 1
 
-    # Adjust number of processes based on input and specified number of processes
     num_processes = min(len(list_of_lists), num_processes)
     assert num_processes >= 1
 
-    file_chunks = [list_of_lists]  # Single chunk for single process
-    seg_chunks = [list_of_segs_from_prev_stage_files] if list_of_segs_from_prev_stage_files is not None else [None]
-    output_chunks = [output_filenames_truncated] if output_filenames_truncated is not None else [None]
+    threads = []
+    done_events = []
+    target_queues = []
+    worker_exceptions = []
+    abort_event = threading.Event()
+    for i in range(num_processes):
+        event = threading.Event()
+        target_queue = queue.Queue(maxsize=queue_depth)
+        th = threading.Thread(target=_run_and_store_exception,
+                              args=(
+                                  worker_exceptions,
+                                  abort_event,
+                                  preprocess_fromfiles_save_to_queue,
+                                  list_of_lists[i::num_processes],
+                                  list_of_segs_from_prev_stage_files[
+                                  i::num_processes] if list_of_segs_from_prev_stage_files is not None else None,
+                                  output_filenames_truncated[
+                                  i::num_processes] if output_filenames_truncated is not None else None,
+                                  plans_manager,
+                                  dataset_json,
+                                  configuration_manager,
+                                  target_queue,
+                                  event,
+                                  abort_event,
+                                  verbose,
+                                  return_nonzero_mask
+                              ), daemon=True)
+        th.start()
+        threads.append(th)
+        done_events.append(event)
+        target_queues.append(target_queue)
 
-    for file_list, seg_list, output_list in zip(file_chunks, seg_chunks, output_chunks):
-        results = preprocess_fromfiles_save(file_list, seg_list, output_list, plans_manager, dataset_json, configuration_manager, verbose)
-        for item in results:
+    try:
+        worker_ctr = 0
+        while (not done_events[worker_ctr].is_set()) or (not target_queues[worker_ctr].empty()):
+            try:
+                item = target_queues[worker_ctr].get(timeout=0.01)
+            except queue.Empty:
+                if len(worker_exceptions) > 0:
+                    raise worker_exceptions[0]
+                all_ok = all([i.is_alive() or j.is_set() for i, j in zip(threads, done_events)]) and \
+                         not abort_event.is_set()
+                if not all_ok:
+                    # the abort may also come from another worker that is still recording its exception. Give the
+                    # workers a moment before we fall back to the generic error
+                    [th.join(timeout=0.1) for th in threads]
+                    if len(worker_exceptions) > 0:
+                        raise worker_exceptions[0]
+                    raise RuntimeError('Background workers died. Look for the error message further up!')
+                continue
+            worker_ctr = (worker_ctr + 1) % num_processes
             if pin_memory:
                 [i.pin_memory() for i in item.values() if isinstance(i, torch.Tensor)]
-            print("item returned")
             yield item
-    # context = multiprocessing.get_context('spawn')
-    # manager = Manager()
-    # num_processes = min(len(list_of_lists), num_processes)
-    # assert num_processes >= 1
-    # processes = []
-    # done_events = []
-    # target_queues = []
-    # abort_event = manager.Event()
-    # for i in range(num_processes):
-    #     event = manager.Event()
-    #     queue = Manager().Queue(maxsize=1)
-    #     pr = context.Process(target=preprocess_fromfiles_save_to_queue,
-    #                  args=(
-    #                      list_of_lists[i::num_processes],
-    #                      list_of_segs_from_prev_stage_files[
-    #                      i::num_processes] if list_of_segs_from_prev_stage_files is not None else None,
-    #                      output_filenames_truncated[
-    #                      i::num_processes] if output_filenames_truncated is not None else None,
-    #                      plans_manager,
-    #                      dataset_json,
-    #                      configuration_manager,
-    #                      queue,
-    #                      event,
-    #                      abort_event,
-    #                      verbose
-    #                  ), daemon=True)
-    #     pr.start()
-    #     target_queues.append(queue)
-    #     done_events.append(event)
-    #     processes.append(pr)
-
-    # worker_ctr = 0
-    # while (not done_events[worker_ctr].is_set()) or (not target_queues[worker_ctr].empty()):
-    #     # import IPython;IPython.embed()
-    #     if not target_queues[worker_ctr].empty():
-    #         item = target_queues[worker_ctr].get()
-    #         worker_ctr = (worker_ctr + 1) % num_processes
-    #     else:
-    #         all_ok = all(
-    #             [i.is_alive() or j.is_set() for i, j in zip(processes, done_events)]) and not abort_event.is_set()
-    #         if not all_ok:
-    #             raise RuntimeError('Background workers died. Look for the error message further up! If there is '
-    #                                'none then your RAM was full and the worker was killed by the OS. Use fewer '
-    #                                'workers or get more RAM in that case!')
-    #         sleep(0.01)
-    #         continue
-    #     if pin_memory:
-    #         [i.pin_memory() for i in item.values() if isinstance(i, torch.Tensor)]
-    #     yield item
-    # [p.join() for p in processes]
+        [th.join() for th in threads]
+    finally:
+        # tell the workers to stop in case we exit early (error or the consumer stopped iterating)
+        abort_event.set()
 
 
 class PreprocessAdapter(DataLoader):
@@ -176,9 +185,11 @@ class PreprocessAdapter(DataLoader):
                  plans_manager: PlansManager,
                  dataset_json: dict,
                  configuration_manager: ConfigurationManager,
-                 num_threads_in_multithreaded: int = 1):
+                 num_threads_in_multithreaded: int = 1,
+                 return_nonzero_mask: bool = False):
         self.preprocessor, self.plans_manager, self.configuration_manager, self.dataset_json = \
             preprocessor, plans_manager, configuration_manager, dataset_json
+        self.return_nonzero_mask = return_nonzero_mask
 
         self.label_manager = plans_manager.get_label_manager(dataset_json)
 
@@ -200,16 +211,18 @@ class PreprocessAdapter(DataLoader):
         # if we have a segmentation from the previous stage we have to process it together with the images so that we
         # can crop it appropriately (if needed). Otherwise it would just be resized to the shape of the data after
         # preprocessing and then there might be misalignments
-        data, seg, data_properties = self.preprocessor.run_case(files, seg_prev_stage, self.plans_manager,
-                                                                self.configuration_manager,
-                                                                self.dataset_json)
-        if seg_prev_stage is not None:
-            seg_onehot = convert_labelmap_to_one_hot(seg[0], self.label_manager.foreground_labels, data.dtype)
-            data = np.vstack((data, seg_onehot))
-
-        data = torch.from_numpy(data)
+        with trace_case(_case_name(ofile)), trace_span('preprocess'):
+            data, seg, data_properties = self.preprocessor.run_case(files, seg_prev_stage, self.plans_manager,
+                                                                    self.configuration_manager,
+                                                                    self.dataset_json)
+            if seg_prev_stage is not None:
+                seg_onehot = convert_labelmap_to_one_hot(seg[0], self.label_manager.foreground_labels, data.dtype)
+                data = np.vstack((data, seg_onehot))
 
-        return {'data': data, 'data_properties': data_properties, 'ofile': ofile}
+        ret = {'data': torch.from_numpy(data), 'data_properties': data_properties, 'ofile': ofile}
+        if self.return_nonzero_mask:
+            ret['nonzero_mask'] = get_nonzero_mask_from_seg(seg)
+        return ret
 
 
 class PreprocessAdapterFromNpy(DataLoader):
@@ -218,10 +231,11 @@ class PreprocessAdapterFromNpy(DataLoader):
                  list_of_image_properties: List[dict],
                  truncated_ofnames: Union[List[str], None],
                  plans_manager: PlansManager, dataset_json: dict, configuration_manager: ConfigurationManager,
-                 num_threads_in_multithreaded: int = 1, verbose: bool = False):
+                 num_threads_in_multithreaded: int = 1, verbose: bool = False, return_nonzero_mask: bool = False):
         preprocessor = configuration_manager.preprocessor_class(verbose=verbose)
         self.preprocessor, self.plans_manager, self.configuration_manager, self.dataset_json, self.truncated_ofnames = \
             preprocessor, plans_manager, configuration_manager, dataset_json, truncated_ofnames
+        self.return_nonzero_mask = return_nonzero_mask
 
         self.label_manager = plans_manager.get_label_manager(dataset_json)
 
@@ -244,17 +258,19 @@ class PreprocessAdapterFromNpy(DataLoader):
         # if we have a segmentation from the previous stage we have to process it together with the images so that we
         # can crop it appropriately (if needed). Otherwise it would just be resized to the shape of the data after
         # preprocessing and then there might be misalignments
-        data, seg = self.preprocessor.run_case_npy(image, seg_prev_stage, props,
-                                                   self.plans_manager,
-                                                   self.configuration_manager,
-                                                   self.dataset_json)
-        if seg_prev_stage is not None:
-            seg_onehot = convert_labelmap_to_one_hot(seg[0], self.label_manager.foreground_labels, data.dtype)
-            data = np.vstack((data, seg_onehot))
-
-        data = torch.from_numpy(data)
+        with trace_case(_case_name(ofname)), trace_span('preprocess'):
+            data, seg = self.preprocessor.run_case_npy(image, seg_prev_stage, props,
+                                                       self.plans_manager,
+                                                       self.configuration_manager,
+                                                       self.dataset_json)
+            if seg_prev_stage is not None:
+                seg_onehot = convert_labelmap_to_one_hot(seg[0], self.label_manager.foreground_labels, data.dtype)
+                data = np.vstack((data, seg_onehot))
 
-        return {'data': data, 'data_properties': props, 'ofile': ofname}
+        ret = {'data': torch.from_numpy(data), 'data_properties': props, 'ofile': ofname}
+        if self.return_nonzero_mask:
+            ret['nonzero_mask'] = get_nonzero_mask_from_seg(seg)
+        return ret
 
 
 def preprocess_fromnpy_save_to_queue(list_of_images: List[np.ndarray],
@@ -267,26 +283,31 @@ def preprocess_fromnpy_save_to_queue(list_of_images: List[np.ndarray],
                                      target_queue: Queue,
                                      done_event: Event,
                                      abort_event: Event,
-                                     verbose: bool = False):
+                                     verbose: bool = False,
+                                     return_nonzero_mask: bool = False):
     try:
         label_manager = plans_manager.get_label_manager(dataset_json)
         preprocessor = configuration_manager.preprocessor_class(verbose=verbose)
         for idx in range(len(list_of_images)):
-            data, seg = preprocessor.run_case_npy(list_of_images[idx],
-                                                  list_of_segs_from_prev_stage[
-                                                      idx] if list_of_segs_from_prev_stage is not None else None,
-                                                  list_of_image_properties[idx],
-                                                  plans_manager,
-                                                  configuration_manager,
-                                                  dataset_json)
-            if list_of_segs_from_prev_stage is not None and list_of_segs_from_prev_stage[idx] is not None:
-                seg_onehot = convert_labelmap_to_one_hot(seg[0], label_manager.foreground_labels, data.dtype)
-                data = np.vstack((data, seg_onehot))
-
-            data = torch.from_numpy(data).to(dtype=torch.float32, memory_format=torch.contiguous_format)
+            with trace_case(_case_name(truncated_ofnames[idx] if truncated_ofnames is not None else None)), \
+                    trace_span('preprocess'):
+                data, seg = preprocessor.run_case_npy(list_of_images[idx],
+                                                      list_of_segs_from_prev_stage[
+                                                          idx] if list_of_segs_from_prev_stage is not None else None,
+                                                      list_of_image_properties[idx],
+                                                      plans_manager,
+                                                      configuration_manager,
+                                                      dataset_json)
+                if list_of_segs_from_prev_stage is not None and list_of_segs_from_prev_stage[idx] is not None:
+                    seg_onehot = convert_labelmap_to_one_hot(seg[0], label_manager.foreground_labels, data.dtype)
+                    data = np.vstack((data, seg_onehot))
+
+                data = torch.from_numpy(data).to(dtype=torch.float32, memory_format=torch.contiguous_format)
 
             item = {'data': data, 'data_properties': list_of_image_properties[idx],
                     'ofile': truncated_ofnames[idx] if truncated_ofnames is not None else None}
+            if return_nonzero_mask:
+                item['nonzero_mask'] = get_nonzero_mask_from_seg(seg)
             success = False
             while not success:
                 try:
@@ -311,7 +332,8 @@ def preprocessing_iterator_fromnpy(list_of_images: List[np.ndarray],
                                    configuration_manager: ConfigurationManager,
                                    num_processes: int,
                                    pin_memory: bool = False,
-                                   verbose: bool = False):
+                                   verbose: bool = False,
+                                   return_nonzero_mask: bool = False):
     context = multiprocessing.get_context('spawn')
     manager = Manager()
     num_processes = min(len(list_of_images), num_processes)
@@ -336,7 +358,8 @@ def preprocessing_iterator_fromnpy(list_of_images: List[np.ndarray],
                          queue,
                          event,
                          abort_event,
-                         verbose
+                         verbose,
+                         return_nonzero_mask
                      ), daemon=True)
         pr.start()
         done_events.append(event)
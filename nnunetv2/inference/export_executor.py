@@ -0,0 +1,65 @@
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Union
+
+from nnunetv2.configuration import default_num_processes
+
+
+class BoundedExportExecutor(object):
+    def __init__(self, executor: Union[Executor, None] = None, num_workers: int = default_num_processes,
+                 max_in_flight: Union[int, None] = None):
+        """
+        Runs the segmentation export (resampling, argmax, writing) in the background so that the prediction of the
+        next case can proceed. Any concurrent.futures.Executor can be plugged in. If none is given we create a
+        ThreadPoolExecutor because threads work everywhere (processes are not an option on AWS Lambda).
+
+        max_in_flight limits the number of exports that are queued or running. If it is reached, wait_until_not_busy
+        blocks so that we don't end up holding the logits of a bazillion cases in RAM. Default: num_workers + 2, same
+        as what check_workers_alive_and_busy used to allow.
+
+        Errors raised in the export are re-raised in the main thread at the next submit/wait.
+        """
+        self._owns_executor = executor is None
+        self.executor = executor if executor is not None else \
+            ThreadPoolExecutor(max_workers=max(1, num_workers), thread_name_prefix='nnUNet_export')
+        self.max_in_flight = max_in_flight if max_in_flight is not None else max(1, num_workers) + 2
+        self._futures: List[Future] = []
+
+    def _raise_if_failed(self):
+        for f in self._futures:
+            if f.done() and not f.cancelled() and f.exception() is not None:
+                raise f.exception()
+
+    def num_in_flight(self) -> int:
+        return sum([not f.done() for f in self._futures])
+
+    def wait_until_not_busy(self, max_in_flight: Union[int, None] = None):
+        """
+        max_in_flight: overrides self.max_in_flight for this call (used by InferencePlan, see inference_plan.py)
+        """
+        max_in_flight = max_in_flight if max_in_flight is not None else self.max_in_flight
+        self._raise_if_failed()
+        while self.num_in_flight() >= max_in_flight:
+            wait([f for f in self._futures if not f.done()], return_when=FIRST_COMPLETED)
+            self._raise_if_failed()
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        self.wait_until_not_busy()
+        future = self.executor.submit(fn, *args, **kwargs)
+        self._futures.append(future)
+        return future
+
+    def results(self) -> list:
+        """
+        blocks until all exports are done and returns their return values in submission order
+        """
+        return [f.result() for f in self._futures]
+
+    def shutdown(self, cancel_pending: bool = False):
+        if self._owns_executor:
+            self.executor.shutdown(wait=True, cancel_futures=cancel_pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(cancel_pending=exc_type is not None)
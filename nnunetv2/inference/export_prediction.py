@@ -1,15 +1,111 @@
 import os
 from copy import deepcopy
-from typing import Union, List
+from typing import Union, List, Tuple
 
 import numpy as np
 import torch
 from acvl_utils.cropping_and_padding.bounding_boxes import bounding_box_to_slice
 from batchgenerators.utilities.file_and_folder_operations import load_json, isfile, save_pickle
 
-from nnunetv2.configuration import default_num_processes
+from nnunetv2.configuration import default_num_processes, ANISO_THRESHOLD
+from nnunetv2.preprocessing.resampling.default_resampling import determine_do_sep_z_and_axis
 from nnunetv2.utilities.label_handling.label_handling import LabelManager
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
+from nnunetv2.utilities.tracing import trace_span, trace_case
+
+
+def get_axis0_interpolation_order(configuration_manager: ConfigurationManager,
+                                  current_spacing: Union[List[float], Tuple[float, ...]],
+                                  new_spacing: Union[List[float], Tuple[float, ...]]) -> Union[int, None]:
+    """
+    The streaming export resamples slabs in-plane with resampling_fn_probabilities and does the interpolation along
+    axis 0 itself. That is only the same as resampling everything at once if we know what resampling_fn_probabilities
+    does along axis 0. Returns the interpolation order it uses along axis 0 (0: nearest, 1: linear) or None if we
+    don't know (or it is something else, such as cubic)
+    """
+    name = configuration_manager.configuration['resampling_fn_probabilities']
+    kwargs = configuration_manager.configuration['resampling_fn_probabilities_kwargs']
+    if name == 'resample_data_or_seg_to_shape':
+        force_separate_z = kwargs.get('force_separate_z', False)
+    elif name == 'resample_torch_fornnunet':
+        force_separate_z = kwargs.get('force_separate_z', None)
+    else:
+        return None
+    do_separate_z, axis = determine_do_sep_z_and_axis(
+        force_separate_z, current_spacing, new_spacing,
+        kwargs.get('separate_z_anisotropy_threshold', ANISO_THRESHOLD))
+    if do_separate_z:
+        if axis != 0:
+            return None
+        if name == 'resample_data_or_seg_to_shape':
+            order = kwargs.get('order_z', 0)
+        else:
+            order = {'nearest-exact': 0, 'linear': 1}.get(kwargs.get('aniso_axis_mode', 'nearest-exact'))
+    else:
+        if name == 'resample_data_or_seg_to_shape':
+            order = kwargs.get('order', 3)
+        else:
+            order = {'linear': 1}.get(kwargs.get('mode', 'linear'))
+    return order if order in (0, 1) else None
+
+
+def get_export_spacings(plans_manager: PlansManager, configuration_manager: ConfigurationManager,
+                        properties_dict: dict) -> Tuple[List[float], List[float]]:
+    """
+    spacing of the predicted logits and spacing to resample them to (both transposed)
+    """
+    spacing_transposed = [properties_dict['spacing'][i] for i in plans_manager.transpose_forward]
+    current_spacing = configuration_manager.spacing if \
+        len(configuration_manager.spacing) == \
+        len(properties_dict['shape_after_cropping_and_before_resampling']) else \
+        [spacing_transposed[0], *configuration_manager.spacing]
+    return current_spacing, spacing_transposed
+
+
+def resample_logits_and_convert_to_segmentation_in_slabs(predicted_logits: Union[torch.Tensor, np.ndarray],
+                                                         segmentation: np.ndarray,
+                                                         current_spacing: Union[List[float], Tuple[float, ...]],
+                                                         new_spacing: Union[List[float], Tuple[float, ...]],
+                                                         configuration_manager: ConfigurationManager,
+                                                         label_manager: LabelManager,
+                                                         axis0_order: int,
+                                                         slab_size: int = 32):
+    """
+    Resamples predicted_logits (c, x, y(, z)) to segmentation.shape and writes the segmentation into segmentation (in
+    place), one slab of slab_size output voxels along axis 0 at a time. Each slab takes the input rows it needs
+    (adjacent slabs overlap by one row), resamples them in-plane with resampling_fn_probabilities and interpolates
+    along axis 0 with axis0_order (see get_axis0_interpolation_order) using the coordinates of the full volume. So
+    the result is the same as resampling everything at once, but we only ever hold one slab in float. No softmax
+    needed, see LabelManager.convert_logits_to_segmentation_skip_nonlin
+    """
+    n_in = predicted_logits.shape[1]
+    n_out = segmentation.shape[0]
+    scale = n_in / n_out
+    for o0 in range(0, n_out, slab_size):
+        o1 = min(o0 + slab_size, n_out)
+        # align_corners=False, same as skimage, scipy and torch
+        src = ((torch.arange(o0, o1, dtype=torch.float64) + 0.5) * scale - 0.5).clamp(0, n_in - 1)
+        if axis0_order == 0:
+            lower = torch.floor(src + 0.5).long().clamp(max=n_in - 1)
+            upper = lower
+        else:
+            lower = torch.floor(src).long()
+            upper = (lower + 1).clamp(max=n_in - 1)
+        i0, i1 = lower.min().item(), upper.max().item() + 1
+
+        with trace_span('export_resample', slab=(o0, o1)):
+            slab = torch.as_tensor(predicted_logits[:, i0:i1]).float()
+            slab = configuration_manager.resampling_fn_probabilities(slab, [i1 - i0, *segmentation.shape[1:]],
+                                                                     current_spacing, new_spacing)
+            slab = torch.as_tensor(slab).float()
+            if axis0_order == 0:
+                slab = slab[:, lower - i0]
+            else:
+                weight = (src - lower).float().view(1, -1, *[1] * (slab.ndim - 2))
+                slab = slab[:, lower - i0] * (1 - weight) + slab[:, upper - i0] * weight
+        with trace_span('argmax', slab=(o0, o1)):
+            segmentation[o0:o1] = label_manager.convert_logits_to_segmentation_skip_nonlin(slab).cpu().numpy()
+        del slab
 
 
 def convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits: Union[torch.Tensor, np.ndarray],
@@ -18,26 +114,45 @@ def convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits
                                                                 label_manager: LabelManager,
                                                                 properties_dict: dict,
                                                                 return_probabilities: bool = False,
-                                                                num_threads_torch: int = default_num_processes):
-    print("made it to convert_predicted_logits_to_segmentation_with_correct_shape")
+                                                                num_threads_torch: int = default_num_processes,
+                                                                slab_size: Union[int, None] = 32):
+    """
+    If no probabilities are requested, the resampling and argmax are done in slabs of slab_size voxels along the first
+    axis so that the peak memory is bounded by a slab and not by the full resolution class stack (see
+    resample_logits_and_convert_to_segmentation_in_slabs). This happens only for resampling functions we know how to
+    split (see get_axis0_interpolation_order). slab_size=None always resamples everything at once
+    """
     old_threads = torch.get_num_threads()
     torch.set_num_threads(num_threads_torch)
 
+    current_spacing, spacing_transposed = get_export_spacings(plans_manager, configuration_manager, properties_dict)
+    axis0_order = get_axis0_interpolation_order(configuration_manager, current_spacing, spacing_transposed) \
+        if slab_size is not None and not return_probabilities else None
+    if axis0_order is not None:
+        segmentation_reverted_cropping = np.zeros(properties_dict['shape_before_cropping'],
+                                                  dtype=np.uint8 if len(label_manager.foreground_labels) < 255 else
+                                                  np.uint16)
+        slicer = bounding_box_to_slice(properties_dict['bbox_used_for_cropping'])
+        resample_logits_and_convert_to_segmentation_in_slabs(predicted_logits,
+                                                             segmentation_reverted_cropping[slicer],
+                                                             current_spacing, spacing_transposed,
+                                                             configuration_manager, label_manager, axis0_order,
+                                                             slab_size)
+        torch.set_num_threads(old_threads)
+        return segmentation_reverted_cropping.transpose(plans_manager.transpose_backward)
+
     # resample to original shape
-    spacing_transposed = [properties_dict['spacing'][i] for i in plans_manager.transpose_forward]
-    current_spacing = configuration_manager.spacing if \
-        len(configuration_manager.spacing) == \
-        len(properties_dict['shape_after_cropping_and_before_resampling']) else \
-        [spacing_transposed[0], *configuration_manager.spacing]
-    predicted_logits = configuration_manager.resampling_fn_probabilities(predicted_logits,
-                                            properties_dict['shape_after_cropping_and_before_resampling'],
-                                            current_spacing,
-                                            [properties_dict['spacing'][i] for i in plans_manager.transpose_forward])
+    with trace_span('export_resample'):
+        predicted_logits = configuration_manager.resampling_fn_probabilities(predicted_logits,
+                                                properties_dict['shape_after_cropping_and_before_resampling'],
+                                                current_spacing,
+                                                spacing_transposed)
     # return value of resampling_fn_probabilities can be ndarray or Tensor but that does not matter because
     # apply_inference_nonlin will convert to torch
-    predicted_probabilities = label_manager.apply_inference_nonlin(predicted_logits)
-    del predicted_logits
-    segmentation = label_manager.convert_probabilities_to_segmentation(predicted_probabilities)
+    with trace_span('argmax'):
+        predicted_probabilities = label_manager.apply_inference_nonlin(predicted_logits)
+        del predicted_logits
+        segmentation = label_manager.convert_probabilities_to_segmentation(predicted_probabilities)
 
     # segmentation may be torch.Tensor but we continue with numpy
     if isinstance(segmentation, torch.Tensor):
@@ -74,7 +189,11 @@ def export_prediction_from_logits(predicted_array_or_file: Union[np.ndarray, tor
                                   configuration_manager: ConfigurationManager,
                                   plans_manager: PlansManager,
                                   dataset_json_dict_or_file: Union[dict, str], output_file_truncated: str,
-                                  save_probabilities: bool = False):
+                                  save_probabilities: bool = False,
+                                  slab_size: Union[int, None] = 32):
+    """
+    slab_size: see convert_predicted_logits_to_segmentation_with_correct_shape
+    """
     # if isinstance(predicted_array_or_file, str):
     #     tmp = deepcopy(predicted_array_or_file)
     #     if predicted_array_or_file.endswith('.npy'):
@@ -82,30 +201,57 @@ def export_prediction_from_logits(predicted_array_or_file: Union[np.ndarray, tor
     #     elif predicted_array_or_file.endswith('.npz'):
     #         predicted_array_or_file = np.load(predicted_array_or_file)['softmax']
     #     os.remove(tmp)
-    print("made it to export_prediction_from_logits")
     if isinstance(dataset_json_dict_or_file, str):
         dataset_json_dict_or_file = load_json(dataset_json_dict_or_file)
 
-    label_manager = plans_manager.get_label_manager(dataset_json_dict_or_file)
-    ret = convert_predicted_logits_to_segmentation_with_correct_shape(
-        predicted_array_or_file, plans_manager, configuration_manager, label_manager, properties_dict,
-        return_probabilities=save_probabilities
-    )
-    del predicted_array_or_file
-
-    # save
-    if save_probabilities:
-        segmentation_final, probabilities_final = ret
-        np.savez_compressed(output_file_truncated + '.npz', probabilities=probabilities_final)
-        save_pickle(properties_dict, output_file_truncated + '.pkl')
-        del probabilities_final, ret
-    else:
-        segmentation_final = ret
-        del ret
+    with trace_case(os.path.basename(output_file_truncated)), trace_span('export'):
+        label_manager = plans_manager.get_label_manager(dataset_json_dict_or_file)
+        ret = convert_predicted_logits_to_segmentation_with_correct_shape(
+            predicted_array_or_file, plans_manager, configuration_manager, label_manager, properties_dict,
+            return_probabilities=save_probabilities, slab_size=slab_size
+        )
+        del predicted_array_or_file
+
+        # save
+        if save_probabilities:
+            segmentation_final, probabilities_final = ret
+            with trace_span('write_probabilities'):
+                np.savez_compressed(output_file_truncated + '.npz', probabilities=probabilities_final)
+                save_pickle(properties_dict, output_file_truncated + '.pkl')
+            del probabilities_final, ret
+        else:
+            segmentation_final = ret
+            del ret
 
-    rw = plans_manager.image_reader_writer_class()
-    rw.write_seg(segmentation_final, output_file_truncated + dataset_json_dict_or_file['file_ending'],
-                 properties_dict)
+        with trace_span('write'):
+            rw = plans_manager.image_reader_writer_class()
+            rw.write_seg(segmentation_final, output_file_truncated + dataset_json_dict_or_file['file_ending'],
+                         properties_dict)
+
+
+def resample_logits_to_next_stage_segmentation(predicted_logits: Union[torch.Tensor, np.ndarray],
+                                               target_shape: Union[List[int], Tuple[int, ...]],
+                                               current_spacing: Union[List[float], Tuple[float, ...]],
+                                               target_spacing: Union[List[float], Tuple[float, ...]],
+                                               configuration_manager: ConfigurationManager,
+                                               label_manager: LabelManager,
+                                               num_threads_torch: int = default_num_processes) -> np.ndarray:
+    """
+    Used by the in-process cascade. predicted_logits are the logits of the previous stage in its preprocessed
+    geometry (cropped, transposed, spacing of configuration_manager). Both stages crop the same bounding box, so we can
+    resample them straight to the preprocessed shape of the next stage (target_shape) instead of going back to the
+    original image geometry and preprocessing the segmentation again. configuration_manager is the one of the previous
+    stage (its resampling_fn_probabilities is used)
+    """
+    old_threads = torch.get_num_threads()
+    torch.set_num_threads(num_threads_torch)
+    predicted_logits = configuration_manager.resampling_fn_probabilities(predicted_logits, target_shape,
+                                                                        current_spacing, target_spacing)
+    segmentation = label_manager.convert_logits_to_segmentation(predicted_logits)
+    if isinstance(segmentation, torch.Tensor):
+        segmentation = segmentation.cpu().numpy()
+    torch.set_num_threads(old_threads)
+    return segmentation
 
 
 def resample_and_save(predicted: Union[torch.Tensor, np.ndarray], target_shape: List[int], output_file: str,
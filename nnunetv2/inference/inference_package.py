@@ -0,0 +1,206 @@
+"""
+Inference packages are a stripped down version of a trained model folder that loads fast:
+
+package_folder/
+    inference_package.json: everything needed to build the network and run inference (architecture, resolved
+                            configuration, the parts of plans and dataset.json needed for inference, mirroring axes)
+                            and the location of each tensor in weights.bin
+    weights.bin: raw fp16 or fp32 weights of all folds, 64 byte aligned so that they can be memory mapped
+
+Compared to initialize_from_trained_model_folder, loading a package does not unpickle training checkpoints (optimizer
+state, grad scaler, logging, ...) and does not import all trainer classes to find the one that was used. Weights are
+memory mapped, so nothing is read from disk until it is used.
+"""
+import json
+from copy import deepcopy
+from typing import Union, Tuple
+
+import numpy as np
+import torch
+from batchgenerators.utilities.file_and_folder_operations import load_json, join, maybe_mkdir_p, save_json, isfile
+
+from nnunetv2.utilities.get_network_from_plans import get_network_from_plans
+from nnunetv2.utilities.label_handling.label_handling import determine_num_input_channels
+from nnunetv2.utilities.plans_handling.plans_handler import PlansManager
+
+INFERENCE_PACKAGE_FORMAT_VERSION = 1
+_ALIGNMENT = 64
+_DTYPES = {'float16': (torch.float16, np.float16), 'float32': (torch.float32, np.float32)}
+# dataset.json keys that are not needed for inference and can be large
+_DATASET_JSON_KEYS_NOT_NEEDED = ('training', 'test')
+
+
+def export_inference_package(model_training_output_dir: str, output_folder: str,
+                             use_folds: Union[Tuple[Union[int, str], ...], None] = None,
+                             checkpoint_name: str = 'checkpoint_final.pth',
+                             weights_dtype: str = 'float32') -> None:
+    # importing these here because they pull in the entire trainer tree, which is exactly what we want to avoid when
+    # loading the package
+    from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+    from nnunetv2.training.nnUNetTrainer.nnUNetTrainer import nnUNetTrainer
+    from nnunetv2.utilities.find_class_by_name import recursive_find_python_class
+    import nnunetv2
+
+    assert weights_dtype in _DTYPES.keys(), f'weights_dtype must be one of {list(_DTYPES.keys())}, got {weights_dtype}'
+    if use_folds is None:
+        use_folds = nnUNetPredictor.auto_detect_available_folds(model_training_output_dir, checkpoint_name)
+    use_folds = [int(f) if f != 'all' else f for f in use_folds]
+
+    dataset_json = load_json(join(model_training_output_dir, 'dataset.json'))
+    plans = load_json(join(model_training_output_dir, 'plans.json'))
+    plans_manager = PlansManager(plans)
+
+    maybe_mkdir_p(output_folder)
+    torch_dtype = _DTYPES[weights_dtype][0]
+    tensors = {}
+    offset = 0
+    with open(join(output_folder, 'weights.bin'), 'wb') as f:
+        for i, fold in enumerate(use_folds):
+            checkpoint = torch.load(join(model_training_output_dir, f'fold_{fold}', checkpoint_name),
+                                    map_location=torch.device('cpu'))
+            if i == 0:
+                trainer_name = checkpoint['trainer_name']
+                configuration_name = checkpoint['init_args']['configuration']
+                mirror_axes = checkpoint.get('inference_allowed_mirroring_axes')
+            tensors[str(fold)] = {}
+            for k, v in checkpoint['network_weights'].items():
+                # only floating point tensors are converted (there may be integer buffers)
+                arr = (v.to(torch_dtype) if torch.is_floating_point(v) else v).contiguous().numpy()
+                padding = (-offset) % _ALIGNMENT
+                f.write(b'\0' * padding)
+                offset += padding
+                tensors[str(fold)][k] = {'offset': offset, 'shape': list(arr.shape), 'dtype': str(arr.dtype)}
+                f.write(arr.tobytes())
+                offset += arr.nbytes
+            del checkpoint
+
+    trainer_class = recursive_find_python_class(join(nnunetv2.__path__[0], "training", "nnUNetTrainer"),
+                                                trainer_name, 'nnunetv2.training.nnUNetTrainer')
+    custom_network_builder = trainer_class is None or \
+        trainer_class.build_network_architecture is not nnUNetTrainer.build_network_architecture
+    if custom_network_builder:
+        print(f'WARNING: {trainer_name} does not use the default build_network_architecture. Loading this package '
+              f'needs to import {trainer_name} (which is slow)')
+
+    # only keep the configuration we need (with inheritance resolved)
+    configuration_manager = plans_manager.get_configuration(configuration_name)
+    configuration = deepcopy(configuration_manager.configuration)
+    configuration.pop('inherits_from', None)
+    plans_subset = {k: v for k, v in plans.items() if k != 'configurations'}
+    plans_subset['configurations'] = {configuration_name: configuration}
+
+    metadata = {
+        'format_version': INFERENCE_PACKAGE_FORMAT_VERSION,
+        'trainer_name': trainer_name,
+        'custom_network_builder': custom_network_builder,
+        'configuration_name': configuration_name,
+        'network_arch_class_name': configuration_manager.network_arch_class_name,
+        'network_arch_init_kwargs': configuration_manager.network_arch_init_kwargs,
+        'network_arch_init_kwargs_req_import': list(configuration_manager.network_arch_init_kwargs_req_import),
+        'num_input_channels': determine_num_input_channels(plans_manager, configuration_manager, dataset_json),
+        'num_segmentation_heads': plans_manager.get_label_manager(dataset_json).num_segmentation_heads,
+        'inference_allowed_mirroring_axes': list(mirror_axes) if mirror_axes is not None else None,
+        'folds': [str(i) for i in use_folds],
+        'weights_dtype': weights_dtype,
+        'plans': plans_subset,
+        'dataset_json': {k: v for k, v in dataset_json.items() if k not in _DATASET_JSON_KEYS_NOT_NEEDED},
+        'tensors': tensors
+    }
+    save_json(metadata, join(output_folder, 'inference_package.json'), sort_keys=False)
+
+
+def is_inference_package(folder: str) -> bool:
+    return isfile(join(folder, 'inference_package.json'))
+
+
+def load_inference_package(package_folder: str, use_folds: Union[Tuple[Union[int, str], ...], None] = None) -> dict:
+    """
+    Returns a dict with keys network, parameters (one state dict per fold, memory mapped, read lazily), plans,
+    dataset_json, configuration_name, trainer_name and inference_allowed_mirroring_axes
+    """
+    metadata_file = join(package_folder, 'inference_package.json')
+    if not is_inference_package(package_folder):
+        raise RuntimeError(f'{package_folder} is not an inference package (inference_package.json is missing)')
+    with open(metadata_file, 'r') as f:
+        metadata = json.load(f)
+    if metadata['format_version'] > INFERENCE_PACKAGE_FORMAT_VERSION:
+        raise RuntimeError(f'Inference package format version {metadata["format_version"]} is newer than what this '
+                           f'version of nnU-Net supports ({INFERENCE_PACKAGE_FORMAT_VERSION}). Please update nnU-Net')
+
+    if use_folds is None:
+        use_folds = metadata['folds']
+    use_folds = [str(i) for i in use_folds]
+    missing = [i for i in use_folds if i not in metadata['tensors'].keys()]
+    if len(missing) > 0:
+        raise RuntimeError(f'Folds {missing} are not in this inference package. Available: {metadata["folds"]}')
+
+    # copy on write: torch wants writeable arrays, but we never write to them so nothing is ever copied
+    weights = np.memmap(join(package_folder, 'weights.bin'), dtype=np.uint8, mode='c')
+    parameters = []
+    for fold in use_folds:
+        state_dict = {}
+        for k, t in metadata['tensors'][fold].items():
+            dtype = np.dtype(t['dtype'])
+            num_bytes = int(np.prod(t['shape'], dtype=np.int64)) * dtype.itemsize
+            arr = weights[t['offset']:t['offset'] + num_bytes].view(dtype).reshape(t['shape'])
+            state_dict[k] = torch.from_numpy(arr)
+        parameters.append(state_dict)
+
+    if metadata['custom_network_builder']:
+        from nnunetv2.utilities.find_class_by_name import recursive_find_python_class
+        import nnunetv2
+        trainer_class = recursive_find_python_class(join(nnunetv2.__path__[0], "training", "nnUNetTrainer"),
+                                                    metadata['trainer_name'], 'nnunetv2.training.nnUNetTrainer')
+        if trainer_class is None:
+            raise RuntimeError(f'Unable to locate trainer class {metadata["trainer_name"]} in '
+                               f'nnunetv2.training.nnUNetTrainer. Please place it there (in any .py file)!')
+        network = trainer_class.build_network_architecture(
+            metadata['network_arch_class_name'],
+            metadata['network_arch_init_kwargs'],
+            metadata['network_arch_init_kwargs_req_import'],
+            metadata['num_input_channels'],
+            metadata['num_segmentation_heads'],
+            enable_deep_supervision=False
+        )
+    else:
+        # this is what nnUNetTrainer.build_network_architecture does
+        network = get_network_from_plans(
+            metadata['network_arch_class_name'],
+            metadata['network_arch_init_kwargs'],
+            metadata['network_arch_init_kwargs_req_import'],
+            metadata['num_input_channels'],
+            metadata['num_segmentation_heads'],
+            allow_init=False,
+            deep_supervision=False
+        )
+
+    mirror_axes = metadata['inference_allowed_mirroring_axes']
+    return {
+        'network': network,
+        'parameters': parameters,
+        'plans': metadata['plans'],
+        'dataset_json': metadata['dataset_json'],
+        'configuration_name': metadata['configuration_name'],
+        'trainer_name': metadata['trainer_name'],
+        'inference_allowed_mirroring_axes': tuple(mirror_axes) if mirror_axes is not None else None
+    }
+
+
+def export_inference_package_entry_point():
+    import argparse
+    parser = argparse.ArgumentParser(description='Exports a trained model folder (the one with the fold_X '
+                                                 'subfolders) as an inference package that loads much faster. Use '
+                                                 'the package with nnUNetv2_predict_from_modelfolder -m PACKAGE or '
+                                                 'nnUNetPredictor.initialize_from_inference_package')
+    parser.add_argument('-m', type=str, required=True,
+                        help='trained model folder (contains fold_X subfolders, plans.json, dataset.json)')
+    parser.add_argument('-o', type=str, required=True, help='output folder for the package')
+    parser.add_argument('-f', nargs='+', type=str, required=False, default=None,
+                        help='folds to include. Default: all folds that have the checkpoint')
+    parser.add_argument('-chk', type=str, required=False, default='checkpoint_final.pth',
+                        help='checkpoint name. Default: checkpoint_final.pth')
+    parser.add_argument('-dtype', type=str, required=False, default='float32', choices=list(_DTYPES.keys()),
+                        help='dtype of the stored weights. float16 halves the package size. The network still runs '
+                             'with whatever precision it would run with otherwise. Default: float32')
+    args = parser.parse_args()
+    export_inference_package(args.m, args.o, args.f, args.chk, args.dtype)
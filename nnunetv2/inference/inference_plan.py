@@ -0,0 +1,209 @@
+"""
+Memory budget aware planning of the prediction of a single case (see nnUNetPredictor, ram_budget_gb and
+vram_budget_gb).
+
+Without a budget, nnU-Net tries to keep everything on the device and falls back to the CPU if that raises an error,
+and the export is not considered at all. With a budget, plan_inference picks, before anything is allocated, the
+settings that fit:
+
+- accumulator location: 'device' (cuda only), 'cpu' (in RAM) or 'memmap' (memory mapped file, see
+  allocate_disk_backed_tensor)
+- accumulator dtype: the configured one, float16 if float32 does not fit
+- tile batch size (forward batch size, tiles x mirrored views)
+- streaming export (resampling and argmax in slabs along axis 0) and its slab size
+- the number of exports that may run at the same time as the prediction
+
+Options are tried from fastest/most accurate to most frugal: the accumulator options in the order above, for each of
+them the largest tile batch size that fits (device budget on cuda, RAM budget on the CPU) and then the largest number
+of export workers and slab size that fit the RAM budget. If nothing fits the most frugal plan is returned with
+fits=False.
+
+The estimates are deliberately simple (sizes of the big arrays plus the per tile footprint also used by
+determine_tile_batch_size) and somewhat conservative. Exports that are still running while a case is predicted are
+assumed to be as large as the case itself.
+"""
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+
+ACCUMULATOR_LOCATIONS = ('device', 'cpu', 'memmap')
+
+
+class InferencePlan(object):
+    def __init__(self, tile_batch_size: int, accumulator_dtype: torch.dtype, accumulator_location: str,
+                 export_slab_size: Optional[int], num_export_workers: int, predicted_peak_device_bytes: int,
+                 predicted_peak_ram_bytes: int, device_budget_bytes: Optional[int], ram_budget_bytes: Optional[int]):
+        """
+        export_slab_size None means that the export resamples everything at once (not streamed).
+        predicted_peak_device_bytes is 0 for device cpu, everything is counted in predicted_peak_ram_bytes then
+        """
+        assert accumulator_location in ACCUMULATOR_LOCATIONS
+        self.tile_batch_size = tile_batch_size
+        self.accumulator_dtype = accumulator_dtype
+        self.accumulator_location = accumulator_location
+        self.export_slab_size = export_slab_size
+        self.num_export_workers = num_export_workers
+        self.predicted_peak_device_bytes = predicted_peak_device_bytes
+        self.predicted_peak_ram_bytes = predicted_peak_ram_bytes
+        self.device_budget_bytes = device_budget_bytes
+        self.ram_budget_bytes = ram_budget_bytes
+
+    @property
+    def stream_export(self) -> bool:
+        return self.export_slab_size is not None
+
+    @property
+    def fits(self) -> bool:
+        return (self.device_budget_bytes is None or self.predicted_peak_device_bytes <= self.device_budget_bytes) and \
+            (self.ram_budget_bytes is None or self.predicted_peak_ram_bytes <= self.ram_budget_bytes)
+
+    def check_bounds(self):
+        """
+        raises a RuntimeError if the predicted peak exceeds a budget. Cheap, call this before allocating anything
+        """
+        if not self.fits:
+            raise RuntimeError(f'This case does not fit into the memory budget, not even with the most frugal '
+                               f'settings: {self}. Increase the budget (or predict it on a larger machine)')
+
+    def as_dict(self) -> dict:
+        return {
+            'tile_batch_size': self.tile_batch_size,
+            'accumulator_dtype': str(self.accumulator_dtype),
+            'accumulator_location': self.accumulator_location,
+            'stream_export': self.stream_export,
+            'export_slab_size': self.export_slab_size,
+            'num_export_workers': self.num_export_workers,
+            'predicted_peak_device_bytes': self.predicted_peak_device_bytes,
+            'predicted_peak_ram_bytes': self.predicted_peak_ram_bytes,
+            'device_budget_bytes': self.device_budget_bytes,
+            'ram_budget_bytes': self.ram_budget_bytes,
+        }
+
+    def __repr__(self):
+        def gb(b):
+            if b is None:
+                return 'unlimited'
+            return f'{b / 1024 ** 3:.2f} GB' if b >= 1024 ** 3 else f'{b / 1024 ** 2:.0f} MB'
+        device = f'device peak {gb(self.predicted_peak_device_bytes)} of {gb(self.device_budget_bytes)}, ' \
+            if self.predicted_peak_device_bytes > 0 else ''
+        return f'InferencePlan(tile_batch_size={self.tile_batch_size}, ' \
+               f'accumulator={self.accumulator_location}/{str(self.accumulator_dtype).split(".")[-1]}, ' \
+               f'stream_export={self.stream_export} (slab_size={self.export_slab_size}), ' \
+               f'num_export_workers={self.num_export_workers}; predicted: {device}' \
+               f'RAM peak {gb(self.predicted_peak_ram_bytes)} of {gb(self.ram_budget_bytes)})'
+
+
+def _dtype_size(dtype: torch.dtype) -> int:
+    return torch.tensor([], dtype=dtype).element_size()
+
+
+def estimate_export_bytes(num_heads: int, logits_shape: Tuple[int, ...], resampled_shape: Tuple[int, ...],
+                          output_shape: Tuple[int, ...], logits_dtype: torch.dtype, slab_size: Optional[int],
+                          save_probabilities: bool) -> int:
+    """
+    peak RAM of one export (export_prediction_from_logits), including the logits it holds. logits_shape is the
+    spatial shape of the prediction, resampled_shape the shape after resampling (shape after cropping),
+    output_shape the shape before cropping
+    """
+    n_logits = int(np.prod(logits_shape, dtype=np.int64))
+    n_resampled = int(np.prod(resampled_shape, dtype=np.int64))
+    n_output = int(np.prod(output_shape, dtype=np.int64))
+    total = num_heads * n_logits * _dtype_size(logits_dtype) + n_output  # logits + uint8 segmentation
+    if slab_size is not None:
+        rows_out = min(slab_size, resampled_shape[0])
+        rows_in = min(logits_shape[0], int(np.ceil(rows_out * logits_shape[0] / resampled_shape[0])) + 2)
+        # input rows resampled in-plane, interpolated along axis 0 and the argmax, all float32
+        total += 4 * num_heads * (rows_in * n_resampled // resampled_shape[0] * 2 +
+                                  rows_out * n_resampled // resampled_shape[0])
+    else:
+        # float copy of the logits, resampled logits and probabilities
+        total += 4 * num_heads * (n_logits + 2 * n_resampled) + 8 * n_resampled
+        if save_probabilities:
+            # probabilities with reverted cropping
+            total += 4 * num_heads * n_output
+    return total
+
+
+def plan_inference(image_shape: Tuple[int, ...], patch_size: Union[List[int], Tuple[int, ...]], num_heads: int,
+                   resampled_shape: Tuple[int, ...], output_shape: Tuple[int, ...], device: torch.device,
+                   ram_budget_bytes: Optional[int], device_budget_bytes: Optional[int],
+                   accumulator_dtype: torch.dtype = torch.float16, max_tile_batch_size: int = 16,
+                   num_export_workers: int = 1, can_stream_export: bool = True, save_probabilities: bool = False,
+                   network_bytes: int = 0, features_first_stage: int = 32, use_normalization_map: bool = True,
+                   sequential_folds: bool = False, allow_device_accumulator: bool = True,
+                   allow_ram_accumulator: bool = True, refinement: bool = False) -> InferencePlan:
+    """
+    image_shape: preprocessed image (c, x, y(, z)). network_bytes: parameters of all networks resident on the device.
+    sequential_folds: folds are predicted one after the other and summed up on the CPU (the default without
+    ensemble_folds_per_tile), which needs a second copy of the logits in RAM. allow_ram_accumulator=False skips
+    'cpu' (if the predictor was told to always memory map, see accumulator_folder). refinement: adaptive sliding
+    window (refinement_margin), the draft is looked at slab by slab between the two phases
+    """
+    num_input_channels = image_shape[0]
+    spatial = [max(i, j) for i, j in zip(image_shape[1:][-len(patch_size):], patch_size)]
+    spatial = list(image_shape[1:len(image_shape) - len(patch_size)]) + spatial
+    n_vox = int(np.prod(spatial, dtype=np.int64))
+    data_bytes = 4 * num_input_channels * n_vox
+    # same footprint as in determine_tile_batch_size
+    bytes_per_sample = 4 * int(np.prod(patch_size, dtype=np.int64)) * \
+        (num_input_channels + num_heads + 4 * features_first_stage)
+    on_cuda = device.type == 'cuda'
+    # the float32 normalization map replaces n_predictions if all tiles of the regular sliding window are predicted.
+    # 2d configurations on 3d images only need one slice of it
+    slice_wise = len(patch_size) < len(spatial)
+    map_bytes = 4 * (n_vox // spatial[0] if slice_wise else n_vox) if use_normalization_map else 0
+    refinement_bytes = 0
+    if refinement:
+        # draft and probabilities (float32), segmentation (int64), margin and flags of one slab of
+        # _internal_select_refinement_slicers
+        rows = min(spatial[0], (1 if slice_wise else patch_size[0]) + 2)
+        refinement_bytes = rows * n_vox // spatial[0] * (8 * num_heads + 16)
+
+    dtypes = [accumulator_dtype] + ([torch.float16] if accumulator_dtype != torch.float16 else [])
+    locations = [i for i in ACCUMULATOR_LOCATIONS if (i != 'device' or (on_cuda and allow_device_accumulator)) and
+                 (i != 'cpu' or allow_ram_accumulator)]
+    tile_batch_sizes = []
+    b = max(1, max_tile_batch_size)
+    while b >= 1:
+        tile_batch_sizes.append(b)
+        b //= 2
+    slab_sizes = [32, 16, 8] if can_stream_export and not save_probabilities else [None]
+
+    plan = None
+    for location in locations:
+        for dtype in dtypes:
+            if location == 'memmap':
+                # logits and n_predictions are on disk, the map is only used by the 2d fast path (one slice)
+                accumulator_bytes = map_bytes if slice_wise else 0
+            else:
+                accumulator_bytes = num_heads * n_vox * _dtype_size(dtype) + \
+                                    (map_bytes if use_normalization_map else n_vox * _dtype_size(dtype))
+            logits_bytes = num_heads * int(np.prod(image_shape[1:], dtype=np.int64)) * _dtype_size(dtype)
+            for tile_batch_size in tile_batch_sizes:
+                forward_bytes = network_bytes + tile_batch_size * bytes_per_sample
+                # the accumulator and the refinement temporaries live on the results device
+                results_bytes = accumulator_bytes + refinement_bytes
+                if on_cuda:
+                    device_peak = forward_bytes + (data_bytes + results_bytes if location == 'device' else 0)
+                    ram_peak = data_bytes + (results_bytes if location != 'device' else 0)
+                else:
+                    device_peak = 0
+                    ram_peak = data_bytes + forward_bytes + results_bytes
+                # the result is copied to the CPU (unless it is there already), folds are summed up there
+                ram_peak += logits_bytes * ((location == 'device') + sequential_folds)
+                if device_budget_bytes is not None and device_peak > device_budget_bytes and tile_batch_size > 1:
+                    continue
+                for workers in range(max(1, num_export_workers), 0, -1):
+                    for slab_size in slab_sizes:
+                        export_bytes = estimate_export_bytes(num_heads, image_shape[1:], resampled_shape, output_shape,
+                                                             dtype, slab_size, save_probabilities)
+                        plan = InferencePlan(tile_batch_size, dtype, location, slab_size, workers, device_peak,
+                                             ram_peak + workers * export_bytes, device_budget_bytes,
+                                             ram_budget_bytes)
+                        if plan.fits:
+                            return plan
+                # a smaller tile batch does not help with RAM on cuda
+                if on_cuda:
+                    break
+    return plan
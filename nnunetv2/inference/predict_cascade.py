@@ -0,0 +1,210 @@
+"""
+In-process cascade (3d_lowres -> 3d_cascade_fullres).
+
+The regular way of running the cascade is two separate predictions: the lowres one writes its segmentations to disk
+and the fullres one reads them back (folder_with_segs_from_prev_stage), crops and resamples them together with the
+image and stacks them as one-hot channels. nnUNetCascadePredictor chains both stages in memory instead:
+
+- every image is read only once and preprocessed for both stages
+- the lowres logits are resampled straight to the preprocessed geometry of the fullres stage (both stages crop the same
+  bounding box, see resample_logits_to_next_stage_segmentation) and stacked onto the fullres data
+- the lowres segmentation is only exported if you ask for it
+
+The lowres segmentation the fullres stage sees is computed by resampling logits instead of resampling the exported
+segmentation with resampling_fn_seg, so results can differ from the file based cascade in a few boundary voxels.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from typing import Union, List, Tuple, Optional
+
+import numpy as np
+import torch
+from batchgenerators.utilities.file_and_folder_operations import maybe_mkdir_p, join, save_json
+
+from nnunetv2.configuration import default_num_processes
+from nnunetv2.inference.data_iterators import get_nonzero_mask_from_seg
+from nnunetv2.inference.export_executor import BoundedExportExecutor
+from nnunetv2.inference.export_prediction import export_prediction_from_logits, \
+    convert_predicted_logits_to_segmentation_with_correct_shape, resample_logits_to_next_stage_segmentation
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.inference.sliding_window_prediction import compute_gaussian
+from nnunetv2.utilities.helpers import empty_cache
+from nnunetv2.utilities.label_handling.label_handling import convert_labelmap_to_one_hot
+from nnunetv2.utilities.tracing import log
+
+
+class nnUNetCascadePredictor(object):
+    def __init__(self, previous_stage_predictor: nnUNetPredictor, predictor: nnUNetPredictor):
+        """
+        Both predictors must be initialized. predictor is the cascaded configuration (3d_cascade_fullres),
+        previous_stage_predictor the one it depends on (3d_lowres). Each stage uses the settings (tile step size,
+        mirroring, device, ...) of its own predictor. Memory budgets (ram_budget_gb, vram_budget_gb) are not supported,
+        the planner does not know that both stages and the lowres logits are in memory at the same time
+        """
+        assert predictor.configuration_manager.previous_stage_name is not None, \
+            'predictor must be a cascaded configuration (its configuration needs a previous_stage)'
+        assert previous_stage_predictor.plans_manager.plans_name == predictor.plans_manager.plans_name, \
+            f'Both stages must come from the same plans. Got {previous_stage_predictor.plans_manager.plans_name} ' \
+            f'and {predictor.plans_manager.plans_name}'
+        assert previous_stage_predictor.label_manager.foreground_labels == predictor.label_manager.foreground_labels, \
+            'Both stages must have the same labels'
+        assert len(previous_stage_predictor.configuration_manager.spacing) == \
+               len(predictor.configuration_manager.spacing), 'Both stages must be 3d (or both 2d)'
+        assert all([i.ram_budget_gb is None and i.vram_budget_gb is None
+                    for i in (previous_stage_predictor, predictor)]), \
+            'Memory budgets (ram_budget_gb, vram_budget_gb) are not supported by the in-process cascade'
+        self.previous_stage_predictor = previous_stage_predictor
+        self.predictor = predictor
+
+    def _internal_preprocess(self, image: np.ndarray, image_properties: dict) -> dict:
+        """
+        preprocesses image for both stages. Does not depend on any prediction, so this can run ahead in the background
+        """
+        ret = {}
+        for stage, p in (('previous_stage', self.previous_stage_predictor), ('stage', self.predictor)):
+            properties = deepcopy(image_properties)
+            preprocessor = p.configuration_manager.preprocessor_class(verbose=p.verbose_preprocessing)
+            data, seg = preprocessor.run_case_npy(image, None, properties, p.plans_manager, p.configuration_manager,
+                                                  p.dataset_json)
+            ret[stage] = {'data': data, 'data_properties': properties,
+                          'nonzero_mask': get_nonzero_mask_from_seg(seg) if p.tile_skip_threshold is not None
+                          else None}
+        return ret
+
+    def _internal_read_and_preprocess(self, image_files: List[str]) -> dict:
+        rw = self.predictor.plans_manager.image_reader_writer_class()
+        image, image_properties = rw.read_images(image_files)
+        return self._internal_preprocess(image, image_properties)
+
+    def _internal_get_spacing(self, predictor: nnUNetPredictor, properties: dict) -> List[float]:
+        spacing = predictor.configuration_manager.spacing
+        if len(spacing) == len(properties['shape_after_cropping_and_before_resampling']):
+            return spacing
+        spacing_transposed = [properties['spacing'][i] for i in predictor.plans_manager.transpose_forward]
+        return [spacing_transposed[0], *spacing]
+
+    def predict_logits_from_preprocessed_data(self, preprocessed: dict) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        preprocessed is what _internal_preprocess returns. Returns the logits of the previous stage and of this
+        stage, each in the preprocessed geometry of its stage
+        """
+        prev = preprocessed['previous_stage']
+        previous_stage_logits = self.previous_stage_predictor.predict_logits_from_preprocessed_data(
+            torch.from_numpy(prev['data']), prev['nonzero_mask']).cpu()
+
+        current = preprocessed['stage']
+        data = current['data']
+        segmentation_previous_stage = resample_logits_to_next_stage_segmentation(
+            previous_stage_logits, data.shape[1:],
+            self._internal_get_spacing(self.previous_stage_predictor, prev['data_properties']),
+            self._internal_get_spacing(self.predictor, current['data_properties']),
+            self.previous_stage_predictor.configuration_manager, self.previous_stage_predictor.label_manager)
+        seg_onehot = convert_labelmap_to_one_hot(segmentation_previous_stage,
+                                                 self.predictor.label_manager.foreground_labels, data.dtype)
+        data = torch.from_numpy(np.vstack((data, seg_onehot)))
+        del segmentation_previous_stage, seg_onehot
+
+        logits = self.predictor.predict_logits_from_preprocessed_data(data, current['nonzero_mask']).cpu()
+        return previous_stage_logits, logits
+
+    def predict_single_npy_array(self, input_image: np.ndarray, image_properties: dict,
+                                 output_file_truncated: str = None,
+                                 save_or_return_probabilities: bool = False,
+                                 output_file_truncated_previous_stage: str = None):
+        """
+        Same as nnUNetPredictor.predict_single_npy_array, but runs both stages. If output_file_truncated_previous_stage
+        is given, the segmentation of the previous stage is exported there as well
+        """
+        preprocessed = self._internal_preprocess(input_image, image_properties)
+        previous_stage_logits, logits = self.predict_logits_from_preprocessed_data(preprocessed)
+        p = self.predictor
+        properties = preprocessed['stage']['data_properties']
+        if output_file_truncated_previous_stage is not None:
+            pp = self.previous_stage_predictor
+            export_prediction_from_logits(previous_stage_logits, preprocessed['previous_stage']['data_properties'],
+                                          pp.configuration_manager, pp.plans_manager, pp.dataset_json,
+                                          output_file_truncated_previous_stage, False)
+        del previous_stage_logits
+
+        if output_file_truncated is not None:
+            export_prediction_from_logits(logits, properties, p.configuration_manager, p.plans_manager,
+                                          p.dataset_json, output_file_truncated, save_or_return_probabilities)
+        else:
+            ret = convert_predicted_logits_to_segmentation_with_correct_shape(logits, p.plans_manager,
+                                                                              p.configuration_manager,
+                                                                              p.label_manager, properties,
+                                                                              return_probabilities=
+                                                                              save_or_return_probabilities)
+            if save_or_return_probabilities:
+                return ret[0], ret[1]
+            else:
+                return ret
+
+    def predict_from_files(self,
+                           list_of_lists_or_source_folder: Union[str, List[List[str]]],
+                           output_folder_or_list_of_truncated_output_files: Union[str, List[str]],
+                           save_probabilities: bool = False,
+                           overwrite: bool = True,
+                           num_processes_segmentation_export: int = default_num_processes,
+                           num_parts: int = 1,
+                           part_id: int = 0,
+                           output_folder_previous_stage: Optional[str] = None,
+                           size_aware_scheduling: bool = False,
+                           num_processes_preprocessing: int = 1):
+        """
+        Runs both stages for all cases. Reading and preprocessing of the next num_processes_preprocessing cases happen
+        in as many background threads while the current one is being predicted, resampling and export happen in the
+        background as well (see nnUNetPredictor.predict_from_data_iterator). Every case that is read ahead holds the
+        preprocessed data of both stages, so keep num_processes_preprocessing small.
+
+        output_folder_previous_stage: if not None, the segmentations of the previous stage are exported there. They
+        are not needed to run the cascade
+
+        size_aware_scheduling: see nnUNetPredictor.predict_from_files. Costs are estimated for the final stage
+        """
+        p = self.predictor
+        list_of_lists, output_filename_truncated, _ = p._manage_input_and_output_lists(
+            list_of_lists_or_source_folder, output_folder_or_list_of_truncated_output_files, None, overwrite,
+            part_id, num_parts, save_probabilities, size_aware_scheduling)
+        if len(list_of_lists) == 0:
+            return
+
+        output_folder = os.path.dirname(output_filename_truncated[0])
+        maybe_mkdir_p(output_folder)
+        save_json(p.dataset_json, join(output_folder, 'dataset.json'), sort_keys=False)
+        save_json(p.plans_manager.plans, join(output_folder, 'plans.json'), sort_keys=False)
+        if output_folder_previous_stage is not None:
+            maybe_mkdir_p(output_folder_previous_stage)
+
+        pp = self.previous_stage_predictor
+        num_ahead = max(1, num_processes_preprocessing)
+        with BoundedExportExecutor(None, num_processes_segmentation_export) as exporter, \
+                ThreadPoolExecutor(max_workers=num_ahead) as reader:
+            next_cases = [reader.submit(self._internal_read_and_preprocess, i) for i in list_of_lists[:num_ahead]]
+            for i, ofile in enumerate(output_filename_truncated):
+                preprocessed = next_cases.pop(0).result()
+                if i + num_ahead < len(list_of_lists):
+                    next_cases.append(reader.submit(self._internal_read_and_preprocess, list_of_lists[i + num_ahead]))
+                print(f'\nPredicting {os.path.basename(ofile)} (cascade):')
+                exporter.wait_until_not_busy()
+
+                previous_stage_logits, logits = self.predict_logits_from_preprocessed_data(preprocessed)
+                if output_folder_previous_stage is not None:
+                    exporter.submit(export_prediction_from_logits, previous_stage_logits,
+                                    preprocessed['previous_stage']['data_properties'], pp.configuration_manager,
+                                    pp.plans_manager, pp.dataset_json,
+                                    join(output_folder_previous_stage, os.path.basename(ofile)), False)
+                del previous_stage_logits
+                log('sending off prediction to background worker for resampling and export', level='debug')
+                exporter.submit(export_prediction_from_logits, logits, preprocessed['stage']['data_properties'],
+                                p.configuration_manager, p.plans_manager, p.dataset_json, ofile, save_probabilities)
+                del preprocessed, logits
+                log(f'done with {os.path.basename(ofile)}')
+            exporter.results()
+
+        compute_gaussian.cache_clear()
+        p.normalization_map_cache.clear()
+        pp.normalization_map_cache.clear()
+        empty_cache(p.device)
+        empty_cache(pp.device)
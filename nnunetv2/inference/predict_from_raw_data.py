@@ -1,10 +1,11 @@
 import inspect
 import itertools
-from lambda_multiprocessing import Pool
 import os
+import tempfile
+from concurrent.futures import Executor
 from copy import deepcopy
 from time import sleep
-from typing import Tuple, Union, List, Optional
+from typing import Tuple, Union, List, Optional, Callable
 
 import numpy as np
 import torch
@@ -13,27 +14,52 @@ from batchgenerators.dataloading.multi_threaded_augmenter import MultiThreadedAu
 from batchgenerators.utilities.file_and_folder_operations import load_json, join, isfile, maybe_mkdir_p, isdir, subdirs, \
     save_json
 from torch import nn
-from torch._dynamo import OptimizedModule
 from torch.nn.parallel import DistributedDataParallel
 from tqdm import tqdm
 
 import nnunetv2
 from nnunetv2.configuration import default_num_processes
+from nnunetv2.inference.case_scheduling import estimate_prediction_cost, split_into_balanced_parts
+from nnunetv2.inference.cpu_engine import CPU_ENGINE_BACKENDS, CPU_ENGINE_QUANTIZATION, build_cpu_engine_network, \
+    sample_calibration_tiles
 from nnunetv2.inference.data_iterators import PreprocessAdapterFromNpy, preprocessing_iterator_fromfiles, \
     preprocessing_iterator_fromnpy
+from nnunetv2.inference.export_executor import BoundedExportExecutor
 from nnunetv2.inference.export_prediction import export_prediction_from_logits, \
-    convert_predicted_logits_to_segmentation_with_correct_shape
+    convert_predicted_logits_to_segmentation_with_correct_shape, get_axis0_interpolation_order, get_export_spacings
+from nnunetv2.inference.inference_package import load_inference_package, is_inference_package
+from nnunetv2.inference.inference_plan import InferencePlan, plan_inference
+from nnunetv2.inference.prediction_manifest import PredictionManifest, compute_model_fingerprint
+from nnunetv2.inference.roi_prediction import roi_to_preprocessed_bbox, get_properties_for_preprocessed_bbox
+from nnunetv2.inference.sliding_window_checkpoint import SlidingWindowCheckpoint, SlidingWindowInterrupted
 from nnunetv2.inference.sliding_window_prediction import compute_gaussian, \
-    compute_steps_for_sliding_window
-from nnunetv2.utilities.file_path_utilities import get_output_folder, check_workers_alive_and_busy
+    compute_steps_for_sliding_window, determine_tile_batch_size, \
+    compute_inner_tile_borders, allocate_disk_backed_tensor, compute_reciprocal_normalization_map, \
+    compute_reciprocal_normalization_map_2d, get_slice_batch_runs, NormalizationMapCache, get_available_memory
+from nnunetv2.utilities.file_path_utilities import get_output_folder
 from nnunetv2.utilities.find_class_by_name import recursive_find_python_class
-from nnunetv2.utilities.helpers import empty_cache, dummy_context
+from nnunetv2.utilities.helpers import empty_cache, dummy_context, is_compiled_module
 from nnunetv2.utilities.json_export import recursive_fix_for_json_export
 from nnunetv2.utilities.label_handling.label_handling import determine_num_input_channels
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
+from nnunetv2.utilities.tracing import trace_span, trace_case, trace_peak_rss, log, set_log_level, enable_tracing, \
+    write_chrome_trace
 from nnunetv2.utilities.utils import create_lists_from_splitted_dataset_folder
 
 
+def _export_prediction_and_notify(on_case_exported: Optional[Callable[[str], None]], predicted_array_or_file,
+                                  properties_dict: dict, configuration_manager, plans_manager, dataset_json_dict_or_file,
+                                  output_file_truncated: str, save_probabilities: bool = False, **kwargs):
+    """
+    export_prediction_from_logits followed by on_case_exported(output_file_truncated). Both run in the export worker,
+    so errors of on_case_exported are re-raised by BoundedExportExecutor like export errors
+    """
+    export_prediction_from_logits(predicted_array_or_file, properties_dict, configuration_manager, plans_manager,
+                                  dataset_json_dict_or_file, output_file_truncated, save_probabilities, **kwargs)
+    if on_case_exported is not None:
+        on_case_exported(output_file_truncated)
+
+
 class nnUNetPredictor(object):
     def __init__(self,
                  tile_step_size: float = 0.5,
@@ -43,7 +69,73 @@ class nnUNetPredictor(object):
                  device: torch.device = torch.device('cuda'),
                  verbose: bool = False,
                  verbose_preprocessing: bool = False,
-                 allow_tqdm: bool = True):
+                 allow_tqdm: bool = True,
+                 tile_batch_size: Union[int, None] = None,
+                 ensemble_folds_per_tile: bool = False,
+                 tile_skip_threshold: Union[float, None] = None,
+                 refinement_margin: Union[float, None] = None,
+                 accumulator_folder: Union[str, None] = None,
+                 accumulator_dtype: torch.dtype = torch.float16,
+                 normalization_map_cache_size: int = 1,
+                 cpu_engine: Union[str, None] = None,
+                 cpu_engine_quantization: Union[str, None] = None,
+                 ram_budget_gb: Union[float, None] = None,
+                 vram_budget_gb: Union[float, None] = None):
+        """
+        tile_batch_size: maximum batch size of a forward pass. Sliding window tiles and their mirrored views (test
+        time augmentation) are stacked along the batch dimension, so with mirroring in 3D (8 views) a
+        tile_batch_size of 16 means 2 tiles per forward pass. None means that it is determined automatically from the
+        memory that is available on the device
+
+        ensemble_folds_per_tile: if True, one network instance per fold is kept resident and all folds are run on
+        each tile before moving on to the next one. The image is then only tiled and transferred once and there is a
+        single accumulator instead of one full sliding window pass per fold. Costs the memory of the additional
+        network instances
+
+        tile_skip_threshold: if not None, sliding window tiles in which the fraction of voxels inside the nonzero mask
+        (see crop_to_nonzero) is below this value are not predicted. Voxels that are not covered by any predicted tile
+        are set to background. Use a small value such as 0.01. Only has an effect if the nonzero mask is known, which
+        is the case for all prediction functions that do the preprocessing
+
+        refinement_margin: if not None, the adaptive (coarse to fine) sliding window is used. A draft is predicted
+        with non-overlapping tiles (tile_step_size 1). Of the regular tiles (tile_step_size) only those are predicted
+        in addition that contain voxels where the draft's margin between the two most likely classes is below
+        refinement_margin or where foreground was predicted close to a seam between draft tiles. This is the
+        time/accuracy knob: 0 only fixes seams (fastest), 1 refines almost everything (about as slow as the regular
+        sliding window). Something like 0.3 is a reasonable start
+
+        accumulator_folder: if not None, the sliding window results arrays (predicted_logits, n_predictions) are memory
+        mapped files in this folder whenever they live on the CPU (device cpu or fallback after running out of VRAM).
+        Use this for volumes where num_heads x shape does not fit into RAM. Needs a fast local disk (/tmp on Lambda)
+
+        accumulator_dtype: torch.float16 (default) or torch.float32 for the results arrays. fp32 doubles their size
+        but avoids precision issues when many tiles overlap
+
+        normalization_map_cache_size: the sliding window normalization (1 / sum of gaussian weights) only depends on the
+        (padded) image shape and is cached for this many shapes so that consecutive images of the same shape can skip
+        accumulating and dividing by it. Each map has the size of the image (float32, on the results device), so keep
+        this small. 0 disables the cache. predict_from_data_iterator (predict_from_files etc) clears it when it is done,
+        call normalization_map_cache.clear() yourself if you predict with the lower level functions. Not used with
+        tile_skip_threshold (if tiles were skipped) or refinement_margin because then the tiles differ from image to
+        image, and not for 3d images whose results arrays are memory mapped (see accumulator_folder) because the map
+        would have to be in RAM
+
+        cpu_engine: None (eager PyTorch, default), 'torchscript' or 'onnxruntime'. Only for device cpu. The network of
+        each fold is exported for the patch size and run by a graph runtime, see nnunetv2/inference/cpu_engine.py. All
+        folds stay resident and are evaluated on each tile (as with ensemble_folds_per_tile)
+
+        cpu_engine_quantization: None (fp32), 'static' or 'dynamic' int8 quantization for cpu_engine. 'static' needs
+        calibration data, see calibrate_cpu_engine. 'dynamic' is only available with onnxruntime. Check the accuracy
+        with nnUNetv2_check_cpu_engine_accuracy before using this!
+
+        ram_budget_gb, vram_budget_gb: if one of them is set, every case gets an InferencePlan (see inference_plan.py)
+        that is computed from its shape before anything is allocated: tile batch size, accumulator dtype (float16 if
+        accumulator_dtype float32 does not fit) and location (device, CPU or memory mapped, the latter in
+        accumulator_folder or the temp folder), streaming export and how many exports may run at the same time. The
+        plan and its predicted peak memory are printed. Cases that don't fit even with the most frugal settings raise
+        an error before the prediction starts. vram_budget_gb defaults to the free memory of the cuda device,
+        ram_budget_gb to unlimited. The CPU fallback on errors on the device stays in place
+        """
         self.verbose = verbose
         self.verbose_preprocessing = verbose_preprocessing
         self.allow_tqdm = allow_tqdm
@@ -54,10 +146,36 @@ class nnUNetPredictor(object):
         self.tile_step_size = tile_step_size
         self.use_gaussian = use_gaussian
         self.use_mirroring = use_mirroring
+        self.tile_batch_size = tile_batch_size
+        self.ensemble_folds_per_tile = ensemble_folds_per_tile
+        self.tile_skip_threshold = tile_skip_threshold
+        self.refinement_margin = refinement_margin
+        self.accumulator_folder = accumulator_folder
+        self.accumulator_dtype = accumulator_dtype
+        self.normalization_map_cache = NormalizationMapCache(normalization_map_cache_size)
+        if cpu_engine is not None:
+            assert cpu_engine in CPU_ENGINE_BACKENDS, f'cpu_engine must be one of {CPU_ENGINE_BACKENDS}'
+            assert device.type == 'cpu', 'cpu_engine can only be used with device cpu'
+        assert cpu_engine_quantization is None or cpu_engine is not None, \
+            'cpu_engine_quantization requires a cpu_engine'
+        assert not (cpu_engine == 'torchscript' and cpu_engine_quantization == 'dynamic'), \
+            "dynamic quantization is only available with cpu_engine='onnxruntime'. Use 'static'"
+        self.cpu_engine = cpu_engine
+        self.cpu_engine_quantization = cpu_engine_quantization
+        self.ram_budget_gb = ram_budget_gb
+        self.vram_budget_gb = vram_budget_gb
+        # tiles from preprocessed images for static quantization, see calibrate_cpu_engine
+        self.cpu_engine_calibration_tiles = None
+        # resident networks, one per fold. Only used if ensemble_folds_per_tile, cpu_engine or tile_batch_scheduler.
+        # Built on demand
+        self.fold_networks = None
+        # set by TileBatchScheduler (tile_batch_scheduler.py) to share forward passes between concurrent predictions
+        self.tile_batch_scheduler = None
         if device.type == 'cuda':
             torch.backends.cudnn.benchmark = True
         else:
-            print(f'perform_everything_on_device=True is only supported for cuda devices! Setting this to False')
+            log(f'perform_everything_on_device=True is only supported for cuda devices! Setting this to False',
+                level='warning')
             perform_everything_on_device = False
         self.device = device
         self.perform_everything_on_device = perform_everything_on_device
@@ -116,8 +234,28 @@ class nnUNetPredictor(object):
         self.trainer_name = trainer_name
         self.allowed_mirroring_axes = inference_allowed_mirroring_axes
         self.label_manager = plans_manager.get_label_manager(dataset_json)
+        self.fold_networks = None
+        if ('nnUNet_compile' in os.environ.keys()) and (os.environ['nnUNet_compile'].lower() in ('true', '1', 't')) \
+                and not is_compiled_module(self.network):
+            print('Using torch.compile')
+            self.network = torch.compile(self.network)
+
+    def initialize_from_inference_package(self, package_folder: str,
+                                          use_folds: Union[Tuple[Union[int, str]], None] = None):
+        """
+        Same as initialize_from_trained_model_folder but for packages created with nnUNetv2_export_inference_package.
+        Much faster: no checkpoint unpickling, no trainer class search, weights are memory mapped
+        """
+        if isinstance(use_folds, str):
+            use_folds = [use_folds]
+        package = load_inference_package(package_folder, use_folds)
+        plans_manager = PlansManager(package['plans'])
+        self.manual_initialization(package['network'], plans_manager,
+                                   plans_manager.get_configuration(package['configuration_name']),
+                                   package['parameters'], package['dataset_json'], package['trainer_name'],
+                                   package['inference_allowed_mirroring_axes'])
         if ('nnUNet_compile' in os.environ.keys()) and (os.environ['nnUNet_compile'].lower() in ('true', '1', 't')) \
-                and not isinstance(self.network, OptimizedModule):
+                and not is_compiled_module(self.network):
             print('Using torch.compile')
             self.network = torch.compile(self.network)
 
@@ -136,12 +274,13 @@ class nnUNetPredictor(object):
         self.trainer_name = trainer_name
         self.allowed_mirroring_axes = inference_allowed_mirroring_axes
         self.label_manager = plans_manager.get_label_manager(dataset_json)
+        self.fold_networks = None
         allow_compile = True
         allow_compile = allow_compile and ('nnUNet_compile' in os.environ.keys()) and (
                     os.environ['nnUNet_compile'].lower() in ('true', '1', 't'))
-        allow_compile = allow_compile and not isinstance(self.network, OptimizedModule)
+        allow_compile = allow_compile and not is_compiled_module(self.network)
         if isinstance(self.network, DistributedDataParallel):
-            allow_compile = allow_compile and isinstance(self.network.module, OptimizedModule)
+            allow_compile = allow_compile and is_compiled_module(self.network.module)
         if allow_compile:
             print('Using torch.compile')
             self.network = torch.compile(self.network)
@@ -162,12 +301,23 @@ class nnUNetPredictor(object):
                                        overwrite: bool = True,
                                        part_id: int = 0,
                                        num_parts: int = 1,
-                                       save_probabilities: bool = False):
+                                       save_probabilities: bool = False,
+                                       size_aware_scheduling: bool = False):
         if isinstance(list_of_lists_or_source_folder, str):
             list_of_lists_or_source_folder = create_lists_from_splitted_dataset_folder(list_of_lists_or_source_folder,
                                                                                        self.dataset_json['file_ending'])
         print(f'There are {len(list_of_lists_or_source_folder)} cases in the source folder')
-        list_of_lists_or_source_folder = list_of_lists_or_source_folder[part_id::num_parts]
+        if size_aware_scheduling:
+            costs = self._internal_estimate_case_costs(list_of_lists_or_source_folder)
+            selected = split_into_balanced_parts(costs, num_parts)[part_id]
+            log(f'Size aware scheduling: this part has an estimated cost of {sum([costs[i] for i in selected])} '
+                f'tile predictions out of {sum(costs)} in total')
+        else:
+            selected = list(range(len(list_of_lists_or_source_folder)))[part_id::num_parts]
+        list_of_lists_or_source_folder = [list_of_lists_or_source_folder[i] for i in selected]
+        if isinstance(output_folder_or_list_of_truncated_output_files, list):
+            output_folder_or_list_of_truncated_output_files = \
+                [output_folder_or_list_of_truncated_output_files[i] for i in selected]
         caseids = [os.path.basename(i[0])[:-(len(self.dataset_json['file_ending']) + 5)] for i in
                    list_of_lists_or_source_folder]
         print(
@@ -196,6 +346,21 @@ class nnUNetPredictor(object):
                   f'That\'s {len(not_existing_indices)} cases.')
         return list_of_lists_or_source_folder, output_filename_truncated, seg_from_prev_stage_files
 
+    def _internal_estimate_case_costs(self, list_of_lists: List[List[str]]) -> List[int]:
+        """
+        estimated number of tile predictions per case, from the header of the first input file of each case (see
+        case_scheduling.py)
+        """
+        rw = self.plans_manager.image_reader_writer_class()
+        num_folds = len(self.list_of_parameters) if self.list_of_parameters is not None else 1
+        num_views = len(self._internal_get_mirror_axes_combinations(len(self.configuration_manager.patch_size) + 2))
+        costs = []
+        for files in list_of_lists:
+            shape, spacing = rw.read_image_shape_and_spacing(files[0])
+            costs.append(estimate_prediction_cost(shape, spacing, self.plans_manager, self.configuration_manager,
+                                                  self.tile_step_size, num_folds, num_views))
+        return costs
+
     def predict_from_files(self,
                            list_of_lists_or_source_folder: Union[str, List[List[str]]],
                            output_folder_or_list_of_truncated_output_files: Union[str, None, List[str]],
@@ -205,10 +370,31 @@ class nnUNetPredictor(object):
                            num_processes_segmentation_export: int = default_num_processes,
                            folder_with_segs_from_prev_stage: str = None,
                            num_parts: int = 1,
-                           part_id: int = 0):
+                           part_id: int = 0,
+                           preprocessing_queue_depth: int = 1,
+                           rois: Optional[dict] = None,
+                           roi_margin: Union[None, int, Tuple[int, ...]] = None,
+                           use_manifest: bool = False,
+                           size_aware_scheduling: bool = False):
         """
         This is nnU-Net's default function for making predictions. It works best for batch predictions
         (predicting many images at once).
+
+        preprocessing_queue_depth: how many preprocessed cases each preprocessing worker may hold while waiting for
+        the prediction to pick them up. Higher values smooth out fluctuations in preprocessing time at the cost of RAM
+
+        rois: optional {case identifier: roi}. Cases with a roi are only predicted in the roi (plus roi_margin), the
+        rest of their segmentation is background. See predict_logits_in_roi. The case identifier is the name of the
+        output file without file ending
+
+        use_manifest: keep track of finished cases in a manifest in the output folder (see prediction_manifest.py).
+        With overwrite=False, only cases whose inputs, model, settings and outputs still match the manifest are
+        skipped. Partially written, stale or modified outputs are predicted again. Costs one pass of hashing over
+        the input files (only when they changed since the last run)
+
+        size_aware_scheduling: estimate the cost of each case from its image header (see case_scheduling.py), predict
+        the most expensive cases first and split the cases into num_parts parts of similar total cost instead of
+        taking every num_parts-th case. All parts must use the same setting
         """
         if isinstance(output_folder_or_list_of_truncated_output_files, str):
             output_folder = output_folder_or_list_of_truncated_output_files
@@ -245,41 +431,85 @@ class nnUNetPredictor(object):
         list_of_lists_or_source_folder, output_filename_truncated, seg_from_prev_stage_files = \
             self._manage_input_and_output_lists(list_of_lists_or_source_folder,
                                                 output_folder_or_list_of_truncated_output_files,
-                                                folder_with_segs_from_prev_stage, overwrite, part_id, num_parts,
-                                                save_probabilities)
+                                                folder_with_segs_from_prev_stage, overwrite or use_manifest, part_id,
+                                                num_parts, save_probabilities, size_aware_scheduling)
+        on_case_exported = None
+        if use_manifest:
+            assert output_folder is not None, 'use_manifest needs output files'
+            list_of_lists_or_source_folder, output_filename_truncated, seg_from_prev_stage_files, on_case_exported = \
+                self._internal_filter_cases_with_manifest(list_of_lists_or_source_folder, output_filename_truncated,
+                                                          seg_from_prev_stage_files, output_folder, overwrite,
+                                                          save_probabilities, rois, roi_margin, part_id, num_parts)
         if len(list_of_lists_or_source_folder) == 0:
             return
 
         data_iterator = self._internal_get_data_iterator_from_lists_of_filenames(list_of_lists_or_source_folder,
                                                                                  seg_from_prev_stage_files,
                                                                                  output_filename_truncated,
-                                                                                 num_processes_preprocessing)
-        print("data iterator successful")
+                                                                                 num_processes_preprocessing,
+                                                                                 preprocessing_queue_depth)
+        log("data iterator successful", level='debug')
+        if rois is not None:
+            data_iterator = self._internal_attach_rois(data_iterator, rois, roi_margin)
+
+        return self.predict_from_data_iterator(data_iterator, save_probabilities, num_processes_segmentation_export,
+                                               on_case_exported=on_case_exported)
+
+    def _internal_filter_cases_with_manifest(self, list_of_lists: List[List[str]],
+                                             output_filename_truncated: List[str],
+                                             seg_from_prev_stage_files: List[Union[str, None]],
+                                             output_folder: str, overwrite: bool, save_probabilities: bool,
+                                             rois: Optional[dict], roi_margin: Union[None, int, Tuple[int, ...]],
+                                             part_id: int, num_parts: int):
+        """
+        Returns the cases that need to be predicted and a callback for predict_from_data_iterator that records
+        finished cases in the manifest
+        """
+        manifest = PredictionManifest(output_folder, compute_model_fingerprint(self), part_id, num_parts)
+        cases = {}
+        keep = []
+        for i, (files, ofile, seg_file) in enumerate(zip(list_of_lists, output_filename_truncated,
+                                                         seg_from_prev_stage_files)):
+            roi = rois.get(os.path.basename(ofile)) if rois is not None else None
+            case = {
+                'input_fingerprints': manifest.fingerprint_inputs(ofile,
+                                                                  files + ([seg_file] if seg_file is not None else [])),
+                'output_files': [ofile + self.dataset_json['file_ending']] +
+                                ([ofile + '.npz', ofile + '.pkl'] if save_probabilities else []),
+                'case_settings': {'save_probabilities': save_probabilities, 'roi': roi,
+                                  'roi_margin': roi_margin if roi is not None else None}
+            }
+            if overwrite or not manifest.is_done(ofile, **case):
+                keep.append(i)
+                cases[ofile] = case
+        if not overwrite:
+            print(f'overwrite was set to {overwrite}, so I am only working on cases that do not have a valid '
+                  f'prediction according to {manifest.manifest_file}. That\'s {len(keep)} cases.')
+
+        def on_case_exported(ofile: str):
+            manifest.mark_done(ofile, **cases[ofile])
+
+        return [list_of_lists[i] for i in keep], [output_filename_truncated[i] for i in keep], \
+            [seg_from_prev_stage_files[i] for i in keep], on_case_exported
 
-        return self.predict_from_data_iterator(data_iterator, save_probabilities, num_processes_segmentation_export)
+    @staticmethod
+    def _internal_attach_rois(data_iterator, rois: dict, roi_margin: Union[None, int, Tuple[int, ...]] = None):
+        for preprocessed in data_iterator:
+            preprocessed['roi'] = rois.get(os.path.basename(preprocessed['ofile']))
+            preprocessed['roi_margin'] = roi_margin
+            yield preprocessed
 
     def _internal_get_data_iterator_from_lists_of_filenames(self,
                                                             input_list_of_lists: List[List[str]],
                                                             seg_from_prev_stage_files: Union[List[str], None],
                                                             output_filenames_truncated: Union[List[str], None],
-                                                            num_processes: int):
+                                                            num_processes: int,
+                                                            queue_depth: int = 1):
         return preprocessing_iterator_fromfiles(input_list_of_lists, seg_from_prev_stage_files,
                                                 output_filenames_truncated, self.plans_manager, self.dataset_json,
                                                 self.configuration_manager, num_processes, self.device.type == 'cuda',
-                                                self.verbose_preprocessing)
-        # preprocessor = self.configuration_manager.preprocessor_class(verbose=self.verbose_preprocessing)
-        # # hijack batchgenerators, yo
-        # # we use the multiprocessing of the batchgenerators dataloader to handle all the background worker stuff. This
-        # # way we don't have to reinvent the wheel here.
-        # num_processes = max(1, min(num_processes, len(input_list_of_lists)))
-        # ppa = PreprocessAdapter(input_list_of_lists, seg_from_prev_stage_files, preprocessor,
-        #                         output_filenames_truncated, self.plans_manager, self.dataset_json,
-        #                         self.configuration_manager, num_processes)
-        # if num_processes == 0:
-        #     mta = SingleThreadedAugmenter(ppa, None)
-        # else:
-        #     mta = MultiThreadedAugmenter(ppa, None, num_processes, 1, None, pin_memory=pin_memory)
-        # return mta
+                                                self.verbose_preprocessing, queue_depth,
+                                                self.tile_skip_threshold is not None)
 
     def get_data_iterator_from_raw_npy_data(self,
                                             image_or_list_of_images: Union[np.ndarray, List[np.ndarray]],
@@ -315,7 +545,8 @@ class nnUNetPredictor(object):
             self.configuration_manager,
             num_processes,
             self.device.type == 'cuda',
-            self.verbose_preprocessing
+            self.verbose_preprocessing,
+            self.tile_skip_threshold is not None
         )
 
         return pp
@@ -341,15 +572,32 @@ class nnUNetPredictor(object):
     def predict_from_data_iterator(self,
                                    data_iterator,
                                    save_probabilities: bool = False,
-                                   num_processes_segmentation_export: int = default_num_processes):
+                                   num_processes_segmentation_export: int = default_num_processes,
+                                   export_executor: Optional[Executor] = None,
+                                   on_case_exported: Optional[Callable[[str], None]] = None):
         """
         each element returned by data_iterator must be a dict with 'data', 'ofile' and 'data_properties' keys!
-        If 'ofile' is None, the result will be returned instead of written to a file
+        If 'ofile' is None, the result will be returned instead of written to a file. Elements may also have a 'roi'
+        (and 'roi_margin') key, see predict_logits_in_roi
+
+        Resampling and export run in the background while the next case is being predicted. By default this uses
+        num_processes_segmentation_export threads. Pass any concurrent.futures.Executor as export_executor if you
+        want something else (it will not be shut down by us).
+
+        on_case_exported(ofile) is called by the export worker once a case has been written completely. Errors are
+        raised like export errors. Not called for cases that are returned instead of written
+
+        If a memory budget is set (ram_budget_gb, vram_budget_gb), each case is predicted and exported according to
+        its InferencePlan (see plan_inference). It also limits how many exports run while the case is predicted
         """
-        with Pool(num_processes_segmentation_export) as export_pool:
-            # worker_list = [i for i in export_pool._pool] # this is a list of the actual worker processes, but it uses pool._pool which is not a public attribute
-            r = []
-            for preprocessed in data_iterator:
+        with BoundedExportExecutor(export_executor, num_processes_segmentation_export) as exporter:
+            data_iterator = iter(data_iterator)
+            while True:
+                # time spent waiting for preprocessing is time the device is idle
+                with trace_span('wait_preprocessed'):
+                    preprocessed = next(data_iterator, None)
+                if preprocessed is None:
+                    break
                 data = preprocessed['data']
                 if isinstance(data, str):
                     delfile = data
@@ -362,62 +610,58 @@ class nnUNetPredictor(object):
                 else:
                     print(f'\nPredicting image of shape {data.shape}:')
 
-                print(f'perform_everything_on_device: {self.perform_everything_on_device}')
+                log(f'perform_everything_on_device: {self.perform_everything_on_device}', level='debug')
 
                 properties = preprocessed['data_properties']
 
+                plan = self.plan_inference(data.shape, properties, save_probabilities,
+                                           num_processes_segmentation_export)
+                if plan is not None:
+                    log(plan)
+                    plan.check_bounds()
+
                 # let's not get into a runaway situation where the GPU predicts so fast that the disk has to b swamped with
                 # npy files
-                # proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
-                # while not proceed:
-                #     sleep(0.1)
-                #     proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
-
-                prediction = self.predict_logits_from_preprocessed_data(data).cpu()
-                print(f'prediction shape: {prediction.shape}')
+                with trace_span('wait_export', case=os.path.basename(ofile) if ofile is not None else None):
+                    exporter.wait_until_not_busy(plan.num_export_workers if plan is not None else None)
+
+                with trace_case(os.path.basename(ofile) if ofile is not None else None), \
+                        trace_span('predict', shape=tuple(data.shape)):
+                    if preprocessed.get('roi') is not None:
+                        prediction, properties = self.predict_logits_in_roi(data, properties, preprocessed['roi'],
+                                                                            preprocessed.get('roi_margin'),
+                                                                            preprocessed.get('nonzero_mask'), plan)
+                        prediction = prediction.cpu()
+                    else:
+                        prediction = self.predict_logits_from_preprocessed_data(data,
+                                                                                preprocessed.get('nonzero_mask'),
+                                                                                plan).cpu()
+                    trace_peak_rss()
+                log(f'prediction shape: {prediction.shape}', level='debug')
+                slab_size = plan.export_slab_size if plan is not None else 32
 
                 if ofile is not None:
-                    print('sending off prediction to background worker for resampling and export')
-                    # this needs to go into background processes
-                    r.append(export_prediction_from_logits(prediction, properties, self.configuration_manager, self.plans_manager,
-                                                  self.dataset_json, ofile, save_probabilities))
-                    # r.append(
-                    #     export_pool.starmap_async(
-                    #         export_prediction_from_logits,
-                    #         [(prediction, properties, self.configuration_manager, self.plans_manager,
-                    #           self.dataset_json, ofile, save_probabilities),]
-                    #     )
-                    # )
+                    log('sending off prediction to background worker for resampling and export', level='debug')
+                    exporter.submit(_export_prediction_and_notify, on_case_exported,
+                                    prediction, properties, self.configuration_manager, self.plans_manager,
+                                    self.dataset_json, ofile, save_probabilities, slab_size=slab_size)
                 else:
-                    # convert_predicted_logits_to_segmentation_with_correct_shape(
-                    #             prediction, self.plans_manager,
-                    #              self.configuration_manager, self.label_manager,
-                    #              properties,
-                    #              save_probabilities)
-
-                    print('sending off prediction to background worker for resampling')
-                    r.append(
-                        export_pool.starmap_async(
-                            convert_predicted_logits_to_segmentation_with_correct_shape, (
-                                (prediction, self.plans_manager,
-                                 self.configuration_manager, self.label_manager,
-                                 properties,
-                                 save_probabilities),)
-                        )
-                    )
+                    log('sending off prediction to background worker for resampling', level='debug')
+                    exporter.submit(convert_predicted_logits_to_segmentation_with_correct_shape,
+                                    prediction, self.plans_manager,
+                                    self.configuration_manager, self.label_manager,
+                                    properties,
+                                    save_probabilities, slab_size=slab_size)
                 if ofile is not None:
                     print(f'done with {os.path.basename(ofile)}')
                 else:
                     print(f'\nDone with image of shape {data.shape}:')
-            print(len(r))
-            print(f'results: {r}')
-            ret = [i for i in r]
-
-        # if isinstance(data_iterator, MultiThreadedAugmenter):
-        #     data_iterator._finish()
+            ret = exporter.results()
 
         # clear lru cache
         compute_gaussian.cache_clear()
+        # the normalization maps are as large as the images and would otherwise stay on the device
+        self.normalization_map_cache.clear()
         # clear device cache
         empty_cache(self.device)
         return ret
@@ -425,7 +669,10 @@ class nnUNetPredictor(object):
     def predict_single_npy_array(self, input_image: np.ndarray, image_properties: dict,
                                  segmentation_previous_stage: np.ndarray = None,
                                  output_file_truncated: str = None,
-                                 save_or_return_probabilities: bool = False):
+                                 save_or_return_probabilities: bool = False,
+                                 roi: Optional[List[List[int]]] = None,
+                                 roi_margin: Union[None, int, Tuple[int, ...]] = None,
+                                 checkpoint: Optional[SlidingWindowCheckpoint] = None):
         """
         WARNING: SLOW. ONLY USE THIS IF YOU CANNOT GIVE NNUNET MULTIPLE IMAGES AT ONCE FOR SOME REASON.
 
@@ -438,73 +685,237 @@ class nnUNetPredictor(object):
                      default axis ordering for medical images is the one from SimpleITK. If you load with nibabel,
                      you need to transpose your axes AND your spacing from [x,y,z] to [z,y,x]!
         image_properties must only have a 'spacing' key!
+
+        roi: optional bounding box in input_image coordinates. Only this region (plus roi_margin) is predicted, the
+        rest of the segmentation is background. See predict_logits_in_roi
+
+        checkpoint: optional SlidingWindowCheckpoint for time boxed prediction (see
+        predict_logits_from_preprocessed_data). If the deadline is reached, SlidingWindowInterrupted is raised and a
+        later call with the same arguments resumes the prediction
         """
         ppa = PreprocessAdapterFromNpy([input_image], [segmentation_previous_stage], [image_properties],
                                        [output_file_truncated],
                                        self.plans_manager, self.dataset_json, self.configuration_manager,
-                                       num_threads_in_multithreaded=1, verbose=self.verbose)
+                                       num_threads_in_multithreaded=1, verbose=self.verbose,
+                                       return_nonzero_mask=self.tile_skip_threshold is not None)
         if self.verbose:
             print('preprocessing')
         dct = next(ppa)
+        plan = self.plan_inference(dct['data'].shape, dct['data_properties'], save_or_return_probabilities)
+        if plan is not None:
+            log(plan)
+            plan.check_bounds()
 
         if self.verbose:
             print('predicting')
-        predicted_logits = self.predict_logits_from_preprocessed_data(dct['data']).cpu()
+        if roi is not None:
+            predicted_logits, dct['data_properties'] = self.predict_logits_in_roi(dct['data'], dct['data_properties'],
+                                                                                  roi, roi_margin,
+                                                                                  dct.get('nonzero_mask'), plan,
+                                                                                  checkpoint)
+            predicted_logits = predicted_logits.cpu()
+        else:
+            predicted_logits = self.predict_logits_from_preprocessed_data(dct['data'], dct.get('nonzero_mask'),
+                                                                          plan, checkpoint).cpu()
+        slab_size = plan.export_slab_size if plan is not None else 32
 
         if self.verbose:
             print('resampling to original shape')
         if output_file_truncated is not None:
             export_prediction_from_logits(predicted_logits, dct['data_properties'], self.configuration_manager,
                                           self.plans_manager, self.dataset_json, output_file_truncated,
-                                          save_or_return_probabilities)
+                                          save_or_return_probabilities, slab_size=slab_size)
         else:
             ret = convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits, self.plans_manager,
                                                                               self.configuration_manager,
                                                                               self.label_manager,
                                                                               dct['data_properties'],
                                                                               return_probabilities=
-                                                                              save_or_return_probabilities)
+                                                                              save_or_return_probabilities,
+                                                                              slab_size=slab_size)
             if save_or_return_probabilities:
                 return ret[0], ret[1]
             else:
                 return ret
 
     @torch.inference_mode()
-    def predict_logits_from_preprocessed_data(self, data: torch.Tensor) -> torch.Tensor:
+    def predict_logits_from_preprocessed_data(self, data: torch.Tensor,
+                                              nonzero_mask: Optional[torch.Tensor] = None,
+                                              plan: Optional[InferencePlan] = None,
+                                              checkpoint: Optional[SlidingWindowCheckpoint] = None) -> torch.Tensor:
         """
         IMPORTANT! IF YOU ARE RUNNING THE CASCADE, THE SEGMENTATION FROM THE PREVIOUS STAGE MUST ALREADY BE STACKED ON
         TOP OF THE IMAGE AS ONE-HOT REPRESENTATION! SEE PreprocessAdapter ON HOW THIS SHOULD BE DONE!
 
         RETURNED LOGITS HAVE THE SHAPE OF THE INPUT. THEY MUST BE CONVERTED BACK TO THE ORIGINAL IMAGE SIZE.
         SEE convert_predicted_logits_to_segmentation_with_correct_shape
+
+        nonzero_mask (x, y(, z)) is optional and only used if tile_skip_threshold is set
+
+        plan: optional InferencePlan (see plan_inference) that overrides tile batch size and accumulator settings
+
+        checkpoint: optional SlidingWindowCheckpoint. If its deadline is reached, the progress (including the sum of
+        the folds that are already done) is saved and SlidingWindowInterrupted is raised. Calling this again with the
+        same data and a checkpoint on the same folder resumes, the result is bit-identical to an uninterrupted run.
+        See sliding_window_checkpoint.py
         """
+        assert checkpoint is None or self.tile_batch_scheduler is None, \
+            'checkpoint cannot be used with a tile_batch_scheduler (tiles of other predictions change the batches)'
         n_threads = torch.get_num_threads()
         torch.set_num_threads(default_num_processes if default_num_processes < n_threads else n_threads)
         prediction = None
-        print(f"len of list_of_parameters: {len(self.list_of_parameters)}")
-        for params in self.list_of_parameters:
-            # messing with state dict names...
-            if not isinstance(self.network, OptimizedModule):
-                self.network.load_state_dict(params)
-            else:
-                self.network._orig_mod.load_state_dict(params)
-
-            # why not leave prediction on device if perform_everything_on_device? Because this may cause the
-            # second iteration to crash due to OOM. Grabbing that with try except cause way more bloated code than
-            # this actually saves computation time
-            if prediction is None:
-                prediction = self.predict_sliding_window_return_logits(data).to('cpu')
-            else:
-                prediction += self.predict_sliding_window_return_logits(data).to('cpu')
-
-        if len(self.list_of_parameters) > 1:
-            prediction /= len(self.list_of_parameters)
+        log(f"len of list_of_parameters: {len(self.list_of_parameters)}", level='debug')
+        if self.tile_batch_scheduler is not None:
+            # self.network must not be touched because other threads may be predicting as well. All folds are
+            # evaluated on each tile by the scheduler
+            with self.tile_batch_scheduler.active_case():
+                prediction = self.predict_sliding_window_return_logits(data, nonzero_mask, plan).to('cpu')
+        elif (self.ensemble_folds_per_tile and len(self.list_of_parameters) > 1) or self.cpu_engine is not None:
+            if self.fold_networks is None:
+                self._internal_build_fold_networks()
+            # all folds are evaluated on each tile, see _internal_predict_tile_batch
+            prediction = self.predict_sliding_window_return_logits(data, nonzero_mask, plan, checkpoint).to('cpu')
+        else:
+            start_fold = 0
+            if checkpoint is not None:
+                fingerprint = checkpoint.fingerprint(data, self._internal_get_checkpoint_settings(checkpoint, plan))
+                state = checkpoint.load('folds', fingerprint)
+                if state is not None:
+                    start_fold, prediction = state['cursor']['next_fold'], state['tensors']['fold_sum']
+                    log(f'Resuming from checkpoint in {checkpoint.folder}, {start_fold} folds are done')
+            for fold, params in enumerate(self.list_of_parameters):
+                if fold < start_fold:
+                    continue
+                with trace_span('fold', fold=fold):
+                    # messing with state dict names...
+                    if not is_compiled_module(self.network):
+                        self.network.load_state_dict(params)
+                    else:
+                        self.network._orig_mod.load_state_dict(params)
+
+                    # why not leave prediction on device if perform_everything_on_device? Because this may cause the
+                    # second iteration to crash due to OOM. Grabbing that with try except cause way more bloated code
+                    # than this actually saves computation time
+                    try:
+                        fold_prediction = self.predict_sliding_window_return_logits(
+                            data, nonzero_mask, plan, checkpoint.for_fold(fold) if checkpoint is not None else None
+                        ).to('cpu')
+                    except SlidingWindowInterrupted:
+                        checkpoint.save('folds', fingerprint, {'fold_sum': prediction}, {'next_fold': fold})
+                        torch.set_num_threads(n_threads)
+                        raise
+                    if prediction is None:
+                        prediction = fold_prediction
+                    else:
+                        prediction += fold_prediction
+                    del fold_prediction
+            if checkpoint is not None:
+                checkpoint.remove('folds')
+
+            if len(self.list_of_parameters) > 1:
+                prediction /= len(self.list_of_parameters)
 
         if self.verbose: print('Prediction done')
         torch.set_num_threads(n_threads)
         return prediction
 
-    def _internal_get_sliding_window_slicers(self, image_size: Tuple[int, ...]):
+    def predict_logits_in_roi(self, data: torch.Tensor, properties: dict, roi: List[List[int]],
+                              roi_margin: Union[None, int, Tuple[int, ...]] = None,
+                              nonzero_mask: Optional[torch.Tensor] = None,
+                              plan: Optional[InferencePlan] = None,
+                              checkpoint: Optional[SlidingWindowCheckpoint] = None) -> Tuple[torch.Tensor, dict]:
+        """
+        Like predict_logits_from_preprocessed_data but only predicts the tiles needed for roi (see roi_prediction.py
+        for the format, it is given in original image coordinates) plus roi_margin preprocessed voxels of context on
+        each side. Default margin: half the patch size.
+
+        Returns the logits of the roi (rounded outwards to whole preprocessed voxels) and a modified copy of
+        properties. Pass both to export_prediction_from_logits or
+        convert_predicted_logits_to_segmentation_with_correct_shape to get a full size segmentation that is
+        background outside the roi
+        """
+        image_size = data.shape[1:]
+        bbox = roi_to_preprocessed_bbox(roi, properties, image_size, self.plans_manager.transpose_forward)
+        if any([i == j for i, j in bbox]):
+            # roi does not overlap the cropped image, everything in there is background. We still need some logits to
+            # export, so we make a single background voxel
+            log(f'roi {roi} is outside of the nonzero region of the image, the prediction is all background')
+            bbox = [[min(i, s - 1), min(i, s - 1) + 1] for (i, _), s in zip(bbox, image_size)]
+            logits = torch.zeros((self.label_manager.num_segmentation_heads, *[1] * len(image_size)))
+            if self.label_manager.has_regions:
+                logits -= 1
+            else:
+                logits[0] = 1
+            return logits, get_properties_for_preprocessed_bbox(bbox, properties, image_size)
+
+        if roi_margin is None:
+            roi_margin = [i // 2 for i in self.configuration_manager.patch_size]
+        elif isinstance(roi_margin, int):
+            roi_margin = [roi_margin] * len(self.configuration_manager.patch_size)
+        # 2d configurations predict slice by slice, no context needed along the first axis
+        roi_margin = [0] * (len(image_size) - len(roi_margin)) + list(roi_margin)
+        context_bbox = [[max(0, i - m), min(s, j + m)] for (i, j), m, s in zip(bbox, roi_margin, image_size)]
+        context_slicer = tuple([slice(i, j) for i, j in context_bbox])
+        if self.verbose:
+            print(f'roi {roi} -> preprocessed {bbox}, predicting {context_bbox} of {image_size}')
+
+        logits = self.predict_logits_from_preprocessed_data(
+            data[(slice(None), *context_slicer)],
+            nonzero_mask[context_slicer] if nonzero_mask is not None else None, plan, checkpoint)
+        logits = logits[(slice(None), *[slice(i - c, j - c) for (i, j), (c, _) in zip(bbox, context_bbox)])]
+        return logits, get_properties_for_preprocessed_bbox(bbox, properties, image_size)
+
+    def _internal_build_fold_networks(self):
+        """
+        creates one copy of self.network per entry in self.list_of_parameters and loads the respective weights. With
+        cpu_engine these are the exported networks
+        """
+        is_compiled = is_compiled_module(self.network)
+        base_network = self.network._orig_mod if is_compiled else self.network
+        fold_networks = []
+        for params in self.list_of_parameters:
+            network = deepcopy(base_network)
+            network.load_state_dict(params)
+            if self.cpu_engine is not None:
+                network = build_cpu_engine_network(network.eval(), self._internal_get_example_input(),
+                                                   self.cpu_engine, self.cpu_engine_quantization,
+                                                   self.cpu_engine_calibration_tiles)
+            elif is_compiled:
+                network = torch.compile(network)
+            fold_networks.append(network)
+        self.fold_networks = fold_networks
+
+    def _internal_get_example_input(self) -> torch.Tensor:
+        num_input_channels = determine_num_input_channels(self.plans_manager, self.configuration_manager,
+                                                          self.dataset_json)
+        return torch.zeros((1, num_input_channels, *self.configuration_manager.patch_size))
+
+    def calibrate_cpu_engine(self, list_of_lists_or_source_folder: Union[str, List[List[str]]],
+                             num_cases: int = 4, num_tiles_per_case: int = 8):
+        """
+        Preprocesses num_cases of the given images and keeps num_tiles_per_case sliding window tiles of each for
+        cpu_engine_quantization='static'. Use images that are representative of what you want to predict. Cascade
+        (previous stage segmentation) is not supported
+        """
+        if isinstance(list_of_lists_or_source_folder, str):
+            list_of_lists_or_source_folder = create_lists_from_splitted_dataset_folder(
+                list_of_lists_or_source_folder, self.dataset_json['file_ending'])
+        preprocessor = self.configuration_manager.preprocessor_class(verbose=self.verbose_preprocessing)
+        list_of_data = []
+        for files in list_of_lists_or_source_folder[:num_cases]:
+            data, _, _ = preprocessor.run_case(files, None, self.plans_manager, self.configuration_manager,
+                                               self.dataset_json)
+            list_of_data.append(torch.from_numpy(data))
+        self.cpu_engine_calibration_tiles = sample_calibration_tiles(list_of_data,
+                                                                     self.configuration_manager.patch_size,
+                                                                     num_tiles_per_case)
+        # engine networks need to be rebuilt with the new calibration
+        self.fold_networks = None
+
+    def _internal_get_sliding_window_slicers(self, image_size: Tuple[int, ...],
+                                             tile_step_size: Optional[float] = None):
+        if tile_step_size is None:
+            tile_step_size = self.tile_step_size
         slicers = []
         if len(self.configuration_manager.patch_size) < len(image_size):
             assert len(self.configuration_manager.patch_size) == len(
@@ -514,10 +925,10 @@ class nnUNetPredictor(object):
                                  '(only dimension ' \
                                  'discrepancy of 1 allowed).'
             steps = compute_steps_for_sliding_window(image_size[1:], self.configuration_manager.patch_size,
-                                                     self.tile_step_size)
+                                                     tile_step_size)
             if self.verbose: print(f'n_steps {image_size[0] * len(steps[0]) * len(steps[1])}, image size is'
                                    f' {image_size}, tile_size {self.configuration_manager.patch_size}, '
-                                   f'tile_step_size {self.tile_step_size}\nsteps:\n{steps}')
+                                   f'tile_step_size {tile_step_size}\nsteps:\n{steps}')
             for d in range(image_size[0]):
                 for sx in steps[0]:
                     for sy in steps[1]:
@@ -526,10 +937,10 @@ class nnUNetPredictor(object):
                                                      zip((sx, sy), self.configuration_manager.patch_size)]]))
         else:
             steps = compute_steps_for_sliding_window(image_size, self.configuration_manager.patch_size,
-                                                     self.tile_step_size)
+                                                     tile_step_size)
             if self.verbose: print(
                 f'n_steps {np.prod([len(i) for i in steps])}, image size is {image_size}, tile_size {self.configuration_manager.patch_size}, '
-                f'tile_step_size {self.tile_step_size}\nsteps:\n{steps}')
+                f'tile_step_size {tile_step_size}\nsteps:\n{steps}')
             for sx in steps[0]:
                 for sy in steps[1]:
                     for sz in steps[2]:
@@ -538,30 +949,184 @@ class nnUNetPredictor(object):
                                                   zip((sx, sy, sz), self.configuration_manager.patch_size)]]))
         return slicers
 
-    def _internal_maybe_mirror_and_predict(self, x: torch.Tensor) -> torch.Tensor:
+    def _internal_filter_slicers_by_occupancy(self, slicers: List[tuple], nonzero_mask: torch.Tensor) -> List[tuple]:
+        """
+        removes all slicers whose tile has a fraction of nonzero voxels below self.tile_skip_threshold. nonzero_mask
+        must have the (padded) shape of the image (x, y(, z))
+        """
+        keep = []
+        for sl in slicers:
+            tile = nonzero_mask[sl[1:]]
+            if torch.count_nonzero(tile).item() / tile.numel() >= self.tile_skip_threshold:
+                keep.append(sl)
+        if self.verbose:
+            print(f'skipping {len(slicers) - len(keep)} out of {len(slicers)} tiles because they are (mostly) '
+                  f'outside the nonzero mask')
+        return keep
+
+    def _internal_get_mirror_axes_combinations(self, x_ndim: int) -> List[Tuple[int, ...]]:
+        """
+        returns the axes that need to be flipped for each test time augmentation view. The first entry is always the
+        empty tuple (= no mirroring). x_ndim is the dimensionality of the network input (b, c, x, y(, z))
+        """
         mirror_axes = self.allowed_mirroring_axes if self.use_mirroring else None
-        prediction = self.network(x)
-
-        if mirror_axes is not None:
-            # check for invalid numbers in mirror_axes
-            # x should be 5d for 3d images and 4d for 2d. so the max value of mirror_axes cannot exceed len(x.shape) - 3
-            assert max(mirror_axes) <= x.ndim - 3, 'mirror_axes does not match the dimension of the input!'
-
-            mirror_axes = [m + 2 for m in mirror_axes]
-            axes_combinations = [
-                c for i in range(len(mirror_axes)) for c in itertools.combinations(mirror_axes, i + 1)
-            ]
-            for axes in axes_combinations:
-                prediction += torch.flip(self.network(torch.flip(x, axes)), axes)
-            prediction /= (len(axes_combinations) + 1)
+        if mirror_axes is None:
+            return [()]
+        # check for invalid numbers in mirror_axes
+        # x should be 5d for 3d images and 4d for 2d. so the max value of mirror_axes cannot exceed len(x.shape) - 3
+        assert max(mirror_axes) <= x_ndim - 3, 'mirror_axes does not match the dimension of the input!'
+
+        mirror_axes = [m + 2 for m in mirror_axes]
+        axes_combinations = [
+            c for i in range(len(mirror_axes)) for c in itertools.combinations(mirror_axes, i + 1)
+        ]
+        return [()] + axes_combinations
+
+    def _internal_maybe_mirror_and_predict(self, x: torch.Tensor, network: Optional[nn.Module] = None,
+                                           max_batch_size: Optional[int] = None) -> torch.Tensor:
+        """
+        The mirrored views of x are stacked along the batch dimension so that they are predicted together. If
+        max_batch_size is given, the views are split into several forward passes of at most max_batch_size samples
+        (but always at least one full view of x)
+        """
+        if network is None:
+            network = self.network
+        view_axes = self._internal_get_mirror_axes_combinations(x.ndim)
+        b = x.shape[0]
+        views_per_forward = len(view_axes) if max_batch_size is None else max(1, max_batch_size // b)
+
+        prediction = None
+        for i in range(0, len(view_axes), views_per_forward):
+            axes_here = view_axes[i:i + views_per_forward]
+            with trace_span('forward', sync_device=self.device, tiles=b, mirror_axes=axes_here):
+                out = network(torch.cat([torch.flip(x, axes) if len(axes) > 0 else x for axes in axes_here]))
+            for j, axes in enumerate(axes_here):
+                out_view = out[j * b:(j + 1) * b]
+                if len(axes) > 0:
+                    out_view = torch.flip(out_view, axes)
+                if prediction is None:
+                    prediction = out_view
+                else:
+                    prediction += out_view
+        if len(view_axes) > 1:
+            prediction /= len(view_axes)
+        return prediction
+
+    def _internal_predict_tile_batch(self, x: torch.Tensor, max_batch_size: Optional[int] = None) -> torch.Tensor:
+        """
+        x is a batch of tiles that already lives on self.device. If a tile_batch_scheduler is attached, it predicts x
+        (possibly together with tiles of other predictions), see TileBatchScheduler
+        """
+        if self.tile_batch_scheduler is not None:
+            return self.tile_batch_scheduler.predict(x)
+        return self._internal_forward_tile_batch(x, max_batch_size)
+
+    def _internal_forward_tile_batch(self, x: torch.Tensor, max_batch_size: Optional[int] = None) -> torch.Tensor:
+        """
+        If fold_networks are active all folds are evaluated on x and the result is averaged, otherwise this is just
+        self.network (+ mirroring)
+        """
+        if not (self.ensemble_folds_per_tile or self.cpu_engine is not None or self.tile_batch_scheduler is not None) \
+                or self.fold_networks is None:
+            return self._internal_maybe_mirror_and_predict(x, max_batch_size=max_batch_size)
+        prediction = None
+        for fold, network in enumerate(self.fold_networks):
+            with trace_span('forward_fold', fold=fold):
+                if prediction is None:
+                    prediction = self._internal_maybe_mirror_and_predict(x, network, max_batch_size)
+                else:
+                    prediction += self._internal_maybe_mirror_and_predict(x, network, max_batch_size)
+        prediction /= len(self.fold_networks)
         return prediction
 
+    def _internal_get_checkpoint_settings(self, checkpoint: SlidingWindowCheckpoint,
+                                          plan: Optional[InferencePlan]) -> dict:
+        """
+        everything besides the input that the state of a SlidingWindowCheckpoint depends on
+        """
+        if checkpoint.model_fingerprint is None:
+            checkpoint.model_fingerprint = compute_model_fingerprint(self)
+        return {'model': checkpoint.model_fingerprint,
+                'accumulator_dtype': plan.accumulator_dtype if plan is not None else self.accumulator_dtype}
+
+    def _internal_get_tile_batch_size(self, data: torch.Tensor) -> int:
+        """
+        maximum number of samples (tiles x mirrored views) in one forward pass
+        """
+        if self.tile_batch_size is not None:
+            return max(1, self.tile_batch_size)
+        features_per_stage = self.configuration_manager.network_arch_init_kwargs.get('features_per_stage')
+        # 2d tiles are small and there are many of them (every slice), so we allow larger batches
+        max_tile_batch_size = 64 if len(self.configuration_manager.patch_size) == 2 else 16
+        return determine_tile_batch_size(self.configuration_manager.patch_size, data.shape[0],
+                                         self.label_manager.num_segmentation_heads, self.device,
+                                         features_per_stage[0] if features_per_stage else 32,
+                                         max_tile_batch_size=max_tile_batch_size)
+
+    def plan_inference(self, data_shape: Tuple[int, ...], properties: dict, save_probabilities: bool = False,
+                       num_export_workers: int = 1) -> Optional[InferencePlan]:
+        """
+        InferencePlan for a preprocessed image of data_shape (c, x, y(, z)) with the given properties (as returned by
+        the preprocessing). None if neither ram_budget_gb nor vram_budget_gb is set
+        """
+        if self.ram_budget_gb is None and self.vram_budget_gb is None:
+            return None
+        ram_budget = int(self.ram_budget_gb * 1024 ** 3) if self.ram_budget_gb is not None else None
+        device_budget = None
+        if self.device.type == 'cuda':
+            device_budget = int(self.vram_budget_gb * 1024 ** 3) if self.vram_budget_gb is not None else \
+                get_available_memory(self.device)
+
+        uses_fold_networks = self.ensemble_folds_per_tile or self.cpu_engine is not None or \
+            self.tile_batch_scheduler is not None
+        num_networks = len(self.list_of_parameters) if uses_fold_networks else 1
+        network_bytes = num_networks * sum([i.numel() * i.element_size() for i in self.network.parameters()])
+        features_per_stage = self.configuration_manager.network_arch_init_kwargs.get('features_per_stage')
+        if self.tile_batch_size is not None:
+            max_tile_batch_size = self.tile_batch_size
+        else:
+            max_tile_batch_size = 64 if len(self.configuration_manager.patch_size) == 2 else 16
+        axis0_order = get_axis0_interpolation_order(self.configuration_manager,
+                                                    *get_export_spacings(self.plans_manager,
+                                                                         self.configuration_manager, properties))
+        return plan_inference(tuple(data_shape), self.configuration_manager.patch_size,
+                              self.label_manager.num_segmentation_heads,
+                              tuple(properties['shape_after_cropping_and_before_resampling']),
+                              tuple(properties['shape_before_cropping']), self.device, ram_budget, device_budget,
+                              self.accumulator_dtype, max_tile_batch_size, num_export_workers,
+                              axis0_order is not None, save_probabilities, network_bytes,
+                              features_per_stage[0] if features_per_stage else 32,
+                              self.tile_skip_threshold is None and self.refinement_margin is None,
+                              not uses_fold_networks and len(self.list_of_parameters) > 1,
+                              self.perform_everything_on_device, self.accumulator_folder is None,
+                              self.refinement_margin is not None)
+
     def _internal_predict_sliding_window_return_logits(self,
                                                        data: torch.Tensor,
                                                        slicers,
                                                        do_on_device: bool = True,
+                                                       fill_uncovered_with_background: bool = False,
+                                                       draft_slicers: Optional[List[tuple]] = None,
+                                                       plan: Optional[InferencePlan] = None,
+                                                       checkpoint: Optional[SlidingWindowCheckpoint] = None,
+                                                       fingerprint: Optional[str] = None
                                                        ):
-        predicted_logits = n_predictions = prediction = gaussian = workon = None
+        """
+        fill_uncovered_with_background must be set if the slicers do not cover the entire image (skipped tiles)
+
+        slicers=None is the 2d fast path: all tiles of the regular sliding window, predicted in batches of slices
+
+        If draft_slicers is given we do the adaptive (coarse to fine) sliding window: draft_slicers are predicted
+        first and of slicers only those are predicted in addition that cover regions in which the draft is not
+        confident (see self.refinement_margin) or where foreground lies on a seam between draft tiles
+
+        plan (optional, see plan_inference) overrides accumulator dtype and location and the tile batch size
+
+        checkpoint (optional, see predict_sliding_window_return_logits): the phases (draft + refinement or just the
+        regular tiles) and tile batches are the units of work we can resume from. fingerprint identifies the input
+        and settings the state belongs to (required with checkpoint)
+        """
+        predicted_logits = n_predictions = prediction = gaussian = workon = normalization_map = None
         results_device = self.device if do_on_device else torch.device('cpu')
 
         try:
@@ -570,16 +1135,12 @@ class nnUNetPredictor(object):
             # move data to device
             if self.verbose:
                 print(f'move image to device {results_device}')
-            data = data.to(results_device)
+            with trace_span('h2d', sync_device=results_device):
+                data = data.to(results_device)
 
             # preallocate arrays
             if self.verbose:
                 print(f'preallocating results arrays on device {results_device}')
-            predicted_logits = torch.zeros((self.label_manager.num_segmentation_heads, *data.shape[1:]),
-                                           dtype=torch.half,
-                                           device=results_device)
-            n_predictions = torch.zeros(data.shape[1:], dtype=torch.half, device=results_device)
-
             if self.use_gaussian:
                 gaussian = compute_gaussian(tuple(self.configuration_manager.patch_size), sigma_scale=1. / 8,
                                             value_scaling_factor=10,
@@ -587,38 +1148,342 @@ class nnUNetPredictor(object):
             else:
                 gaussian = 1
 
-            if not self.allow_tqdm and self.verbose:
-                print(f'running prediction: {len(slicers)} steps')
-            for sl in tqdm(slicers, disable=not self.allow_tqdm):
-                workon = data[sl][None]
-                workon = workon.to(self.device)
-
-                prediction = self._internal_maybe_mirror_and_predict(workon)[0].to(results_device)
-
-                if self.use_gaussian:
-                    prediction *= gaussian
-                predicted_logits[sl] += prediction
-                n_predictions[sl[1:]] += gaussian
-
-            predicted_logits /= n_predictions
-            # check for infs
-            if torch.any(torch.isinf(predicted_logits)):
-                raise RuntimeError('Encountered inf in predicted array. Aborting... If this problem persists, '
-                                   'reduce value_scaling_factor in compute_gaussian or increase the dtype of '
-                                   'predicted_logits to fp32')
+            logits_shape = (self.label_manager.num_segmentation_heads, *data.shape[1:])
+            accumulator_dtype = plan.accumulator_dtype if plan is not None else self.accumulator_dtype
+            accumulator_folder = self.accumulator_folder if results_device.type == 'cpu' else None
+            if plan is not None and plan.accumulator_location == 'memmap' and accumulator_folder is None:
+                accumulator_folder = tempfile.gettempdir()
+
+            # if all tiles of the regular sliding window are predicted, the normalization only depends on the shape
+            # and we can take it from the cache instead of accumulating n_predictions. The map is a full size float32
+            # array in memory, so not if the accumulator is memory mapped (we keep n_predictions on disk then). The 2d
+            # fast path needs it, but there it only takes the memory of one slice
+            normalization_map = None
+            if draft_slicers is None and not fill_uncovered_with_background and \
+                    (accumulator_folder is None or slicers is None):
+                normalization_map = self._internal_get_reciprocal_normalization_map(data.shape[1:], slicers,
+                                                                                    gaussian, results_device)
+            if accumulator_folder is not None:
+                predicted_logits = allocate_disk_backed_tensor(logits_shape, accumulator_dtype, accumulator_folder)
+                if normalization_map is None:
+                    n_predictions = allocate_disk_backed_tensor(data.shape[1:], accumulator_dtype,
+                                                                accumulator_folder)
+            else:
+                predicted_logits = torch.zeros(logits_shape, dtype=accumulator_dtype, device=results_device)
+                if normalization_map is None:
+                    n_predictions = torch.zeros(data.shape[1:], dtype=accumulator_dtype, device=results_device)
+
+            # this is determined after preallocation so that the memory taken by the results arrays is accounted for.
+            # Tiles and their mirrored views share the batch dimension, so the number of tiles per batch is the
+            # forward batch size divided by the number of views
+            tile_batch_size = plan.tile_batch_size if plan is not None else self._internal_get_tile_batch_size(data)
+
+            # phase 0: regular tiles (or the draft of the adaptive sliding window), phase 1: refinement tiles
+            cursor = {'phase': 0, 'next_tile': 0, 'tile_batch_size': tile_batch_size, 'refinement_tiles': None}
+            state = checkpoint.load('sliding_window', fingerprint) if checkpoint is not None else None
+            if state is not None and (state['tensors']['n_predictions'] is None) != (n_predictions is None):
+                # written with a different accumulator location (memory mapped or not), can't be used
+                log(f'Ignoring the sliding window state in {checkpoint.folder}, it was written with a different '
+                    f'accumulator_folder setting', level='warning')
+                state = None
+            if state is not None:
+                cursor = state['cursor']
+                # same batches as before, otherwise the result would not be bit-identical
+                tile_batch_size = cursor['tile_batch_size']
+                predicted_logits.copy_(state['tensors']['predicted_logits'])
+                if n_predictions is not None:
+                    n_predictions.copy_(state['tensors']['n_predictions'])
+                log(f'Resuming from checkpoint in {checkpoint.folder}: phase {cursor["phase"]}, tile '
+                    f'{cursor["next_tile"]}')
+                del state
+
+            def checkpoint_fn(phase: int):
+                if checkpoint is None:
+                    return None
+
+                def save_if_deadline_reached(next_tile: int):
+                    if checkpoint.deadline_reached():
+                        checkpoint.save('sliding_window', fingerprint,
+                                        {'predicted_logits': predicted_logits, 'n_predictions': n_predictions},
+                                        dict(cursor, phase=phase, next_tile=next_tile))
+                        raise SlidingWindowInterrupted(f'Deadline reached, progress was saved in {checkpoint.folder}')
+                return save_if_deadline_reached
+
+            def resume_from(phase: int) -> int:
+                if phase < cursor['phase']:
+                    return -1
+                return cursor['next_tile'] if phase == cursor['phase'] else 0
+
+            if slicers is None:
+                self._internal_accumulate_slice_batches(data, predicted_logits, gaussian, tile_batch_size,
+                                                        results_device, resume_from(0), checkpoint_fn(0))
+            elif draft_slicers is None:
+                self._internal_accumulate_tiles(data, slicers, predicted_logits, n_predictions, gaussian,
+                                                tile_batch_size, results_device, resume_from(0), checkpoint_fn(0))
+            else:
+                if resume_from(0) >= 0:
+                    self._internal_accumulate_tiles(data, draft_slicers, predicted_logits, n_predictions, gaussian,
+                                                    tile_batch_size, results_device, resume_from(0), checkpoint_fn(0))
+                if cursor['refinement_tiles'] is None:
+                    # the selection depends on the accumulator, which changes once refinement tiles are added. So
+                    # we need to remember it
+                    cursor['refinement_tiles'] = self._internal_select_refinement_slicers(
+                        predicted_logits, n_predictions, draft_slicers, slicers)
+                refinement_slicers = [slicers[i] for i in cursor['refinement_tiles']]
+                self._internal_accumulate_tiles(data, refinement_slicers, predicted_logits, n_predictions, gaussian,
+                                                tile_batch_size, results_device, resume_from(1), checkpoint_fn(1))
+
+            with trace_span('normalize_accumulator'):
+                self._internal_normalize_accumulator(predicted_logits, n_predictions, fill_uncovered_with_background,
+                                                     normalization_map)
+            if checkpoint is not None:
+                checkpoint.remove('sliding_window')
         except Exception as e:
-            del predicted_logits, n_predictions, prediction, gaussian, workon
+            del predicted_logits, n_predictions, prediction, gaussian, workon, normalization_map
             empty_cache(self.device)
             empty_cache(results_device)
             raise e
         return predicted_logits
 
+    def _internal_accumulate_tiles(self, data: torch.Tensor, slicers: List[tuple], predicted_logits: torch.Tensor,
+                                   n_predictions: Optional[torch.Tensor], gaussian: Union[torch.Tensor, int],
+                                   tile_batch_size: int, results_device: torch.device, resume_from: int = 0,
+                                   after_batch: Optional[Callable[[int], None]] = None):
+        """
+        predicts the tiles given by slicers and adds their (gaussian weighted) logits to predicted_logits and the
+        weights to n_predictions (in place). n_predictions can be None if a normalization map is used instead
+
+        resume_from: skip the tiles before this one (must be the end of a batch of an earlier call with the same
+        tile_batch_size). after_batch(number of tiles done) is called after every batch
+        """
+        if len(slicers) == 0:
+            return
+        # Tiles and their mirrored views share the batch dimension, so the number of tiles per batch is the
+        # forward batch size divided by the number of views
+        num_views = len(self._internal_get_mirror_axes_combinations(data.ndim + 1))
+        tiles_per_batch = max(1, min(tile_batch_size // num_views, len(slicers)))
+        slicer_batches = [slicers[i:i + tiles_per_batch] for i in range(0, len(slicers), tiles_per_batch)]
+
+        if not self.allow_tqdm and self.verbose:
+            print(f'running prediction: {len(slicers)} steps in {len(slicer_batches)} batches of up to '
+                  f'{tiles_per_batch} tiles ({num_views} mirrored views each)')
+        with tqdm(total=len(slicers), initial=resume_from, disable=not self.allow_tqdm) as pbar:
+            for b, batch_slicers in enumerate(slicer_batches):
+                if b * tiles_per_batch < resume_from:
+                    continue
+                workon = torch.stack([data[sl] for sl in batch_slicers])
+                with trace_span('h2d', sync_device=self.device):
+                    workon = workon.to(self.device)
+
+                prediction = self._internal_predict_tile_batch(workon, tile_batch_size).to(results_device)
+
+                with trace_span('accumulate', sync_device=results_device, tiles=len(batch_slicers)):
+                    if self.use_gaussian:
+                        prediction *= gaussian
+                    for sl, p in zip(batch_slicers, prediction):
+                        predicted_logits[sl] += p
+                        if n_predictions is not None:
+                            n_predictions[sl[1:]] += gaussian
+                pbar.update(len(batch_slicers))
+                if after_batch is not None:
+                    after_batch(b * tiles_per_batch + len(batch_slicers))
+
+    def _internal_get_reciprocal_normalization_map(self, image_size: Tuple[int, ...],
+                                                   slicers: Optional[List[tuple]],
+                                                   gaussian: Union[torch.Tensor, int],
+                                                   results_device: torch.device) -> torch.Tensor:
+        """
+        slicers=None means 2d fast path (see _internal_accumulate_slice_batches)
+        """
+        key = (tuple(image_size), tuple(self.configuration_manager.patch_size), self.tile_step_size,
+               self.use_gaussian, gaussian.dtype if isinstance(gaussian, torch.Tensor) else None, str(results_device))
+        if slicers is None:
+            patch_size = self.configuration_manager.patch_size
+            steps = compute_steps_for_sliding_window(image_size[1:], patch_size, self.tile_step_size)
+            return self.normalization_map_cache.get(
+                key, lambda: compute_reciprocal_normalization_map_2d(image_size, steps, patch_size, gaussian,
+                                                                     results_device))
+        return self.normalization_map_cache.get(
+            key, lambda: compute_reciprocal_normalization_map(image_size, slicers, gaussian, results_device))
+
+    def _internal_accumulate_slice_batches(self, data: torch.Tensor, predicted_logits: torch.Tensor,
+                                           gaussian: Union[torch.Tensor, int], tile_batch_size: int,
+                                           results_device: torch.device, resume_from: int = 0,
+                                           after_batch: Optional[Callable[[int], None]] = None):
+        """
+        2d configuration on a 3d image (data is (c, z, x, y)). Predicts all tiles of the regular sliding window and adds
+        their (gaussian weighted) logits to predicted_logits. Tile i is slice i // num_positions at the in-plane
+        position i % num_positions (same order as _internal_get_sliding_window_slicers). A batch holds many slices and
+        is cut out of data / added back to predicted_logits with one slicing operation per in-plane position (see
+        get_slice_batch_runs) instead of one per tile. The accumulation order per voxel is the same as with slicers
+
+        resume_from, after_batch: see _internal_accumulate_tiles
+        """
+        patch_size = self.configuration_manager.patch_size
+        num_slices = data.shape[1]
+        steps = compute_steps_for_sliding_window(data.shape[2:], patch_size, self.tile_step_size)
+        positions = [(sx, sy) for sx in steps[0] for sy in steps[1]]
+        num_tiles = num_slices * len(positions)
+        num_views = len(self._internal_get_mirror_axes_combinations(len(patch_size) + 2))
+        tiles_per_batch = max(1, min(tile_batch_size // num_views, num_tiles))
+        if tiles_per_batch >= len(positions):
+            # whole slices per batch -> one run per position
+            tiles_per_batch -= tiles_per_batch % len(positions)
+
+        if not self.allow_tqdm and self.verbose:
+            print(f'running prediction: {num_tiles} steps ({num_slices} slices x {len(positions)} positions) in '
+                  f'{int(np.ceil(num_tiles / tiles_per_batch))} batches of up to {tiles_per_batch} tiles '
+                  f'({num_views} mirrored views each)')
+        with tqdm(total=num_tiles, initial=resume_from, disable=not self.allow_tqdm) as pbar:
+            for start in range(resume_from, num_tiles, tiles_per_batch):
+                end = min(start + tiles_per_batch, num_tiles)
+                runs = get_slice_batch_runs(start, end, len(positions))
+                workon = torch.cat([
+                    data[:, first:last, positions[p][0]:positions[p][0] + patch_size[0],
+                         positions[p][1]:positions[p][1] + patch_size[1]].transpose(0, 1)
+                    for p, first, last in runs
+                ])
+                with trace_span('h2d', sync_device=self.device):
+                    workon = workon.to(self.device)
+
+                prediction = self._internal_predict_tile_batch(workon, tile_batch_size).to(results_device)
+
+                with trace_span('accumulate', sync_device=results_device, tiles=end - start):
+                    if self.use_gaussian:
+                        prediction *= gaussian
+                    i = 0
+                    for p, first, last in runs:
+                        sx, sy = positions[p]
+                        predicted_logits[:, first:last, sx:sx + patch_size[0], sy:sy + patch_size[1]] += \
+                            prediction[i:i + last - first].transpose(0, 1)
+                        i += last - first
+                pbar.update(end - start)
+                if after_batch is not None:
+                    after_batch(end)
+
+    def _internal_normalize_accumulator(self, predicted_logits: torch.Tensor, n_predictions: Optional[torch.Tensor],
+                                        fill_uncovered_with_background: bool = False,
+                                        reciprocal_normalization_map: Optional[torch.Tensor] = None):
+        """
+        predicted_logits /= n_predictions (in place) or, if given, predicted_logits *= reciprocal_normalization_map.
+        Voxels that were not predicted are set to background if fill_uncovered_with_background (needs n_predictions).
+        This is done in slabs along the first spatial axis so that we never need temporary arrays of the size of
+        predicted_logits (important if they live on disk, see accumulator_folder)
+        """
+        background_logits = self.label_manager.get_background_logits() if fill_uncovered_with_background else None
+        slab_size = self.configuration_manager.patch_size[0]
+        for s in range(0, predicted_logits.shape[1], slab_size):
+            logits_here = predicted_logits[:, s:s + slab_size]
+            if reciprocal_normalization_map is not None:
+                logits_here *= reciprocal_normalization_map[s:s + slab_size]
+            else:
+                n_here = n_predictions[s:s + slab_size]
+                if background_logits is not None:
+                    uncovered = n_here == 0
+                    for c, v in enumerate(background_logits):
+                        logits_here[c][uncovered] = v
+                    n_here[uncovered] = 1
+                logits_here /= n_here
+            # check for infs
+            if torch.any(torch.isinf(logits_here)):
+                raise RuntimeError('Encountered inf in predicted array. Aborting... If this problem persists, '
+                                   'reduce value_scaling_factor in compute_gaussian or set accumulator_dtype to '
+                                   'torch.float32')
+
+    def _internal_select_refinement_slicers(self, predicted_logits: torch.Tensor, n_predictions: torch.Tensor,
+                                            draft_slicers: List[tuple], slicers: List[tuple]) -> List[int]:
+        """
+        Looks at the draft prediction (predicted_logits / n_predictions after the draft tiles were accumulated) and
+        returns the indices of those slicers (minus the ones already in draft_slicers) that contain at least one voxel where the
+        draft is not confident (margin < self.refinement_margin) or that lies on a seam between draft tiles where the
+        predicted label changes across the seam and at least one side is foreground (= potential seam artifact)
+        """
+        def tile_start(sl):
+            return tuple([i.start if isinstance(i, slice) else i for i in sl[1:]])
+
+        in_draft = set([tile_start(sl) for sl in draft_slicers])
+        candidates = [n for n, sl in enumerate(slicers) if tile_start(sl) not in in_draft]
+        if len(candidates) == 0:
+            return candidates
+
+        patch_size = self.configuration_manager.patch_size
+        image_size = n_predictions.shape
+        steps = compute_steps_for_sliding_window(image_size[-len(patch_size):], patch_size, 1)
+        offset = len(image_size) - len(patch_size)
+        borders = compute_inner_tile_borders(image_size, steps, patch_size)
+        # Go through the image in slabs along axis 0 so that the draft probabilities and segmentation never exist for
+        # the whole image. Each slab is extended by one row on either side for the seams along axis 0
+        slab_size = patch_size[0] if offset == 0 else 1
+        needs_refinement = [False] * len(candidates)
+        for start in range(0, image_size[0], slab_size):
+            end = min(start + slab_size, image_size[0])
+            lb, ub = max(start - 1, 0), min(end + 1, image_size[0])
+            # voxels that are not covered by any draft tile (skipped tiles) get 0 logits -> low margin
+            n = n_predictions[lb:ub]
+            draft = predicted_logits[:, lb:ub] / torch.where(n > 0, n, 1)
+            probabilities = self.label_manager.apply_inference_nonlin(draft)
+            del draft
+            uncertain = self.label_manager.get_prediction_margin(probabilities[:, start - lb:end - lb]) < \
+                self.refinement_margin
+            segmentation = self.label_manager.convert_probabilities_to_segmentation(probabilities)
+            del probabilities
+
+            for d, borders_here in enumerate(borders):
+                axis = offset + d
+                for b in borders_here:
+                    if axis == 0:
+                        if not (start <= b - 1 < end or start <= b < end):
+                            continue
+                        before, after = segmentation[b - 1 - lb], segmentation[b - lb]
+                    else:
+                        before = segmentation[start - lb:end - lb].select(axis, b - 1)
+                        after = segmentation[start - lb:end - lb].select(axis, b)
+                    artifact = (before != after) & ((before != 0) | (after != 0))
+                    for i in (b - 1, b):
+                        if axis != 0:
+                            uncertain.select(axis, i).logical_or_(artifact)
+                        elif start <= i < end:
+                            uncertain[i - start].logical_or_(artifact)
+            del segmentation
+
+            for c, n in enumerate(candidates):
+                if needs_refinement[c]:
+                    continue
+                sl = slicers[n]
+                first = sl[1].start if isinstance(sl[1], slice) else sl[1]
+                last = sl[1].stop if isinstance(sl[1], slice) else sl[1] + 1
+                if max(first, start) < min(last, end):
+                    rows = slice(max(first, start) - start, min(last, end) - start)
+                    needs_refinement[c] = torch.any(uncertain[(rows, *sl[2:])]).item()
+            del uncertain
+
+        refinement_tiles = [n for n, r in zip(candidates, needs_refinement) if r]
+        log(f'adaptive sliding window: predicted {len(draft_slicers)} draft tiles, added '
+            f'{len(refinement_tiles)} out of {len(candidates)} refinement tiles', level='debug')
+        return refinement_tiles
+
     @torch.inference_mode()
-    def predict_sliding_window_return_logits(self, input_image: torch.Tensor) \
+    def predict_sliding_window_return_logits(self, input_image: torch.Tensor,
+                                             nonzero_mask: Optional[torch.Tensor] = None,
+                                             plan: Optional[InferencePlan] = None,
+                                             checkpoint: Optional[SlidingWindowCheckpoint] = None) \
             -> Union[np.ndarray, torch.Tensor]:
+        """
+        nonzero_mask (x, y(, z)) is optional and only used if tile_skip_threshold is set
+
+        plan: optional InferencePlan, see plan_inference
+
+        checkpoint: optional SlidingWindowCheckpoint. The accumulator state is saved and SlidingWindowInterrupted is
+        raised once its deadline is reached. A later call with the same input and a checkpoint on the same folder
+        resumes (bit-identical result). This only covers the network that is currently loaded (or all folds with
+        ensemble_folds_per_tile), predict_logits_from_preprocessed_data keeps track of the folds
+        """
         assert isinstance(input_image, torch.Tensor)
         self.network = self.network.to(self.device)
         self.network.eval()
+        if self.ensemble_folds_per_tile and self.cpu_engine is None and self.fold_networks is not None and \
+                self.tile_batch_scheduler is None:
+            self.fold_networks = [i.to(self.device).eval() for i in self.fold_networks]
 
         empty_cache(self.device)
 
@@ -636,26 +1501,56 @@ class nnUNetPredictor(object):
                 print("step_size:", self.tile_step_size)
                 print("mirror_axes:", self.allowed_mirroring_axes if self.use_mirroring else None)
 
+            # the padded image is a new (inference) tensor every time, so we fingerprint the input
+            fingerprint = checkpoint.fingerprint(input_image,
+                                                 self._internal_get_checkpoint_settings(checkpoint, plan)) \
+                if checkpoint is not None else None
+
             # if input_image is smaller than tile_size we need to pad it to tile_size.
             data, slicer_revert_padding = pad_nd_image(input_image, self.configuration_manager.patch_size,
                                                        'constant', {'value': 0}, True,
                                                        None)
 
-            slicers = self._internal_get_sliding_window_slicers(data.shape[1:])
-
-            if self.perform_everything_on_device and self.device != 'cpu':
+            if len(self.configuration_manager.patch_size) < len(data.shape[1:]) and self.refinement_margin is None \
+                    and (self.tile_skip_threshold is None or nonzero_mask is None):
+                # 2d configuration: the tiles (slice, x step, y step) are addressed by index arithmetic and many
+                # slices are predicted at once, see _internal_accumulate_slice_batches
+                slicers, draft_slicers, fill_uncovered = None, None, False
+            else:
+                slicers = self._internal_get_sliding_window_slicers(data.shape[1:])
+                # adaptive sliding window: non-overlapping draft first, then refine where needed
+                draft_slicers = self._internal_get_sliding_window_slicers(data.shape[1:], 1) \
+                    if self.refinement_margin is not None else None
+
+                num_tiles = len(slicers) + (len(draft_slicers) if draft_slicers is not None else 0)
+                if self.tile_skip_threshold is not None and nonzero_mask is not None:
+                    nonzero_mask = pad_nd_image(nonzero_mask, self.configuration_manager.patch_size, 'constant',
+                                                {'value': False}, False, None)
+                    slicers = self._internal_filter_slicers_by_occupancy(slicers, nonzero_mask)
+                    if draft_slicers is not None:
+                        draft_slicers = self._internal_filter_slicers_by_occupancy(draft_slicers, nonzero_mask)
+                    del nonzero_mask
+                fill_uncovered = len(slicers) + (len(draft_slicers) if draft_slicers is not None else 0) < num_tiles
+
+            do_on_device = self.perform_everything_on_device if plan is None else \
+                plan.accumulator_location == 'device'
+            if do_on_device and self.device != 'cpu':
                 # we need to try except here because we can run OOM in which case we need to fall back to CPU as a results device
                 try:
-                    predicted_logits = self._internal_predict_sliding_window_return_logits(data, slicers,
-                                                                                           self.perform_everything_on_device)
+                    predicted_logits = self._internal_predict_sliding_window_return_logits(
+                        data, slicers, True, fill_uncovered, draft_slicers, plan, checkpoint, fingerprint)
                 except RuntimeError:
-                    print(
-                        'Prediction on device was unsuccessful, probably due to a lack of memory. Moving results arrays to CPU')
+                    log('Prediction on device was unsuccessful, probably due to a lack of memory. Moving results '
+                        'arrays to CPU', level='warning')
+                    self.normalization_map_cache.clear()
                     empty_cache(self.device)
-                    predicted_logits = self._internal_predict_sliding_window_return_logits(data, slicers, False)
+                    predicted_logits = self._internal_predict_sliding_window_return_logits(data, slicers, False,
+                                                                                           fill_uncovered,
+                                                                                           draft_slicers, plan,
+                                                                                           checkpoint, fingerprint)
             else:
-                predicted_logits = self._internal_predict_sliding_window_return_logits(data, slicers,
-                                                                                       self.perform_everything_on_device)
+                predicted_logits = self._internal_predict_sliding_window_return_logits(
+                    data, slicers, do_on_device, fill_uncovered, draft_slicers, plan, checkpoint, fingerprint)
 
             empty_cache(self.device)
             # revert padding
@@ -677,13 +1572,54 @@ def predict_entry_point_modelfolder():
                              'have the same name as their source images.')
     parser.add_argument('-m', type=str, required=True,
                         help='Folder in which the trained model is. Must have subfolders fold_X for the different '
-                             'folds you trained')
+                             'folds you trained. Can also be an inference package created with '
+                             'nnUNetv2_export_inference_package')
     parser.add_argument('-f', nargs='+', type=str, required=False, default=(0, 1, 2, 3, 4),
                         help='Specify the folds of the trained model that should be used for prediction. '
                              'Default: (0, 1, 2, 3, 4)')
     parser.add_argument('-step_size', type=float, required=False, default=0.5,
                         help='Step size for sliding window prediction. The larger it is the faster but less accurate '
                              'the prediction. Default: 0.5. Cannot be larger than 1. We recommend the default.')
+    parser.add_argument('-tile_batch_size', type=int, required=False, default=None,
+                        help='Maximum batch size of a forward pass. Sliding window tiles and their mirrored views (test '
+                             'time augmentation) are predicted together. Default: determined automatically from the '
+                             'available (V)RAM')
+    parser.add_argument('-refinement_margin', type=float, required=False, default=None,
+                        help='Enables the adaptive sliding window: a draft is predicted with non-overlapping tiles and '
+                             'overlapping tiles are only added where the draft is uncertain (margin between the two '
+                             'most likely classes below this value) or where foreground lies on a tile seam. Larger '
+                             'is more accurate but slower. Try 0.3. Default: None (regular sliding window)')
+    parser.add_argument('-accumulator_folder', type=str, required=False, default=None,
+                        help='If set, the sliding window results arrays are kept in memory mapped files in this '
+                             'folder whenever they are on the CPU. Use this for very large volumes that do not fit '
+                             'into RAM. Should be a fast local disk. Default: None (keep everything in RAM)')
+    parser.add_argument('-ram_budget_gb', type=float, required=False, default=None,
+                        help='RAM budget in GB. If set (or -vram_budget_gb), tile batch size, accumulator dtype and '
+                             'location (device, RAM, memory mapped), streaming export and the number of concurrent '
+                             'exports are chosen per case so that the predicted peak memory fits. Cases that cannot '
+                             'fit fail before they are predicted. Default: None (no planning)')
+    parser.add_argument('-vram_budget_gb', type=float, required=False, default=None,
+                        help='GPU memory budget in GB, see -ram_budget_gb. Default: the free memory of the GPU if '
+                             '-ram_budget_gb is set')
+    parser.add_argument('-cpu_engine', type=str, required=False, default=None, choices=CPU_ENGINE_BACKENDS,
+                        help='Only for -device cpu. Exports the network and runs it with torchscript or onnxruntime '
+                             'instead of eager PyTorch. Default: None (eager)')
+    parser.add_argument('-cpu_quantization', type=str, required=False, default=None,
+                        choices=CPU_ENGINE_QUANTIZATION,
+                        help='int8 quantization for -cpu_engine. static needs -calibration_folder, dynamic is only '
+                             'available with onnxruntime. Costs accuracy, check with '
+                             'nnUNetv2_check_cpu_engine_accuracy first! Default: None (fp32)')
+    parser.add_argument('-calibration_folder', type=str, required=False, default=None,
+                        help='Folder with a few representative images (same naming as -i) used to calibrate '
+                             '-cpu_quantization static. Default: None')
+    parser.add_argument('-roi_file', type=str, required=False, default=None,
+                        help='json file with {case identifier: roi}. These cases are only predicted inside their roi '
+                             '(bounding box [[x_start, x_end], [y_start, y_end], [z_start, z_end]] in voxel coordinates '
+                             'of the input image, end exclusive), the rest of the segmentation is background. Cases '
+                             'not in the file are predicted as usual. Default: None')
+    parser.add_argument('-roi_margin', type=int, required=False, default=None,
+                        help='Context (in preprocessed voxels) predicted around each roi. Default: half the patch '
+                             'size')
     parser.add_argument('--disable_tta', action='store_true', required=False, default=False,
                         help='Set this flag to disable test time data augmentation in the form of mirroring. Faster, '
                              'but less accurate inference. Not recommended.')
@@ -694,6 +1630,15 @@ def predict_entry_point_modelfolder():
                              'multiple configurations.')
     parser.add_argument('--continue_prediction', '--c', action='store_true',
                         help='Continue an aborted previous prediction (will not overwrite existing files)')
+    parser.add_argument('--manifest', action='store_true',
+                        help='Keep track of finished cases in prediction_manifest.json in the output folder (input '
+                             'hashes, model fingerprint, outputs). Together with --continue_prediction only valid '
+                             'outputs are skipped: partially written outputs and outputs of changed inputs or a '
+                             'different model/settings are predicted again')
+    parser.add_argument('--size_aware_scheduling', action='store_true',
+                        help='Estimate the cost of each case from its image header, predict the most expensive cases '
+                             'first and split the cases into -num_parts parts of similar total cost (instead of '
+                             'every num_parts-th case). All parts must use this flag')
     parser.add_argument('-chk', type=str, required=False, default='checkpoint_final.pth',
                         help='Name of the checkpoint you want to use. Default: checkpoint_final.pth')
     parser.add_argument('-npp', type=int, required=False, default=3,
@@ -711,6 +1656,15 @@ def predict_entry_point_modelfolder():
     parser.add_argument('--disable_progress_bar', action='store_true', required=False, default=False,
                         help='Set this flag to disable progress bar. Recommended for HPC environments (non interactive '
                              'jobs)')
+    parser.add_argument('-log_level', type=str, required=False, default='info', choices=['debug', 'info', 'warning'],
+                        help='debug also prints messages that are only interesting for debugging. Default: info')
+    parser.add_argument('-trace_file', type=str, required=False, default=None,
+                        help='Append the timings of all inference stages (read, preprocessing, forward passes, '
+                             'export, ...) and the peak memory usage per case to this file (jsonl). Summarize it with '
+                             'nnUNetv2_trace_summary. Default: None (no tracing)')
+    parser.add_argument('-chrome_trace_file', type=str, required=False, default=None,
+                        help='Only with -trace_file: in the end also convert the trace into a Chrome trace '
+                             '(chrome://tracing, https://ui.perfetto.dev). Default: None')
 
     print(
         "\n#######################################################################\nPlease cite the following paper "
@@ -721,6 +1675,10 @@ def predict_entry_point_modelfolder():
 
     args = parser.parse_args()
     args.f = [i if i == 'all' else int(i) for i in args.f]
+    set_log_level(args.log_level)
+    assert args.chrome_trace_file is None or args.trace_file is not None, '-chrome_trace_file needs -trace_file'
+    if args.trace_file is not None:
+        enable_tracing(args.trace_file)
 
     if not isdir(args.o):
         maybe_mkdir_p(args.o)
@@ -747,14 +1705,32 @@ def predict_entry_point_modelfolder():
                                 device=device,
                                 verbose=args.verbose,
                                 allow_tqdm=not args.disable_progress_bar,
-                                verbose_preprocessing=args.verbose)
-    predictor.initialize_from_trained_model_folder(args.m, args.f, args.chk)
+                                verbose_preprocessing=args.verbose,
+                                tile_batch_size=args.tile_batch_size,
+                                refinement_margin=args.refinement_margin,
+                                accumulator_folder=args.accumulator_folder,
+                                cpu_engine=args.cpu_engine,
+                                cpu_engine_quantization=args.cpu_quantization,
+                                ram_budget_gb=args.ram_budget_gb,
+                                vram_budget_gb=args.vram_budget_gb)
+    if is_inference_package(args.m):
+        predictor.initialize_from_inference_package(args.m, args.f)
+    else:
+        predictor.initialize_from_trained_model_folder(args.m, args.f, args.chk)
+    if args.calibration_folder is not None:
+        predictor.calibrate_cpu_engine(args.calibration_folder)
     predictor.predict_from_files(args.i, args.o, save_probabilities=args.save_probabilities,
                                  overwrite=not args.continue_prediction,
                                  num_processes_preprocessing=args.npp,
                                  num_processes_segmentation_export=args.nps,
                                  folder_with_segs_from_prev_stage=args.prev_stage_predictions,
-                                 num_parts=1, part_id=0)
+                                 num_parts=1, part_id=0,
+                                 rois=load_json(args.roi_file) if args.roi_file is not None else None,
+                                 roi_margin=args.roi_margin,
+                                 use_manifest=args.manifest,
+                                 size_aware_scheduling=args.size_aware_scheduling)
+    if args.chrome_trace_file is not None:
+        write_chrome_trace(args.trace_file, args.chrome_trace_file)
 
 
 def predict_entry_point():
@@ -785,6 +1761,46 @@ def predict_entry_point():
     parser.add_argument('-step_size', type=float, required=False, default=0.5,
                         help='Step size for sliding window prediction. The larger it is the faster but less accurate '
                              'the prediction. Default: 0.5. Cannot be larger than 1. We recommend the default.')
+    parser.add_argument('-tile_batch_size', type=int, required=False, default=None,
+                        help='Maximum batch size of a forward pass. Sliding window tiles and their mirrored views (test '
+                             'time augmentation) are predicted together. Default: determined automatically from the '
+                             'available (V)RAM')
+    parser.add_argument('-refinement_margin', type=float, required=False, default=None,
+                        help='Enables the adaptive sliding window: a draft is predicted with non-overlapping tiles and '
+                             'overlapping tiles are only added where the draft is uncertain (margin between the two '
+                             'most likely classes below this value) or where foreground lies on a tile seam. Larger '
+                             'is more accurate but slower. Try 0.3. Default: None (regular sliding window)')
+    parser.add_argument('-accumulator_folder', type=str, required=False, default=None,
+                        help='If set, the sliding window results arrays are kept in memory mapped files in this '
+                             'folder whenever they are on the CPU. Use this for very large volumes that do not fit '
+                             'into RAM. Should be a fast local disk. Default: None (keep everything in RAM)')
+    parser.add_argument('-ram_budget_gb', type=float, required=False, default=None,
+                        help='RAM budget in GB. If set (or -vram_budget_gb), tile batch size, accumulator dtype and '
+                             'location (device, RAM, memory mapped), streaming export and the number of concurrent '
+                             'exports are chosen per case so that the predicted peak memory fits. Cases that cannot '
+                             'fit fail before they are predicted. Default: None (no planning)')
+    parser.add_argument('-vram_budget_gb', type=float, required=False, default=None,
+                        help='GPU memory budget in GB, see -ram_budget_gb. Default: the free memory of the GPU if '
+                             '-ram_budget_gb is set')
+    parser.add_argument('-cpu_engine', type=str, required=False, default=None, choices=CPU_ENGINE_BACKENDS,
+                        help='Only for -device cpu. Exports the network and runs it with torchscript or onnxruntime '
+                             'instead of eager PyTorch. Default: None (eager)')
+    parser.add_argument('-cpu_quantization', type=str, required=False, default=None,
+                        choices=CPU_ENGINE_QUANTIZATION,
+                        help='int8 quantization for -cpu_engine. static needs -calibration_folder, dynamic is only '
+                             'available with onnxruntime. Costs accuracy, check with '
+                             'nnUNetv2_check_cpu_engine_accuracy first! Default: None (fp32)')
+    parser.add_argument('-calibration_folder', type=str, required=False, default=None,
+                        help='Folder with a few representative images (same naming as -i) used to calibrate '
+                             '-cpu_quantization static. Default: None')
+    parser.add_argument('-roi_file', type=str, required=False, default=None,
+                        help='json file with {case identifier: roi}. These cases are only predicted inside their roi '
+                             '(bounding box [[x_start, x_end], [y_start, y_end], [z_start, z_end]] in voxel coordinates '
+                             'of the input image, end exclusive), the rest of the segmentation is background. Cases '
+                             'not in the file are predicted as usual. Default: None')
+    parser.add_argument('-roi_margin', type=int, required=False, default=None,
+                        help='Context (in preprocessed voxels) predicted around each roi. Default: half the patch '
+                             'size')
     parser.add_argument('--disable_tta', action='store_true', required=False, default=False,
                         help='Set this flag to disable test time data augmentation in the form of mirroring. Faster, '
                              'but less accurate inference. Not recommended.')
@@ -795,6 +1811,15 @@ def predict_entry_point():
                              'multiple configurations.')
     parser.add_argument('--continue_prediction', action='store_true',
                         help='Continue an aborted previous prediction (will not overwrite existing files)')
+    parser.add_argument('--manifest', action='store_true',
+                        help='Keep track of finished cases in prediction_manifest.json in the output folder (input '
+                             'hashes, model fingerprint, outputs). Together with --continue_prediction only valid '
+                             'outputs are skipped: partially written outputs and outputs of changed inputs or a '
+                             'different model/settings are predicted again')
+    parser.add_argument('--size_aware_scheduling', action='store_true',
+                        help='Estimate the cost of each case from its image header, predict the most expensive cases '
+                             'first and split the cases into -num_parts parts of similar total cost (instead of '
+                             'every num_parts-th case). All parts must use this flag')
     parser.add_argument('-chk', type=str, required=False, default='checkpoint_final.pth',
                         help='Name of the checkpoint you want to use. Default: checkpoint_final.pth')
     parser.add_argument('-npp', type=int, required=False, default=3,
@@ -804,7 +1829,12 @@ def predict_entry_point():
                         help='Number of processes used for segmentation export. More is not always better. Beware of '
                              'out-of-RAM issues. Default: 3')
     parser.add_argument('-prev_stage_predictions', type=str, required=False, default=None,
-                        help='Folder containing the predictions of the previous stage. Required for cascaded models.')
+                        help='Folder containing the predictions of the previous stage. For cascaded models. If not '
+                             'given, the previous stage is predicted in the same process and its result is passed on '
+                             'in memory (nothing is written to disk unless you set -prev_stage_output)')
+    parser.add_argument('-prev_stage_output', type=str, required=False, default=None,
+                        help='Only for cascaded models without -prev_stage_predictions: also export the '
+                             'segmentations of the previous stage to this folder. Default: None')
     parser.add_argument('-num_parts', type=int, required=False, default=1,
                         help='Number of separate nnUNetv2_predict call that you will be making. Default: 1 (= this one '
                              'call predicts everything)')
@@ -820,6 +1850,15 @@ def predict_entry_point():
     parser.add_argument('--disable_progress_bar', action='store_true', required=False, default=False,
                         help='Set this flag to disable progress bar. Recommended for HPC environments (non interactive '
                              'jobs)')
+    parser.add_argument('-log_level', type=str, required=False, default='info', choices=['debug', 'info', 'warning'],
+                        help='debug also prints messages that are only interesting for debugging. Default: info')
+    parser.add_argument('-trace_file', type=str, required=False, default=None,
+                        help='Append the timings of all inference stages (read, preprocessing, forward passes, '
+                             'export, ...) and the peak memory usage per case to this file (jsonl). Summarize it with '
+                             'nnUNetv2_trace_summary. Default: None (no tracing)')
+    parser.add_argument('-chrome_trace_file', type=str, required=False, default=None,
+                        help='Only with -trace_file: in the end also convert the trace into a Chrome trace '
+                             '(chrome://tracing, https://ui.perfetto.dev). Default: None')
 
     print(
         "\n#######################################################################\nPlease cite the following paper "
@@ -830,6 +1869,10 @@ def predict_entry_point():
 
     args = parser.parse_args()
     args.f = [i if i == 'all' else int(i) for i in args.f]
+    set_log_level(args.log_level)
+    assert args.chrome_trace_file is None or args.trace_file is not None, '-chrome_trace_file needs -trace_file'
+    if args.trace_file is not None:
+        enable_tracing(args.trace_file)
 
     model_folder = get_output_folder(args.d, args.tr, args.p, args.c)
 
@@ -854,26 +1897,65 @@ def predict_entry_point():
     else:
         device = torch.device('mps')
 
-    predictor = nnUNetPredictor(tile_step_size=args.step_size,
-                                use_gaussian=True,
-                                use_mirroring=not args.disable_tta,
-                                perform_everything_on_device=True,
-                                device=device,
-                                verbose=args.verbose,
-                                verbose_preprocessing=args.verbose,
-                                allow_tqdm=not args.disable_progress_bar)
+    predictor_kwargs = dict(tile_step_size=args.step_size,
+                            use_gaussian=True,
+                            use_mirroring=not args.disable_tta,
+                            perform_everything_on_device=True,
+                            device=device,
+                            verbose=args.verbose,
+                            verbose_preprocessing=args.verbose,
+                            allow_tqdm=not args.disable_progress_bar,
+                            tile_batch_size=args.tile_batch_size,
+                            refinement_margin=args.refinement_margin,
+                            accumulator_folder=args.accumulator_folder,
+                            cpu_engine=args.cpu_engine,
+                            cpu_engine_quantization=args.cpu_quantization,
+                            ram_budget_gb=args.ram_budget_gb,
+                            vram_budget_gb=args.vram_budget_gb)
+    predictor = nnUNetPredictor(**predictor_kwargs)
     predictor.initialize_from_trained_model_folder(
         model_folder,
         args.f,
         checkpoint_name=args.chk
     )
-    predictor.predict_from_files(args.i, args.o, save_probabilities=args.save_probabilities,
-                                 overwrite=not args.continue_prediction,
-                                 num_processes_preprocessing=args.npp,
-                                 num_processes_segmentation_export=args.nps,
-                                 folder_with_segs_from_prev_stage=args.prev_stage_predictions,
-                                 num_parts=args.num_parts,
-                                 part_id=args.part_id)
+    if args.calibration_folder is not None:
+        predictor.calibrate_cpu_engine(args.calibration_folder)
+    previous_stage_name = predictor.configuration_manager.previous_stage_name
+    if previous_stage_name is not None and args.prev_stage_predictions is None:
+        from nnunetv2.inference.predict_cascade import nnUNetCascadePredictor
+        assert args.roi_file is None, '-roi_file is not supported when predicting the cascade in one process'
+        assert not args.manifest, '--manifest is not supported when predicting the cascade in one process'
+        assert args.ram_budget_gb is None and args.vram_budget_gb is None, \
+            '-ram_budget_gb and -vram_budget_gb are not supported when predicting the cascade in one process'
+        print(f'No -prev_stage_predictions given. Predicting the previous stage ({previous_stage_name}) in the same '
+              f'process')
+        previous_stage_predictor = nnUNetPredictor(**predictor_kwargs)
+        previous_stage_predictor.initialize_from_trained_model_folder(
+            get_output_folder(args.d, args.tr, args.p, previous_stage_name),
+            args.f,
+            checkpoint_name=args.chk
+        )
+        if args.calibration_folder is not None:
+            previous_stage_predictor.calibrate_cpu_engine(args.calibration_folder)
+        nnUNetCascadePredictor(previous_stage_predictor, predictor).predict_from_files(
+            args.i, args.o, save_probabilities=args.save_probabilities, overwrite=not args.continue_prediction,
+            num_processes_segmentation_export=args.nps, num_parts=args.num_parts, part_id=args.part_id,
+            output_folder_previous_stage=args.prev_stage_output, size_aware_scheduling=args.size_aware_scheduling,
+            num_processes_preprocessing=args.npp)
+    else:
+        predictor.predict_from_files(args.i, args.o, save_probabilities=args.save_probabilities,
+                                     overwrite=not args.continue_prediction,
+                                     num_processes_preprocessing=args.npp,
+                                     num_processes_segmentation_export=args.nps,
+                                     folder_with_segs_from_prev_stage=args.prev_stage_predictions,
+                                     num_parts=args.num_parts,
+                                     part_id=args.part_id,
+                                     rois=load_json(args.roi_file) if args.roi_file is not None else None,
+                                     roi_margin=args.roi_margin,
+                                     use_manifest=args.manifest,
+                                     size_aware_scheduling=args.size_aware_scheduling)
+    if args.chrome_trace_file is not None:
+        write_chrome_trace(args.trace_file, args.chrome_trace_file)
     # r = predict_from_raw_data(args.i,
     #                           args.o,
     #                           model_folder,
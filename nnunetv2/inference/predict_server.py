@@ -0,0 +1,513 @@
+import io
+import json
+import os
+import threading
+import traceback
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from time import time
+from typing import Callable, Tuple, Union, List, Optional
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import torch
+
+from nnunetv2.inference.data_iterators import get_nonzero_mask_from_seg
+from nnunetv2.inference.export_prediction import convert_predicted_logits_to_segmentation_with_correct_shape
+from nnunetv2.inference.inference_package import is_inference_package
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.inference.tile_batch_scheduler import TileBatchScheduler
+from nnunetv2.utilities.helpers import dummy_context, empty_cache
+
+
+class StageTimings(object):
+    def __init__(self):
+        """
+        Keeps count, total and last duration (in seconds) per stage. Thread safe
+        """
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def add(self, stage: str, duration: float):
+        with self._lock:
+            s = self._stages.setdefault(stage, {'count': 0, 'total_s': 0., 'last_s': 0.})
+            s['count'] += 1
+            s['total_s'] += duration
+            s['last_s'] = duration
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {k: dict(v, mean_s=v['total_s'] / v['count']) for k, v in self._stages.items()}
+
+
+class ResidentPredictor(object):
+    def __init__(self, model_folder: str, folds: Union[Tuple[Union[int, str], ...], None], checkpoint_name: str,
+                 predictor_kwargs: dict, tile_batch_scheduler_kwargs: Optional[dict] = None,
+                 on_initialization_error: Optional[Callable[['ResidentPredictor'], None]] = None):
+        """
+        A nnUNetPredictor that stays initialized for as long as the server runs. Requests for the same model are
+        processed one at a time (the predictor is not thread safe), requests for different models run in parallel.
+
+        If tile_batch_scheduler_kwargs is not None (can be an empty dict), a TileBatchScheduler with these kwargs is
+        attached to the predictor. Then requests for the same model run concurrently and share forward passes
+
+        on_initialization_error is called with this object if the predictor could not be initialized (the pool uses
+        it to forget the model)
+        """
+        self.model_folder, self.folds, self.checkpoint_name = model_folder, folds, checkpoint_name
+        self.predictor_kwargs = predictor_kwargs
+        self.tile_batch_scheduler_kwargs = tile_batch_scheduler_kwargs
+        self.on_initialization_error = on_initialization_error
+        self.predictor: Optional[nnUNetPredictor] = None
+        self.tile_batch_scheduler: Optional[TileBatchScheduler] = None
+        self.lock = threading.Lock()
+        self._counter_lock = threading.Lock()
+        self.timings = StageTimings()
+        self.num_requests = 0
+        self.num_errors = 0
+        self.num_active_requests = 0
+        self.loaded_at = None
+        # set by the pool when it drops this model. Requests that already got it still run, the last one unloads it
+        self.evicted = False
+
+    @property
+    def status(self) -> str:
+        # cold: not loaded yet. loaded: network and weights are resident. warm: at least one prediction went through
+        # (cudnn autotuning, torch.compile, lazy allocations etc are done)
+        if self.predictor is None:
+            return 'cold'
+        return 'warm' if self.num_requests - self.num_errors > 0 else 'loaded'
+
+    @property
+    def busy(self) -> bool:
+        return self.num_active_requests > 0 or self.lock.locked()
+
+    def _maybe_initialize(self):
+        if self.predictor is not None:
+            return
+        st = time()
+        predictor = nnUNetPredictor(**self.predictor_kwargs)
+        try:
+            if is_inference_package(self.model_folder):
+                predictor.initialize_from_inference_package(self.model_folder, self.folds)
+            else:
+                predictor.initialize_from_trained_model_folder(self.model_folder, self.folds, self.checkpoint_name)
+        except Exception:
+            if self.on_initialization_error is not None:
+                self.on_initialization_error(self)
+            raise
+        if self.tile_batch_scheduler_kwargs is not None:
+            self.tile_batch_scheduler = TileBatchScheduler(predictor, **self.tile_batch_scheduler_kwargs)
+        self.predictor = predictor
+        self.loaded_at = time()
+        self.timings.add('initialization', self.loaded_at - st)
+
+    def initialize(self):
+        with self.lock:
+            self._maybe_initialize()
+
+    def unload(self):
+        """
+        frees the predictor (and stops the tile batch scheduler). The next request loads it again. Does nothing
+        while requests are running, with evicted set the last of them unloads
+        """
+        with self.lock:
+            if self.num_active_requests > 0:
+                return
+            if self.tile_batch_scheduler is not None:
+                self.tile_batch_scheduler.shutdown()
+                self.tile_batch_scheduler = None
+            self.predictor = None
+            self.loaded_at = None
+
+    def predict(self, image: Union[List[str], np.ndarray], properties: Optional[dict] = None,
+                output_file: Optional[str] = None) -> Tuple[Optional[np.ndarray], dict]:
+        """
+        image is either a list of files (one per input channel) or an array (c, x, y, z) that was loaded the way
+        nnU-Net loads images (see predict_single_npy_array), in which case properties must contain 'spacing'.
+
+        Writes the segmentation to output_file (full file name, including file ending) if given, otherwise returns
+        it. Also returns the timings of this request
+        """
+        timings = {}
+        with self._counter_lock:
+            self.num_requests += 1
+            self.num_active_requests += 1
+        try:
+            with self.lock:
+                if self.predictor is None:
+                    st = time()
+                    self._maybe_initialize()
+                    timings['initialization'] = time() - st
+        except Exception:
+            with self._counter_lock:
+                self.num_errors += 1
+                self.num_active_requests -= 1
+            raise
+        try:
+            # with a tile batch scheduler, requests run concurrently and share forward passes
+            with self.lock if self.tile_batch_scheduler is None else dummy_context():
+                try:
+                    p = self.predictor
+
+                    st = time()
+                    if not isinstance(image, np.ndarray):
+                        image, properties = p.plans_manager.image_reader_writer_class().read_images(image)
+                        timings['read'] = time() - st
+
+                    st = time()
+                    preprocessor = p.configuration_manager.preprocessor_class(verbose=p.verbose_preprocessing)
+                    data, seg = preprocessor.run_case_npy(image, None, properties, p.plans_manager,
+                                                          p.configuration_manager, p.dataset_json)
+                    nonzero_mask = get_nonzero_mask_from_seg(seg) if p.tile_skip_threshold is not None else None
+                    del image, seg
+                    timings['preprocessing'] = time() - st
+
+                    st = time()
+                    logits = p.predict_logits_from_preprocessed_data(torch.from_numpy(data), nonzero_mask).cpu()
+                    del data
+                    timings['prediction'] = time() - st
+
+                    st = time()
+                    segmentation = convert_predicted_logits_to_segmentation_with_correct_shape(
+                        logits, p.plans_manager, p.configuration_manager, p.label_manager, properties)
+                    del logits
+                    if output_file is not None:
+                        p.plans_manager.image_reader_writer_class().write_seg(segmentation, output_file, properties)
+                        segmentation = None
+                    timings['export'] = time() - st
+                except Exception:
+                    with self._counter_lock:
+                        self.num_errors += 1
+                    raise
+                finally:
+                    with self._counter_lock:
+                        self.num_active_requests -= 1
+                for k, v in timings.items():
+                    # initialization is recorded by _maybe_initialize
+                    if k != 'initialization':
+                        self.timings.add(k, v)
+                return segmentation, timings
+        finally:
+            if self.evicted and self.num_active_requests == 0:
+                self.unload()
+            elif self.num_active_requests == 0 and self.predictor is not None:
+                # don't keep an image sized normalization map on the device while the model is idle
+                predictor = self.predictor
+                predictor.normalization_map_cache.clear()
+                empty_cache(predictor.device)
+
+    def as_dict(self) -> dict:
+        return {
+            'model_folder': self.model_folder,
+            'folds': list(self.folds) if self.folds is not None else None,
+            'checkpoint_name': self.checkpoint_name,
+            'status': self.status,
+            'busy': self.busy,
+            'active_requests': self.num_active_requests,
+            'tile_batch_scheduler': self.tile_batch_scheduler.as_dict() if self.tile_batch_scheduler is not None
+            else None,
+            'loaded_at': self.loaded_at,
+            'num_requests': self.num_requests,
+            'num_errors': self.num_errors,
+            'timings': self.timings.as_dict()
+        }
+
+
+class ResidentPredictorPool(object):
+    def __init__(self, predictor_kwargs: dict, tile_batch_scheduler_kwargs: Optional[dict] = None,
+                 max_resident_models: Optional[int] = None, load_on_request: bool = True):
+        """
+        max_resident_models: if more models are requested, the least recently used ones that are not busy are
+        unloaded. None means no limit. Models that could not be initialized are forgotten right away.
+
+        load_on_request=False only serves the models that were added with add (at startup), requests for other
+        models are rejected
+        """
+        assert max_resident_models is None or max_resident_models > 0
+        self.predictor_kwargs = predictor_kwargs
+        self.tile_batch_scheduler_kwargs = tile_batch_scheduler_kwargs
+        self.max_resident_models = max_resident_models
+        self.load_on_request = load_on_request
+        self._lock = threading.Lock()
+        # least recently used first
+        self._predictors = OrderedDict()
+        self.started_at = time()
+
+    @staticmethod
+    def _key(model_folder: str, folds, checkpoint_name: str):
+        return (os.path.abspath(model_folder), tuple(folds) if folds is not None else None, checkpoint_name)
+
+    def get(self, model_folder: str, folds: Union[Tuple[Union[int, str], ...], None] = (0, 1, 2, 3, 4),
+            checkpoint_name: str = 'checkpoint_final.pth') -> ResidentPredictor:
+        """
+        raises a KeyError if the model is not resident and load_on_request is False
+        """
+        return self._get(self._key(model_folder, folds, checkpoint_name), self.load_on_request)
+
+    def add(self, model_folder: str, folds: Union[Tuple[Union[int, str], ...], None] = (0, 1, 2, 3, 4),
+            checkpoint_name: str = 'checkpoint_final.pth') -> ResidentPredictor:
+        """
+        same as get but also adds the model if load_on_request is False. Initialize the returned predictor to load
+        it right away
+        """
+        return self._get(self._key(model_folder, folds, checkpoint_name), True)
+
+    def _get(self, key: tuple, create: bool) -> ResidentPredictor:
+        with self._lock:
+            if key not in self._predictors:
+                if not create:
+                    raise KeyError(f'model {key} is not served by this server (it only serves the models it was '
+                                   f'started with)')
+                self._predictors[key] = ResidentPredictor(*key, predictor_kwargs=self.predictor_kwargs,
+                                                          tile_batch_scheduler_kwargs=self.tile_batch_scheduler_kwargs,
+                                                          on_initialization_error=self._discard)
+            self._predictors.move_to_end(key)
+            predictor = self._predictors[key]
+            evicted = self._evict()
+        # not while holding self._lock, unload waits for the predictor's lock
+        for i in evicted:
+            i.unload()
+        if len(evicted) > 0:
+            empty_cache(self.predictor_kwargs.get('device', torch.device('cuda')))
+        return predictor
+
+    def _evict(self) -> List[ResidentPredictor]:
+        """
+        must hold self._lock. Drops the least recently used models that are not busy until at most
+        max_resident_models are left (the most recently used one is never dropped) and returns them, unload them
+        afterwards. Busy models stay, so the limit can be exceeded for as long as their requests take. Requests that
+        got a model before it was dropped still run, the last one unloads it
+        """
+        if self.max_resident_models is None:
+            return []
+        evicted = []
+        for key in list(self._predictors.keys())[:-1]:
+            if len(self._predictors) <= self.max_resident_models:
+                break
+            if not self._predictors[key].busy:
+                print(f'unloading {key[0]} (folds {key[1]}, {key[2]}), at most {self.max_resident_models} models '
+                      f'are kept resident')
+                predictor = self._predictors.pop(key)
+                predictor.evicted = True
+                evicted.append(predictor)
+        return evicted
+
+    def _discard(self, predictor: ResidentPredictor):
+        with self._lock:
+            key = self._key(predictor.model_folder, predictor.folds, predictor.checkpoint_name)
+            if self._predictors.get(key) is predictor:
+                del self._predictors[key]
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            predictors = list(self._predictors.values())
+        return {
+            'status': 'ok',
+            'uptime_s': time() - self.started_at,
+            'models': [i.as_dict() for i in predictors]
+        }
+
+
+def _parse_folds(folds) -> Union[Tuple[Union[int, str], ...], None]:
+    if folds is None:
+        return (0, 1, 2, 3, 4)
+    if isinstance(folds, str):
+        folds = folds.split(',')
+    return tuple([i if i == 'all' else int(i) for i in folds])
+
+
+class PredictionRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET  /health, /metrics: status of the resident models (cold/loaded/warm) and per-stage timings
+    POST /predict: JSON body {"model_folder": str, "folds": [0, 1] (optional), "checkpoint_name": str (optional),
+         "input_files": [str, ...], "output_file": str (optional)}. If output_file is given the segmentation is
+         written there and the response is JSON, otherwise the segmentation is returned as .npy
+    POST /predict_npy?model_folder=...&spacing=1,0.7,0.7[&folds=0,1][&checkpoint_name=...]: the body is an image
+         (c, x, y, z) in .npy format, the response is the segmentation in .npy format
+
+    Timings of the request are in the X-nnUNet-Timings header (JSON)
+    """
+    pool: ResidentPredictorPool = None
+    verbose: bool = False
+
+    def address_string(self):
+        # client_address is a str for unix sockets
+        return str(self.client_address[0]) if isinstance(self.client_address, tuple) else 'unix'
+
+    def log_message(self, format, *args):
+        if self.verbose:
+            super().log_message(format, *args)
+
+    def _send(self, code: int, body: bytes, content_type: str, headers: Optional[dict] = None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        # write in chunks so that large segmentations don't need a second copy in the socket buffer
+        view = memoryview(body)
+        for i in range(0, len(body), 1 << 20):
+            self.wfile.write(view[i:i + (1 << 20)])
+
+    def _send_json(self, code: int, obj: dict, headers: Optional[dict] = None):
+        self._send(code, json.dumps(obj).encode(), 'application/json', headers)
+
+    def _send_segmentation(self, segmentation: Optional[np.ndarray], timings: dict, output_file: Optional[str]):
+        headers = {'X-nnUNet-Timings': json.dumps(timings)}
+        if segmentation is None:
+            self._send_json(200, {'output_file': output_file, 'timings': timings}, headers)
+        else:
+            buffer = io.BytesIO()
+            np.save(buffer, segmentation)
+            self._send(200, buffer.getvalue(), 'application/octet-stream', headers)
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path in ('/health', '/metrics'):
+            self._send_json(200, self.pool.as_dict())
+        else:
+            self._send_json(404, {'error': f'unknown endpoint {path}'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        try:
+            if url.path == '/predict':
+                request = json.loads(self._read_body())
+                predictor = self.pool.get(request['model_folder'], _parse_folds(request.get('folds')),
+                                          request.get('checkpoint_name', 'checkpoint_final.pth'))
+                segmentation, timings = predictor.predict(request['input_files'],
+                                                          output_file=request.get('output_file'))
+                self._send_segmentation(segmentation, timings, request.get('output_file'))
+            elif url.path == '/predict_npy':
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                predictor = self.pool.get(query['model_folder'], _parse_folds(query.get('folds')),
+                                          query.get('checkpoint_name', 'checkpoint_final.pth'))
+                image = np.load(io.BytesIO(self._read_body()), allow_pickle=False)
+                properties = {'spacing': [float(i) for i in query['spacing'].split(',')]}
+                segmentation, timings = predictor.predict(image, properties)
+                self._send_segmentation(segmentation, timings, None)
+            else:
+                self._send_json(404, {'error': f'unknown endpoint {url.path}'})
+        except (KeyError, ValueError, json.JSONDecodeError) as e:
+            self._send_json(400, {'error': f'bad request: {repr(e)}'})
+        except Exception as e:
+            traceback.print_exc()
+            self._send_json(500, {'error': repr(e)})
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def make_prediction_server(pool: ResidentPredictorPool, host: str = '127.0.0.1', port: int = 8000,
+                           unix_socket: Optional[str] = None, verbose: bool = False):
+    """
+    Returns a server (call serve_forever on it) that answers prediction requests with the resident predictors in
+    pool. If unix_socket is given we listen there instead of host:port
+    """
+    handler = type('Handler', (PredictionRequestHandler,), {'pool': pool, 'verbose': verbose})
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        return ThreadingUnixHTTPServer(unix_socket, handler)
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def predict_server_entry_point():
+    import argparse
+    parser = argparse.ArgumentParser(description='Keeps nnU-Net models resident and serves predictions over HTTP '
+                                                 '(TCP or unix socket). Saves the start up cost (building the '
+                                                 'network, loading checkpoints) for every request. '
+                                                 'Endpoints: GET /health, GET /metrics, POST /predict, '
+                                                 'POST /predict_npy. See PredictionRequestHandler for details')
+    parser.add_argument('-host', type=str, required=False, default='127.0.0.1',
+                        help='Host to listen on. Default: 127.0.0.1')
+    parser.add_argument('-port', type=int, required=False, default=8000,
+                        help='Port to listen on. Default: 8000')
+    parser.add_argument('-unix_socket', type=str, required=False, default=None,
+                        help='Listen on this unix socket instead of host:port')
+    parser.add_argument('-m', nargs='*', type=str, required=False, default=[],
+                        help='Model folders to load at startup (with -f and -chk). Other models are loaded on their '
+                             'first request')
+    parser.add_argument('-f', nargs='+', type=str, required=False, default=(0, 1, 2, 3, 4),
+                        help='Folds of the models given with -m. Default: (0, 1, 2, 3, 4)')
+    parser.add_argument('-chk', type=str, required=False, default='checkpoint_final.pth',
+                        help='Checkpoint of the models given with -m. Default: checkpoint_final.pth')
+    parser.add_argument('-max_resident_models', type=int, required=False, default=None,
+                        help='Keep at most this many models in memory, the least recently used ones are unloaded. '
+                             'Default: no limit')
+    parser.add_argument('--only_startup_models', action='store_true', required=False, default=False,
+                        help='Only serve the models given with -m, reject requests for other models instead of '
+                             'loading them')
+    parser.add_argument('-step_size', type=float, required=False, default=0.5,
+                        help='Step size for sliding window prediction. Default: 0.5')
+    parser.add_argument('-tile_batch_size', type=int, required=False, default=None,
+                        help='Maximum batch size of a forward pass. Default: determined automatically')
+    parser.add_argument('--disable_tta', action='store_true', required=False, default=False,
+                        help='Disable test time data augmentation (mirroring)')
+    parser.add_argument('--batch_across_requests', action='store_true', required=False, default=False,
+                        help='Let concurrent requests for the same model run at the same time and share forward '
+                             'passes (see TileBatchScheduler) instead of processing them one at a time')
+    parser.add_argument('-shared_batch_size', type=int, required=False, default=None,
+                        help='Only with --batch_across_requests: maximum batch size of the shared forward passes. '
+                             'Default: same as -tile_batch_size')
+    parser.add_argument('-max_batch_wait_ms', type=float, required=False, default=5.,
+                        help='Only with --batch_across_requests: how long the tiles of one request may wait for '
+                             'tiles of other requests before the forward pass starts anyway. Default: 5')
+    parser.add_argument('-device', type=str, default='cuda', required=False,
+                        help="'cuda' (GPU), 'cpu' (CPU) or 'mps' (Apple M1/M2). Default: cuda")
+    parser.add_argument('--verbose', action='store_true', help='Print request logs and more')
+    args = parser.parse_args()
+
+    assert args.device in ['cpu', 'cuda', 'mps'], \
+        f'-device must be either cpu, mps or cuda. Other devices are not tested/supported. Got: {args.device}.'
+    if args.device == 'cpu':
+        import multiprocessing
+        torch.set_num_threads(multiprocessing.cpu_count())
+        device = torch.device('cpu')
+    elif args.device == 'cuda':
+        torch.set_num_threads(1)
+        torch.set_num_interop_threads(1)
+        device = torch.device('cuda')
+    else:
+        device = torch.device('mps')
+
+    pool = ResidentPredictorPool(dict(tile_step_size=args.step_size,
+                                      use_gaussian=True,
+                                      use_mirroring=not args.disable_tta,
+                                      perform_everything_on_device=True,
+                                      device=device,
+                                      verbose=args.verbose,
+                                      verbose_preprocessing=args.verbose,
+                                      allow_tqdm=False,
+                                      tile_batch_size=args.tile_batch_size),
+                                 dict(max_batch_size=args.shared_batch_size, max_wait_ms=args.max_batch_wait_ms)
+                                 if args.batch_across_requests else None,
+                                 args.max_resident_models, not args.only_startup_models)
+    for m in args.m:
+        print(f'loading {m}')
+        pool.add(m, _parse_folds(args.f), args.chk).initialize()
+
+    server = make_prediction_server(pool, args.host, args.port, args.unix_socket, args.verbose)
+    print(f'nnU-Net prediction server listening on '
+          f'{args.unix_socket if args.unix_socket is not None else f"{args.host}:{args.port}"}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.unix_socket is not None and os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+
+
+if __name__ == '__main__':
+    predict_server_entry_point()
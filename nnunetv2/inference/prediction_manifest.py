@@ -0,0 +1,164 @@
+"""
+The prediction manifest makes batch predictions resumable. It lives in the output folder and records for each
+finished case
+
+- the input files (size, mtime and sha256)
+- the model fingerprint (hash of the weights of all folds plus everything in the predictor and plans that changes the
+  result, see compute_model_fingerprint) and case specific settings (save_probabilities, roi, ...)
+- the output files (size, mtime and sha256)
+
+A case counts as done only if all of that still matches. So outputs that were partially written when a job got
+killed, outputs of a different model or of changed inputs are predicted again, everything else is skipped. Hashes
+are only recomputed if size or mtime of a file changed (touching a file does not invalidate it).
+
+The manifest is replaced atomically (temporary file + os.replace) each time a case is finished. Several processes
+(num_parts > 1) can share an output folder: each writes its own manifest file and all of them are read.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from glob import glob
+from typing import List, Optional
+
+import torch
+from batchgenerators.utilities.file_and_folder_operations import join, isfile, maybe_mkdir_p
+
+PREDICTION_MANIFEST_FORMAT_VERSION = 1
+# predictor attributes that change the prediction. Everything else (device, verbosity, tile batch size, ...) does not
+# or only within numerical noise
+_PREDICTOR_SETTINGS_IN_FINGERPRINT = ('tile_step_size', 'use_gaussian', 'use_mirroring', 'allowed_mirroring_axes',
+                                      'ensemble_folds_per_tile', 'tile_skip_threshold', 'refinement_margin',
+                                      'accumulator_dtype', 'cpu_engine', 'cpu_engine_quantization', 'trainer_name')
+
+
+def hash_file(filename: str, chunk_size: int = 1 << 22) -> str:
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def compute_model_fingerprint(predictor) -> str:
+    """
+    sha256 over the weights of all folds (in memory, so this works for checkpoints and inference packages alike),
+    the resolved configuration, the labels and the predictor settings that influence the prediction
+    """
+    h = hashlib.sha256()
+    for params in predictor.list_of_parameters:
+        for k in sorted(params.keys()):
+            v = params[k].detach().cpu().contiguous()
+            h.update(f'{k}{v.dtype}{tuple(v.shape)}'.encode())
+            h.update(v.reshape(-1).view(torch.uint8).numpy().data)
+    settings = {k: str(getattr(predictor, k, None)) for k in _PREDICTOR_SETTINGS_IN_FINGERPRINT}
+    settings['configuration'] = predictor.configuration_manager.configuration
+    settings['transpose_forward'] = predictor.plans_manager.transpose_forward
+    settings['foreground_intensity_properties_per_channel'] = \
+        predictor.plans_manager.foreground_intensity_properties_per_channel
+    settings['labels'] = predictor.dataset_json['labels']
+    settings['regions_class_order'] = predictor.dataset_json.get('regions_class_order')
+    h.update(json.dumps(settings, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+class PredictionManifest(object):
+    def __init__(self, output_folder: str, model_fingerprint: str, part_id: int = 0, num_parts: int = 1):
+        self.output_folder = output_folder
+        self.model_fingerprint = model_fingerprint
+        self.manifest_file = join(output_folder, 'prediction_manifest.json' if num_parts == 1 else
+                                  f'prediction_manifest_part{part_id}of{num_parts}.json')
+        self._lock = threading.Lock()
+        # we read the manifests of all runs that wrote into this folder (also those with a different num_parts). Oldest
+        # first so that newer entries win. We only write our own file and only with the cases from that file plus the
+        # ones we finish
+        self.cases = {}
+        self._own_cases = {}
+        for f in sorted(glob(join(output_folder, 'prediction_manifest*.json')), key=os.path.getmtime):
+            try:
+                with open(f, 'r') as fh:
+                    manifest = json.load(fh)
+            except (OSError, ValueError):
+                continue
+            if manifest.get('format_version') != PREDICTION_MANIFEST_FORMAT_VERSION:
+                continue
+            self.cases.update(manifest['cases'])
+            if f == self.manifest_file:
+                self._own_cases = manifest['cases']
+
+    def _key(self, output_file_truncated: str) -> str:
+        return os.path.relpath(os.path.abspath(output_file_truncated), os.path.abspath(self.output_folder))
+
+    @staticmethod
+    def _fingerprint_files(files: List[str], previous: Optional[List[dict]] = None) -> List[dict]:
+        """
+        previous: earlier result for the same files. Their hash is reused if size and mtime did not change
+        """
+        previous = {i['file']: i for i in previous} if previous is not None else {}
+        ret = []
+        for f in files:
+            st = os.stat(f)
+            p = previous.get(f)
+            if p is not None and p['size'] == st.st_size and p['mtime_ns'] == st.st_mtime_ns:
+                sha256 = p['sha256']
+            else:
+                sha256 = hash_file(f)
+            ret.append({'file': f, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': sha256})
+        return ret
+
+    @staticmethod
+    def _same_content(a: List[dict], b: List[dict]) -> bool:
+        return [(i['file'], i['sha256']) for i in a] == [(i['file'], i['sha256']) for i in b]
+
+    def fingerprint_inputs(self, output_file_truncated: str, input_files: List[str]) -> List[dict]:
+        entry = self.cases.get(self._key(output_file_truncated))
+        return self._fingerprint_files(input_files, entry['inputs'] if entry is not None else None)
+
+    def is_done(self, output_file_truncated: str, input_fingerprints: List[dict], output_files: List[str],
+                case_settings: dict) -> bool:
+        entry = self.cases.get(self._key(output_file_truncated))
+        if entry is None or entry['status'] != 'done' or entry['model_fingerprint'] != self.model_fingerprint or \
+                entry['case_settings'] != json.loads(json.dumps(case_settings)):
+            return False
+        if not self._same_content(entry['inputs'], input_fingerprints):
+            return False
+        if sorted([i['file'] for i in entry['outputs']]) != sorted(output_files) or \
+                not all([isfile(i) for i in output_files]):
+            return False
+        return self._same_content(entry['outputs'], self._fingerprint_files([i['file'] for i in entry['outputs']],
+                                                                            entry['outputs']))
+
+    def mark_done(self, output_file_truncated: str, input_fingerprints: List[dict], output_files: List[str],
+                  case_settings: dict):
+        """
+        call this once all output files of the case are completely written. Thread safe
+        """
+        entry = {
+            'status': 'done',
+            'model_fingerprint': self.model_fingerprint,
+            'case_settings': case_settings,
+            'inputs': input_fingerprints,
+            'outputs': self._fingerprint_files(output_files)
+        }
+        with self._lock:
+            self.cases[self._key(output_file_truncated)] = entry
+            self._own_cases[self._key(output_file_truncated)] = entry
+            self._save()
+
+    def _save(self):
+        maybe_mkdir_p(self.output_folder)
+        fd, tmp = tempfile.mkstemp(dir=self.output_folder, prefix='.prediction_manifest', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'format_version': PREDICTION_MANIFEST_FORMAT_VERSION, 'cases': self._own_cases}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.manifest_file)
+        except BaseException:
+            if isfile(tmp):
+                os.remove(tmp)
+            raise
@@ -0,0 +1,56 @@
+"""
+Helpers for predicting only a region of interest (ROI) of an image, see nnUNetPredictor.predict_logits_in_roi.
+
+ROIs are bounding boxes in voxel coordinates of the image as it is returned by the image reader (so without the
+channel axis and before transpose_forward): [[x_start, x_end], [y_start, y_end](, [z_start, z_end])], end exclusive.
+This is the same format as properties['bbox_used_for_cropping'].
+"""
+from copy import deepcopy
+from typing import List, Tuple, Union
+
+import numpy as np
+
+
+def roi_to_preprocessed_bbox(roi: Union[List[List[int]], Tuple[Tuple[int, int], ...]], properties: dict,
+                             preprocessed_shape: Tuple[int, ...], transpose_forward: List[int]) -> List[List[int]]:
+    """
+    Maps roi through transpose_forward, cropping and resampling. properties must be the properties of the
+    preprocessed case (with 'bbox_used_for_cropping' and 'shape_after_cropping_and_before_resampling').
+    preprocessed_shape is the shape of the preprocessed data without the channel axis. The result is rounded outwards
+    to whole preprocessed voxels and clipped to the preprocessed data. Axes where the roi does not overlap the
+    cropped image have start == end
+    """
+    assert len(roi) == len(preprocessed_shape), f'roi must have {len(preprocessed_shape)} axes, got {roi}'
+    roi = [roi[i] for i in transpose_forward]
+    shape_after_cropping = properties['shape_after_cropping_and_before_resampling']
+    bbox = []
+    for (start, end), (crop_start, _), n_cropped, n_preprocessed in zip(roi, properties['bbox_used_for_cropping'],
+                                                                         shape_after_cropping, preprocessed_shape):
+        assert end > start, f'roi must not be empty, got {roi}'
+        scale = n_preprocessed / n_cropped
+        start = int(np.floor(min(max(start - crop_start, 0), n_cropped) * scale))
+        end = int(np.ceil(min(max(end - crop_start, 0), n_cropped) * scale))
+        bbox.append([start, max(start, end)])
+    return bbox
+
+
+def get_properties_for_preprocessed_bbox(bbox: List[List[int]], properties: dict,
+                                         preprocessed_shape: Tuple[int, ...]) -> dict:
+    """
+    Returns a copy of properties that makes convert_predicted_logits_to_segmentation_with_correct_shape (and
+    export_prediction_from_logits) treat logits covering only bbox (in preprocessed coordinates) as if they were the
+    entire prediction: they are resampled to the corresponding region of the original image and pasted into a
+    background filled segmentation of the original shape
+    """
+    properties = deepcopy(properties)
+    shape_after_cropping = properties['shape_after_cropping_and_before_resampling']
+    new_bbox = []
+    for (start, end), (crop_start, _), n_cropped, n_preprocessed in zip(bbox, properties['bbox_used_for_cropping'],
+                                                                         shape_after_cropping, preprocessed_shape):
+        scale = n_preprocessed / n_cropped
+        start = min(int(round(start / scale)), n_cropped - 1)
+        end = min(max(int(round(end / scale)), start + 1), n_cropped)
+        new_bbox.append([crop_start + start, crop_start + end])
+    properties['bbox_used_for_cropping'] = new_bbox
+    properties['shape_after_cropping_and_before_resampling'] = tuple([j - i for i, j in new_bbox])
+    return properties
@@ -0,0 +1,122 @@
+"""
+Time boxed sliding window prediction (see nnUNetPredictor.predict_logits_from_preprocessed_data and
+predict_sliding_window_return_logits, checkpoint=...).
+
+A large volume with many folds and mirrored views can take longer than an invocation is allowed to run (AWS Lambda has
+a hard timeout). With a SlidingWindowCheckpoint the deadline is checked after every tile batch. Once it is reached the
+accumulator (logit sums, weight sums), the cursor (fold, phase of the sliding window, next tile, tile batch size,
+selected refinement tiles) and, for folds that are predicted one after the other, the sum of the finished folds are
+written to the checkpoint folder and SlidingWindowInterrupted is raised. Calling the same function with the same input
+and a checkpoint on the same folder later continues where it stopped. Tiles are batched the same way as before, so the
+result is bit-identical to an uninterrupted run (same device and results device, see below).
+
+Mirrored views (and folds with ensemble_folds_per_tile) are part of the tile batches, so a batch is the smallest unit
+of work. The state is only valid for the same input, model and settings; this is checked with a fingerprint and
+stale state is ignored. Finished predictions remove their state.
+
+If the prediction on the device falls back to the CPU (out of memory) in one call but not in the other, the
+accumulation happens on different devices and the result may differ in the last bits.
+"""
+import hashlib
+import json
+import os
+import time
+import weakref
+from glob import glob
+from typing import Callable, Optional, Union
+
+import numpy as np
+import torch
+from batchgenerators.utilities.file_and_folder_operations import join, isfile, maybe_mkdir_p
+
+from nnunetv2.utilities.tracing import log
+
+
+class SlidingWindowInterrupted(Exception):
+    """
+    The deadline of a SlidingWindowCheckpoint was reached. The progress has been saved, call again to resume
+    """
+    pass
+
+
+class SlidingWindowCheckpoint(object):
+    def __init__(self, folder: str, deadline: Union[None, float, Callable[[], bool]] = None, prefix: str = ''):
+        """
+        folder: local directory for the state of one case (don't share it between cases that run at the same time).
+
+        deadline: time.time() at which we should stop or a function that returns True once we should stop, for
+        example lambda: context.get_remaining_time_in_millis() < 60000 or threading.Event().is_set (set it from a
+        signal handler). It is checked after every tile batch, so leave enough time for one batch plus writing the
+        accumulator. None never stops (but still resumes from what is in folder)
+        """
+        self.folder = folder
+        self.deadline = deadline
+        self.prefix = prefix
+        self.model_fingerprint = None
+        self._data_hash_cache = None
+
+    def for_fold(self, fold: int) -> 'SlidingWindowCheckpoint':
+        """
+        same folder and deadline, separate state for the sliding window of one fold
+        """
+        checkpoint = SlidingWindowCheckpoint(self.folder, self.deadline, f'{self.prefix}fold{fold}_')
+        checkpoint.model_fingerprint = self.model_fingerprint
+        checkpoint._data_hash_cache = self._data_hash_cache
+        return checkpoint
+
+    def deadline_reached(self) -> bool:
+        if self.deadline is None:
+            return False
+        if callable(self.deadline):
+            return bool(self.deadline())
+        return time.time() >= self.deadline
+
+    def fingerprint(self, data: torch.Tensor, settings: dict) -> str:
+        """
+        sha256 of data and settings. The hash of data is cached for the same tensor as long as it is not modified in
+        place (inference tensors have no version counter, modifications of those go unnoticed)
+        """
+        version = None if data.is_inference() else data._version
+        if self._data_hash_cache is None or self._data_hash_cache[0]() is not data or \
+                self._data_hash_cache[1] != version:
+            h = hashlib.sha256()
+            h.update(f'{data.dtype}{tuple(data.shape)}'.encode())
+            h.update(np.ascontiguousarray(data.detach().cpu().numpy()).view(np.uint8).data)
+            self._data_hash_cache = (weakref.ref(data), version, h.hexdigest())
+        h = hashlib.sha256(self._data_hash_cache[2].encode())
+        h.update(json.dumps(dict(settings, prefix=self.prefix), sort_keys=True, default=str).encode())
+        return h.hexdigest()
+
+    def _file(self, name: str) -> str:
+        return join(self.folder, f'{self.prefix}{name}.pt')
+
+    def save(self, name: str, fingerprint: str, tensors: dict, cursor: dict):
+        """
+        written to a temporary file first so that a crash while saving does not destroy the previous state
+        """
+        maybe_mkdir_p(self.folder)
+        tmp = self._file(name) + '.tmp'
+        torch.save({'fingerprint': fingerprint, 'cursor': cursor,
+                    'tensors': {k: v.cpu() if v is not None else None for k, v in tensors.items()}}, tmp)
+        os.replace(tmp, self._file(name))
+
+    def load(self, name: str, fingerprint: str) -> Optional[dict]:
+        if not isfile(self._file(name)):
+            return None
+        state = torch.load(self._file(name), map_location='cpu', weights_only=True)
+        if state['fingerprint'] != fingerprint:
+            log(f'Ignoring {self._file(name)}, it was written for a different input, model or settings',
+                level='warning')
+            return None
+        return state
+
+    def remove(self, name: str):
+        if isfile(self._file(name)):
+            os.remove(self._file(name))
+
+    def clear(self):
+        """
+        removes all state in folder (also that of other prefixes)
+        """
+        for f in glob(join(self.folder, '*.pt')) + glob(join(self.folder, '*.pt.tmp')):
+            os.remove(f)
@@ -1,9 +1,14 @@
+import os
+import tempfile
+import threading
+from collections import OrderedDict
 from functools import lru_cache
 
 import numpy as np
 import torch
-from typing import Union, Tuple, List
+from typing import Union, Tuple, List, Callable, Hashable
 from acvl_utils.cropping_and_padding.padding import pad_nd_image
+from batchgenerators.utilities.file_and_folder_operations import maybe_mkdir_p
 from scipy.ndimage import gaussian_filter
 
 
@@ -54,6 +59,158 @@ def compute_steps_for_sliding_window(image_size: Tuple[int, ...], tile_size: Tup
     return steps
 
 
+def compute_inner_tile_borders(image_size: Tuple[int, ...], steps: List[List[int]],
+                               tile_size: Tuple[int, ...]) -> List[List[int]]:
+    """
+    Returns, for each dimension of tile_size, the coordinates at which a tile starts or ends inside the image (tile
+    borders that coincide with the image border are not included). steps and tile_size refer to the last
+    len(tile_size) dimensions of image_size (this allows 2d tiles on 3d images)
+    """
+    offset = len(image_size) - len(tile_size)
+    borders = []
+    for d, (steps_here, t) in enumerate(zip(steps, tile_size)):
+        size = image_size[offset + d]
+        borders.append(sorted(set([i for i in steps_here if i > 0] + [i + t for i in steps_here if i + t < size])))
+    return borders
+
+
+def compute_reciprocal_normalization_map(image_size: Tuple[int, ...], slicers: List[tuple],
+                                         weights: Union[torch.Tensor, int], device: torch.device) -> torch.Tensor:
+    """
+    Returns 1 / (sum of the tile weights at each voxel) as float32. Multiplying the accumulated (weighted) logits with
+    this is the same as dividing by n_predictions. It only depends on the image size and the tiles (not on the image
+    content) so it can be reused for all images with the same (padded) shape. slicers must cover the entire image
+    """
+    n_predictions = torch.zeros(image_size, dtype=torch.float32, device=device)
+    if isinstance(weights, torch.Tensor):
+        weights = weights.to(device=device, dtype=torch.float32)
+    for sl in slicers:
+        n_predictions[sl[1:]] += weights
+    return torch.reciprocal_(n_predictions)
+
+
+def compute_reciprocal_normalization_map_2d(image_size: Tuple[int, ...], steps: List[List[int]],
+                                            tile_size: Tuple[int, ...], weights: Union[torch.Tensor, int],
+                                            device: torch.device) -> torch.Tensor:
+    """
+    Same as compute_reciprocal_normalization_map but for 2d configurations on 3d images (image_size is (z, x, y),
+    steps and tile_size refer to x, y). The map is the same for all slices, so we only compute it once and return an
+    expanded view. Needs only the memory of a single slice
+    """
+    n_predictions = torch.zeros(image_size[1:], dtype=torch.float32, device=device)
+    if isinstance(weights, torch.Tensor):
+        weights = weights.to(device=device, dtype=torch.float32)
+    for sx in steps[0]:
+        for sy in steps[1]:
+            n_predictions[sx:sx + tile_size[0], sy:sy + tile_size[1]] += weights
+    return torch.reciprocal_(n_predictions)[None].expand(image_size[0], -1, -1)
+
+
+def get_slice_batch_runs(start: int, end: int, num_positions: int) -> List[Tuple[int, int, int]]:
+    """
+    2d sliding window on a 3d image: tile i is slice i // num_positions at in-plane position i % num_positions. For the
+    tiles start:end this returns (position, first slice, last slice + 1) for each position so that every run can be
+    cut out of (and added back to) the image with a single slicing operation. Runs are ordered by position
+    """
+    runs = []
+    for p in range(num_positions):
+        first = max(0, -(-(start - p) // num_positions))
+        last = (end - 1 - p) // num_positions + 1
+        if last > first:
+            runs.append((p, first, last))
+    return runs
+
+
+class NormalizationMapCache(object):
+    def __init__(self, maxsize: int = 1):
+        """
+        Least recently used cache for reciprocal normalization maps (see compute_reciprocal_normalization_map). The
+        maps have the size of the image, so don't make this too large. maxsize=0 disables caching
+        """
+        self.maxsize = maxsize
+        self._maps = OrderedDict()
+        # concurrent predictions (TileBatchScheduler) share the cache
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, compute_fn: Callable[[], torch.Tensor]) -> torch.Tensor:
+        with self._lock:
+            if key in self._maps:
+                self._maps.move_to_end(key)
+                return self._maps[key]
+            # make room first so that the old and the new map don't have to be in memory at the same time
+            while len(self._maps) > 0 and len(self._maps) >= self.maxsize:
+                self._maps.popitem(last=False)
+        normalization_map = compute_fn()
+        if self.maxsize > 0:
+            with self._lock:
+                self._maps[key] = normalization_map
+                while len(self._maps) > self.maxsize:
+                    self._maps.popitem(last=False)
+        return normalization_map
+
+    def clear(self):
+        with self._lock:
+            self._maps.clear()
+
+    def __len__(self):
+        return len(self._maps)
+
+
+def allocate_disk_backed_tensor(shape: Union[Tuple[int, ...], List[int]], dtype: torch.dtype,
+                                folder: str) -> torch.Tensor:
+    """
+    Returns a zero initialized (cpu) tensor whose storage is a memory mapped file in folder. The OS writes pages back
+    to disk as needed, so the resident memory is bounded by what is currently being worked on and not by the size of
+    the tensor. The file is unlinked right away (the mapping stays valid on POSIX systems) so nothing is left behind,
+    even if we crash. Only float16 and float32 are supported.
+    """
+    np_dtype = {torch.float16: np.float16, torch.float32: np.float32}[dtype]
+    maybe_mkdir_p(folder)
+    fd, filename = tempfile.mkstemp(prefix='nnUNet_accumulator_', suffix='.bin', dir=folder)
+    os.close(fd)
+    arr = np.memmap(filename, dtype=np_dtype, mode='w+', shape=tuple(shape))
+    try:
+        os.remove(filename)
+    except OSError:
+        # Windows does not allow removing files that are mapped. The file stays, but that's all
+        pass
+    return torch.from_numpy(arr)
+
+
+def get_available_memory(device: torch.device) -> Union[int, None]:
+    """
+    returns the number of bytes that are currently available on device or None if we cannot tell
+    """
+    if device.type == 'cuda':
+        free, _ = torch.cuda.mem_get_info(device)
+        return free
+    elif device.type == 'cpu':
+        try:
+            return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (ValueError, OSError, AttributeError):
+            # not available on all platforms (looking at you, Windows)
+            return None
+    return None
+
+
+def determine_tile_batch_size(tile_size: Union[Tuple[int, ...], List[int]], num_input_channels: int,
+                              num_output_channels: int, device: torch.device, features_first_stage: int = 32,
+                              max_tile_batch_size: int = 16, memory_fraction: float = 0.5) -> int:
+    """
+    Picks how many tiles (or mirrored views of tiles) we can push through the network at once based on the memory
+    that is currently available on device. The per-tile footprint is a rough estimate: input + output + a few full
+    resolution feature maps (the decoder needs the skips of the highest resolution stage while it works on it). We
+    only use memory_fraction of what is available to leave room for cudnn workspaces, fragmentation etc.
+    """
+    available = get_available_memory(device)
+    if available is None:
+        return 1
+    bytes_per_tile = 4 * np.prod(tile_size, dtype=np.int64) * \
+                     (num_input_channels + num_output_channels + 4 * features_first_stage)
+    tile_batch_size = int(available * memory_fraction // bytes_per_tile)
+    return max(1, min(tile_batch_size, max_tile_batch_size))
+
+
 if __name__ == '__main__':
     a = torch.rand((4, 2, 32, 23))
     a_npy = a.numpy()
@@ -0,0 +1,190 @@
+import threading
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+from time import perf_counter
+from typing import List, Optional, Tuple
+
+import torch
+
+from nnunetv2.utilities.helpers import dummy_context
+from nnunetv2.utilities.tracing import trace_span
+
+
+class _TileRequest(object):
+    def __init__(self, x: torch.Tensor):
+        self.x = x
+        # tiles [0, next_tile) have been handed to a forward pass
+        self.next_tile = 0
+        self.num_done = 0
+        self.outputs: List[Tuple[int, torch.Tensor]] = []
+        self.future = Future()
+        self.submitted_at = perf_counter()
+
+
+class TileBatchScheduler(object):
+    def __init__(self, predictor, max_batch_size: Optional[int] = None, max_wait_ms: float = 5.):
+        """
+        Lets several threads predict with the same (initialized) nnUNetPredictor at the same time and share forward
+        passes. Once attached, the sliding window of each prediction hands its tile batches to the scheduler instead
+        of running the network itself. A single worker thread packs tiles of all waiting predictions (first come first
+        served, a batch may be split) into forward passes of up to max_batch_size samples (tiles x mirrored views,
+        same as nnUNetPredictor.tile_batch_size; default: tile_batch_size of the predictor or determined automatically)
+        and routes the outputs back. Each prediction keeps its own accumulator.
+
+        A forward pass starts as soon as it is full, or when every prediction that is currently running has tiles
+        waiting (so a lone prediction never waits), or max_wait_ms after the oldest waiting tiles arrived.
+
+        Under load this means one forward pass at a time with all threads of the device instead of every request
+        competing for them, and small batches (few tiles, the last batch of an image) of different requests are
+        merged. All folds are resident and evaluated on each tile (as with ensemble_folds_per_tile).
+
+            with TileBatchScheduler(predictor):
+                # from several threads:
+                predictor.predict_single_npy_array(...)  # or predict_logits_from_preprocessed_data etc.
+
+        Only the sliding window is shared; preprocessing and export run in the calling threads.
+        """
+        assert predictor.list_of_parameters is not None, 'initialize the predictor first'
+        self.predictor = predictor
+        if predictor.fold_networks is None:
+            predictor._internal_build_fold_networks()
+        if predictor.cpu_engine is None:
+            predictor.fold_networks = [i.to(predictor.device).eval() for i in predictor.fold_networks]
+        self.max_batch_size = max_batch_size if max_batch_size is not None else \
+            predictor._internal_get_tile_batch_size(predictor._internal_get_example_input()[0])
+        self.max_wait_s = max_wait_ms / 1000
+
+        self._cond = threading.Condition()
+        self._pending: deque = deque()
+        self._num_active_cases = 0
+        self._stop = False
+        self.num_forward_passes = 0
+        self.num_shared_forward_passes = 0
+        self.num_tiles = 0
+
+        predictor.tile_batch_scheduler = self
+        self._thread = threading.Thread(target=self._run, name='nnUNet_tile_batch_scheduler', daemon=True)
+        self._thread.start()
+
+    @contextmanager
+    def active_case(self):
+        """
+        predictions register while they run so that we know when waiting for more tiles is pointless. Done by
+        nnUNetPredictor.predict_logits_from_preprocessed_data
+        """
+        with self._cond:
+            self._num_active_cases += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._num_active_cases -= 1
+                self._cond.notify_all()
+
+    def predict(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        x: batch of tiles (b, c, *patch_size) on the device. Blocks until all of them are predicted. Returns the same
+        as nnUNetPredictor._internal_forward_tile_batch(x)
+        """
+        request = _TileRequest(x)
+        with self._cond:
+            assert not self._stop, 'this TileBatchScheduler was shut down'
+            self._pending.append(request)
+            self._cond.notify_all()
+        return request.future.result()
+
+    def _num_pending_tiles(self) -> int:
+        return sum([r.x.shape[0] - r.next_tile for r in self._pending])
+
+    def _take_tiles(self, max_tiles: int) -> List[Tuple[_TileRequest, int, int]]:
+        batch = []
+        while len(self._pending) > 0 and max_tiles > 0:
+            r = self._pending[0]
+            n = min(max_tiles, r.x.shape[0] - r.next_tile)
+            batch.append((r, r.next_tile, r.next_tile + n))
+            r.next_tile += n
+            max_tiles -= n
+            if r.next_tile == r.x.shape[0]:
+                self._pending.popleft()
+        return batch
+
+    def _run(self):
+        p = self.predictor
+        while True:
+            with self._cond:
+                while not self._stop and len(self._pending) == 0:
+                    self._cond.wait()
+                if len(self._pending) == 0:
+                    return
+                num_views = len(p._internal_get_mirror_axes_combinations(self._pending[0].x.ndim))
+                max_tiles = max(1, self.max_batch_size // num_views)
+                deadline = self._pending[0].submitted_at + self.max_wait_s
+                while not self._stop and self._num_pending_tiles() < max_tiles and \
+                        len(self._pending) < self._num_active_cases:
+                    remaining = deadline - perf_counter()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._take_tiles(max_tiles)
+
+            requests = list(dict.fromkeys([r for r, _, _ in batch]))
+            try:
+                x = torch.cat([r.x[s:e] for r, s, e in batch]) if len(batch) > 1 else \
+                    batch[0][0].x[batch[0][1]:batch[0][2]]
+                # grad mode and autocast are thread local, so we need to set them up here as well
+                with torch.inference_mode(), \
+                        torch.autocast(p.device.type, enabled=True) if p.device.type == 'cuda' else dummy_context(), \
+                        trace_span('scheduled_forward', tiles=x.shape[0], requests=len(requests)):
+                    out = p._internal_forward_tile_batch(x, self.max_batch_size)
+            except BaseException as e:
+                with self._cond:
+                    for r in requests:
+                        if r in self._pending:
+                            self._pending.remove(r)
+                for r in requests:
+                    if not r.future.done():
+                        r.future.set_exception(e)
+                continue
+
+            self.num_forward_passes += 1
+            self.num_shared_forward_passes += len(requests) > 1
+            self.num_tiles += x.shape[0]
+            offset = 0
+            for r, s, e in batch:
+                if r.future.done():
+                    # an earlier part of this request failed
+                    offset += e - s
+                    continue
+                r.outputs.append((s, out[offset:offset + e - s]))
+                offset += e - s
+                r.num_done += e - s
+                if r.num_done == r.x.shape[0]:
+                    outputs = [o for _, o in sorted(r.outputs, key=lambda i: i[0])]
+                    r.future.set_result(outputs[0] if len(outputs) == 1 else torch.cat(outputs))
+
+    def as_dict(self) -> dict:
+        return {
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait_s * 1000,
+            'num_forward_passes': self.num_forward_passes,
+            'num_shared_forward_passes': self.num_shared_forward_passes,
+            'mean_tiles_per_forward_pass': self.num_tiles / max(1, self.num_forward_passes)
+        }
+
+    def shutdown(self):
+        """
+        finishes what is pending and detaches from the predictor, which then works like before
+        """
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        self._thread.join()
+        if self.predictor.tile_batch_scheduler is self:
+            self.predictor.tile_batch_scheduler = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
@@ -27,6 +27,7 @@ from nnunetv2.preprocessing.resampling.default_resampling import compute_new_sha
 from nnunetv2.utilities.dataset_name_id_conversion import maybe_convert_to_dataset_name
 from nnunetv2.utilities.find_class_by_name import recursive_find_python_class
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
+from nnunetv2.utilities.tracing import trace_span, log
 from nnunetv2.utilities.utils import get_filenames_of_train_images_and_targets
 
 
@@ -58,7 +59,8 @@ class DefaultPreprocessor(object):
         shape_before_cropping = data.shape[1:]
         properties['shape_before_cropping'] = shape_before_cropping
         # this command will generate a segmentation. This is important because of the nonzero mask which we may need
-        data, seg, bbox = crop_to_nonzero(data, seg)
+        with trace_span('crop'):
+            data, seg, bbox = crop_to_nonzero(data, seg)
         properties['bbox_used_for_cropping'] = bbox
         # print(data.shape, seg.shape)
         properties['shape_after_cropping_and_before_resampling'] = data.shape[1:]
@@ -75,21 +77,23 @@ class DefaultPreprocessor(object):
         # normalize
         # normalization MUST happen before resampling or we get huge problems with resampled nonzero masks no
         # longer fitting the images perfectly!
-        data = self._normalize(data, seg, configuration_manager,
-                               plans_manager.foreground_intensity_properties_per_channel)
+        with trace_span('normalize'):
+            data = self._normalize(data, seg, configuration_manager,
+                                   plans_manager.foreground_intensity_properties_per_channel)
 
         # print('current shape', data.shape[1:], 'current_spacing', original_spacing,
         #       '\ntarget shape', new_shape, 'target_spacing', target_spacing)
         old_shape = data.shape[1:]
-        data = configuration_manager.resampling_fn_data(data, new_shape, original_spacing, target_spacing)
-        seg = configuration_manager.resampling_fn_seg(seg, new_shape, original_spacing, target_spacing)
+        with trace_span('resample', old_shape=old_shape, new_shape=new_shape):
+            data = configuration_manager.resampling_fn_data(data, new_shape, original_spacing, target_spacing)
+            seg = configuration_manager.resampling_fn_seg(seg, new_shape, original_spacing, target_spacing)
         if self.verbose:
             print(f'old shape: {old_shape}, new_shape: {new_shape}, old_spacing: {original_spacing}, '
                   f'new_spacing: {target_spacing}, fn_data: {configuration_manager.resampling_fn_data}')
 
         # if we have a segmentation, sample foreground locations for oversampling and add those to properties
         if has_seg:
-            print('sampling foreground locations')
+            log('sampling foreground locations', level='debug')
             # reinstantiating LabelManager for each case is not ideal. We could replace the dataset_json argument
             # with a LabelManager Instance in this function because that's all its used for. Dunno what's better.
             # LabelManager is pretty light computation-wise.
@@ -106,9 +110,9 @@ class DefaultPreprocessor(object):
             # print(all_labels, regions)
             properties['class_locations'] = self._sample_foreground_locations(seg, collect_for_this,
                                                                                    verbose=self.verbose)
-            print("properties acquired")
+            log('properties acquired', level='debug')
             seg = self.modify_seg_fn(seg, plans_manager, dataset_json, configuration_manager)
-            print("seg modified")
+            log('seg modified', level='debug')
         if np.max(seg) > 127:
             seg = seg.astype(np.int16)
         else:
@@ -131,13 +135,14 @@ class DefaultPreprocessor(object):
         rw = plans_manager.image_reader_writer_class()
 
         # load image(s)
-        data, data_properties = rw.read_images(image_files)
+        with trace_span('read'):
+            data, data_properties = rw.read_images(image_files)
 
-        # if possible, load seg
-        if seg_file is not None:
-            seg, _ = rw.read_seg(seg_file)
-        else:
-            seg = None
+            # if possible, load seg
+            if seg_file is not None:
+                seg, _ = rw.read_seg(seg_file)
+            else:
+                seg = None
 
         data, seg = self.run_case_npy(data, seg, data_properties, plans_manager, configuration_manager,
                                       dataset_json)
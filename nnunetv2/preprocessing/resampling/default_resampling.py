@@ -3,12 +3,8 @@ from copy import deepcopy
 from typing import Union, Tuple, List
 
 import numpy as np
-import pandas as pd
-import sklearn
 import torch
-from batchgenerators.augmentations.utils import resize_segmentation
 from scipy.ndimage import map_coordinates
-from skimage.transform import resize
 from nnunetv2.configuration import ANISO_THRESHOLD
 
 
@@ -129,10 +125,14 @@ def resample_data_or_seg(data: np.ndarray, new_shape: Union[Tuple[float, ...], L
     assert data.ndim == 4, "data must be (c, x, y, z)"
     assert len(new_shape) == data.ndim - 1
 
+    # skimage, pandas and batchgenerators.augmentations (which imports both) take a while to import, so we only do
+    # it when they are actually needed
     if is_seg:
+        from batchgenerators.augmentations.utils import resize_segmentation
         resize_fn = resize_segmentation
         kwargs = OrderedDict()
     else:
+        from skimage.transform import resize
         resize_fn = resize
         kwargs = {'mode': 'edge', 'anti_aliasing': False}
     shape = np.array(data[0].shape)
@@ -183,6 +183,7 @@ def resample_data_or_seg(data: np.ndarray, new_shape: Union[Tuple[float, ...], L
                     if not is_seg or order_z == 0:
                         reshaped_final[c] = map_coordinates(reshaped_here, coord_map, order=order_z, mode='nearest')[None]
                     else:
+                        import pandas as pd
                         unique_labels = np.sort(pd.unique(reshaped_here.ravel()))  # np.unique(reshaped_data)
                         for i, cl in enumerate(unique_labels):
                             reshaped_final[c][np.round(
@@ -1,9 +1,6 @@
-import matplotlib
-from batchgenerators.utilities.file_and_folder_operations import join
+import sys
 
-matplotlib.use('agg')
-import seaborn as sns
-import matplotlib.pyplot as plt
+from batchgenerators.utilities.file_and_folder_operations import join
 
 
 class nnUNetLogger(object):
@@ -54,6 +51,12 @@ class nnUNetLogger(object):
     def plot_progress_png(self, output_folder):
         # we infer the epoch form our internal logging
         epoch = min([len(i) for i in self.my_fantastic_logging.values()]) - 1  # lists of epoch 0 have len 1
+        # matplotlib and seaborn are slow to import and only needed here
+        import matplotlib
+        if 'matplotlib.pyplot' not in sys.modules:
+            matplotlib.use('agg')
+        import seaborn as sns
+        import matplotlib.pyplot as plt
         sns.set(font_scale=2.5)
         fig, ax_all = plt.subplots(3, 1, figsize=(30, 54))
         # regular progress.png as we are used to from previous nnU-Net versions
@@ -1,5 +1,5 @@
-import subprocess
 import os
+import socket
 
 
 def get_allowed_n_proc_DA():
@@ -20,7 +20,7 @@ def get_allowed_n_proc_DA():
     if 'nnUNet_n_proc_DA' in os.environ.keys():
         use_this = int(os.environ['nnUNet_n_proc_DA'])
     else:
-        hostname = subprocess.getoutput(['hostname'])
+        hostname = socket.gethostname()
         if hostname in ['Fabian', ]:
             use_this = 12
         elif hostname in ['hdf19-gpu16', 'hdf19-gpu17', 'hdf19-gpu18', 'hdf19-gpu19', 'e230-AMDworkstation']:
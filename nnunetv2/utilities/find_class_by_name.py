@@ -1,10 +1,133 @@
+import ast
 import importlib
+import json
+import os
 import pkgutil
+import tempfile
+import threading
+from typing import List, Tuple, Union
 
 from batchgenerators.utilities.file_and_folder_operations import *
 
+# The class index maps each .py file to the names it defines at the top level. It is obtained by parsing the files
+# (not importing them!) and persisted across processes. Entries are invalidated by mtime and size. This lets
+# recursive_find_python_class import only the module that actually defines the class we are looking for instead of
+# importing everything until it finds a match
+CLASS_INDEX_FILE = join(os.environ.get('XDG_CACHE_HOME', join(os.path.expanduser('~'), '.cache')), 'nnunetv2',
+                        'class_index.json')
 
-def recursive_find_python_class(folder: str, class_name: str, current_module: str):
+_found_classes = {}
+_folder_indices = {}
+_persisted_index = None
+# preprocessing threads look up classes at the same time (DefaultPreprocessor._normalize). Guards the three dicts above
+# and writing the index. Reentrant because _get_class_index loads and saves while holding it. Modules are imported
+# without holding it
+_index_lock = threading.RLock()
+
+
+def _get_top_level_names(statements: list) -> List[str]:
+    names = []
+    for node in statements:
+        if isinstance(node, (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)):
+            names.append(node.name)
+        elif isinstance(node, ast.Assign):
+            names += [t.id for t in node.targets if isinstance(t, ast.Name)]
+        elif isinstance(node, ast.AnnAssign) and isinstance(node.target, ast.Name):
+            names.append(node.target.id)
+        elif isinstance(node, ast.If):
+            names += _get_top_level_names(node.body) + _get_top_level_names(node.orelse)
+        elif isinstance(node, ast.Try):
+            names += _get_top_level_names(node.body) + _get_top_level_names(node.orelse) + \
+                     _get_top_level_names(node.finalbody)
+            for h in node.handlers:
+                names += _get_top_level_names(h.body)
+    return names
+
+
+def _iter_modules_in_search_order(folder: str, current_module: str):
+    """
+    same order in which _recursive_find_python_class_by_importing looks at the modules
+    """
+    modules = list(pkgutil.iter_modules([folder]))
+    for importer, modname, ispkg in modules:
+        if not ispkg:
+            yield current_module + "." + modname, join(folder, modname + '.py')
+    for importer, modname, ispkg in modules:
+        if ispkg:
+            yield from _iter_modules_in_search_order(join(folder, modname), current_module + "." + modname)
+
+
+def _load_persisted_index() -> dict:
+    global _persisted_index
+    if _persisted_index is None:
+        _persisted_index = {}
+        if isfile(CLASS_INDEX_FILE):
+            try:
+                with open(CLASS_INDEX_FILE, 'r') as f:
+                    _persisted_index = json.load(f)
+            except (OSError, ValueError):
+                pass
+    return _persisted_index
+
+
+def _save_persisted_index():
+    # several processes may do this at the same time (background workers), so write to a temporary file and
+    # atomically replace. Not being able to write the index (read only home etc) is not a problem, we just lose the
+    # cache
+    try:
+        maybe_mkdir_p(os.path.dirname(CLASS_INDEX_FILE))
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(CLASS_INDEX_FILE), suffix='.tmp')
+        with _index_lock:
+            snapshot = dict(_persisted_index)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp, CLASS_INDEX_FILE)
+    except OSError:
+        pass
+
+
+def _get_class_index(folder: str, current_module: str) -> List[Tuple[str, Union[List[str], None]]]:
+    """
+    returns [(module name, names defined in that module), ...] in search order. Names are None if the module could
+    not be parsed (compiled extensions, syntax we do not understand), these modules must be imported to check them
+    """
+    key = (folder, current_module)
+    with _index_lock:
+        if key in _folder_indices:
+            return _folder_indices[key]
+        return _build_class_index(folder, current_module)
+
+
+def _build_class_index(folder: str, current_module: str) -> List[Tuple[str, Union[List[str], None]]]:
+    """
+    must be called with _index_lock held
+    """
+    persisted = _load_persisted_index()
+    index = []
+    changed = False
+    for module_name, filename in _iter_modules_in_search_order(folder, current_module):
+        names = None
+        if isfile(filename):
+            st = os.stat(filename)
+            entry = persisted.get(filename)
+            if entry is not None and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+                names = entry[2]
+            else:
+                try:
+                    with open(filename, 'rb') as f:
+                        names = _get_top_level_names(ast.parse(f.read(), filename).body)
+                except (SyntaxError, ValueError, OSError):
+                    names = None
+                persisted[filename] = [st.st_mtime_ns, st.st_size, names]
+                changed = True
+        index.append((module_name, names))
+    if changed:
+        _save_persisted_index()
+    _folder_indices[(folder, current_module)] = index
+    return index
+
+
+def _recursive_find_python_class_by_importing(folder: str, class_name: str, current_module: str):
     tr = None
     for importer, modname, ispkg in pkgutil.iter_modules([folder]):
         # print(modname, ispkg)
@@ -18,7 +141,35 @@ def recursive_find_python_class(folder: str, class_name: str, current_module: st
         for importer, modname, ispkg in pkgutil.iter_modules([folder]):
             if ispkg:
                 next_current_module = current_module + "." + modname
-                tr = recursive_find_python_class(join(folder, modname), class_name, current_module=next_current_module)
+                tr = _recursive_find_python_class_by_importing(join(folder, modname), class_name,
+                                                               current_module=next_current_module)
             if tr is not None:
                 break
     return tr
+
+
+def recursive_find_python_class(folder: str, class_name: str, current_module: str):
+    key = (folder, class_name, current_module)
+    with _index_lock:
+        if key in _found_classes:
+            return _found_classes[key]
+
+    tr = None
+    for module_name, names in _get_class_index(folder, current_module):
+        if names is None or class_name in names:
+            m = importlib.import_module(module_name)
+            if hasattr(m, class_name):
+                tr = getattr(m, class_name)
+                break
+
+    if tr is None:
+        # the index only knows what is defined in the source files. Classes can also be created dynamically or come
+        # from files that were added since we built the index. Rebuild the index next time and do it the slow way
+        with _index_lock:
+            _folder_indices.pop((folder, current_module), None)
+        tr = _recursive_find_python_class_by_importing(folder, class_name, current_module)
+
+    if tr is not None:
+        with _index_lock:
+            _found_classes[key] = tr
+    return tr
@@ -1,3 +1,5 @@
+import sys
+
 import torch
 
 
@@ -19,6 +21,14 @@ def empty_cache(device: torch.device):
         pass
 
 
+def is_compiled_module(module) -> bool:
+    # importing torch._dynamo takes more than a second. If it was not imported, nothing can have been compiled
+    if 'torch._dynamo' not in sys.modules:
+        return False
+    from torch._dynamo import OptimizedModule
+    return isinstance(module, OptimizedModule)
+
+
 class dummy_context(object):
     def __enter__(self):
         pass
@@ -182,6 +182,51 @@ class LabelManager(object):
             probabilities = probabilities.cpu().numpy()
         return self.convert_probabilities_to_segmentation(probabilities)
 
+    def convert_logits_to_segmentation_skip_nonlin(self, predicted_logits: torch.Tensor) -> torch.Tensor:
+        """
+        Same result as convert_logits_to_segmentation but cheaper because no probabilities are computed: the argmax of
+        the logits is the argmax of the softmax and sigmoid(x) > 0.5 is x > 0. Falls back to
+        convert_logits_to_segmentation if a custom inference_nonlin is used
+
+        predicted_logits has to have shape (c, x, y(, z)) where c is the number of classes/regions
+        """
+        if self.inference_nonlin not in (softmax_helper_dim0, torch.sigmoid):
+            return self.convert_logits_to_segmentation(predicted_logits)
+        if self.has_regions:
+            assert self.regions_class_order is not None, 'if region-based training is requested then you need to ' \
+                                                         'define regions_class_order!'
+            segmentation = torch.zeros(predicted_logits.shape[1:], dtype=torch.int16, device=predicted_logits.device)
+            for i, c in enumerate(self.regions_class_order):
+                segmentation[predicted_logits[i] > 0] = c
+        else:
+            segmentation = predicted_logits.argmax(0)
+        return segmentation
+
+    def get_prediction_margin(self, predicted_probabilities: torch.Tensor) -> torch.Tensor:
+        """
+        assumes that inference_nonlinearity was already applied!
+
+        Returns a (x, y(, z)) map of how decisive the prediction is, 0 being a coin flip and 1 being certain. For
+        labels this is the difference between the two most likely classes, for regions the distance of the least
+        decisive region from 0.5 (scaled to [0, 1])
+        """
+        if self.has_regions:
+            return (predicted_probabilities * 2 - 1).abs().amin(0)
+        else:
+            top2 = torch.topk(predicted_probabilities, 2, dim=0, sorted=True).values
+            return top2[0] - top2[1]
+
+    def get_background_logits(self, magnitude: float = 10.) -> List[float]:
+        """
+        Returns one logit per segmentation head such that inference_nonlin + convert_probabilities_to_segmentation
+        result in background. Used to fill regions that were not predicted (for example skipped sliding window tiles)
+        """
+        if self.has_regions:
+            return [-magnitude] * self.num_segmentation_heads
+        else:
+            # background is always the first label
+            return [magnitude] + [-magnitude] * (self.num_segmentation_heads - 1)
+
     def revert_cropping_on_probabilities(self, predicted_probabilities: Union[torch.Tensor, np.ndarray],
                                          bbox: List[List[int]],
                                          original_shape: Union[List[int], Tuple[int, ...]]):
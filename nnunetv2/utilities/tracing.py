@@ -0,0 +1,193 @@
+"""
+Tracing of the inference stages and log levels.
+
+Tracing is off by default. In that case trace_span does nothing except checking a global. Enable it with
+enable_tracing(jsonl_file) (or -trace_file on the command line). Every span is then appended to jsonl_file as one
+line: {"name", "case", "ts_us", "dur_us", "pid", "tid", "args"}. Timestamps are wall clock (time.time_ns) so that
+spans from the preprocessing worker processes (they inherit the setting through the nnUNet_trace environment
+variable) and the export threads line up. Each line is written with a single append, so lines of different
+processes don't get mixed up. write_chrome_trace converts the file into a trace that can be viewed with
+chrome://tracing or https://ui.perfetto.dev, summarize_trace aggregates it per stage.
+
+Log levels: log(..., level='debug') only prints if the log level (set_log_level or the nnUNet_log_level environment
+variable, default 'info') is at most debug. Use this for messages that are only interesting when debugging.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional, Union
+
+import numpy as np
+
+TRACE_FILE_ENV = 'nnUNet_trace'
+LOG_LEVEL_ENV = 'nnUNet_log_level'
+LOG_LEVELS = {'debug': 10, 'info': 20, 'warning': 30}
+
+_trace_file = os.environ.get(TRACE_FILE_ENV)
+_trace_handle = None
+_trace_handle_pid = None
+_trace_lock = threading.Lock()
+_thread_state = threading.local()
+_log_level = LOG_LEVELS[os.environ.get(LOG_LEVEL_ENV, 'info').lower()]
+
+
+def set_log_level(level: str):
+    global _log_level
+    assert level in LOG_LEVELS.keys(), f'level must be one of {list(LOG_LEVELS.keys())}, got {level}'
+    _log_level = LOG_LEVELS[level]
+    # worker processes should follow
+    os.environ[LOG_LEVEL_ENV] = level
+
+
+def log(*args, level: str = 'info', **kwargs):
+    if LOG_LEVELS[level] >= _log_level:
+        print(*args, **kwargs)
+
+
+def enable_tracing(jsonl_file: Union[str, None]):
+    """
+    None disables tracing. Spans are appended, so remove the file first if you don't want to keep earlier runs
+    """
+    global _trace_file
+    _trace_file = os.path.abspath(jsonl_file) if jsonl_file is not None else None
+    if _trace_file is None:
+        os.environ.pop(TRACE_FILE_ENV, None)
+    else:
+        os.environ[TRACE_FILE_ENV] = _trace_file
+
+
+def tracing_enabled() -> bool:
+    return _trace_file is not None
+
+
+def _write_event(event: dict):
+    global _trace_handle, _trace_handle_pid
+    line = json.dumps(event, default=str) + '\n'
+    with _trace_lock:
+        # forked worker processes must not share the handle of the parent
+        if _trace_handle is None or _trace_handle_pid != os.getpid() or _trace_handle.name != _trace_file:
+            _trace_handle = open(_trace_file, 'a')
+            _trace_handle_pid = os.getpid()
+        _trace_handle.write(line)
+        _trace_handle.flush()
+
+
+@contextmanager
+def trace_case(case: Optional[str]):
+    """
+    spans in this block (same thread) that don't set case themselves are attributed to case
+    """
+    previous = getattr(_thread_state, 'case', None)
+    _thread_state.case = case
+    try:
+        yield
+    finally:
+        _thread_state.case = previous
+
+
+@contextmanager
+def trace_span(name: str, case: Optional[str] = None, sync_device=None, **args):
+    """
+    sync_device: cuda runs asynchronously. If a torch.device of type cuda is given, we synchronize it at the end of
+    the span (only if tracing is enabled) so that the duration covers the actual work
+    """
+    if _trace_file is None:
+        yield
+        return
+    start = time.time_ns()
+    try:
+        yield
+    finally:
+        if sync_device is not None and sync_device.type == 'cuda':
+            import torch
+            torch.cuda.synchronize(sync_device)
+        end = time.time_ns()
+        _write_event({'name': name, 'case': case if case is not None else getattr(_thread_state, 'case', None),
+                      'ts_us': start // 1000, 'dur_us': (end - start) // 1000, 'pid': os.getpid(),
+                      'tid': threading.get_ident(), 'args': args})
+
+
+def trace_peak_rss(case: Optional[str] = None):
+    """
+    records the peak resident set size (MB) of this process and of its (terminated and waited for) children so far
+    """
+    if _trace_file is None:
+        return
+    try:
+        import resource
+    except ImportError:
+        return
+    # linux reports kB, macOS bytes
+    scale = 1 / 1024 ** 2 if os.uname().sysname == 'Darwin' else 1 / 1024
+    _write_event({'name': 'peak_rss', 'case': case if case is not None else getattr(_thread_state, 'case', None),
+                  'ts_us': time.time_ns() // 1000, 'dur_us': 0, 'pid': os.getpid(), 'tid': threading.get_ident(),
+                  'args': {'self_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+                           'children_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale}})
+
+
+def load_trace(jsonl_file: str) -> list:
+    events = []
+    with open(jsonl_file, 'r') as f:
+        for line in f:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                # the last line may be incomplete if the process was killed
+                pass
+    return events
+
+
+def write_chrome_trace(jsonl_file: str, output_file: str):
+    events = []
+    for e in load_trace(jsonl_file):
+        args = dict(e['args'], case=e['case'])
+        if e['name'] == 'peak_rss':
+            events.append({'name': 'peak_rss_mb', 'ph': 'C', 'ts': e['ts_us'], 'pid': e['pid'], 'args': e['args']})
+        else:
+            events.append({'name': e['name'], 'ph': 'X', 'ts': e['ts_us'], 'dur': e['dur_us'], 'pid': e['pid'],
+                           'tid': e['tid'], 'args': args})
+    with open(output_file, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def summarize_trace(jsonl_file: str) -> dict:
+    """
+    per stage: count, total, mean, median and max duration (seconds). Stages nest (forward is part of predict), so
+    totals of different stages don't add up
+    """
+    durations = {}
+    peak_rss = {'self_mb': 0., 'children_mb': 0.}
+    for e in load_trace(jsonl_file):
+        if e['name'] == 'peak_rss':
+            for k in peak_rss.keys():
+                peak_rss[k] = max(peak_rss[k], e['args'][k])
+            continue
+        durations.setdefault(e['name'], []).append(e['dur_us'] / 1e6)
+    summary = {k: {'count': len(v), 'total_s': float(np.sum(v)), 'mean_s': float(np.mean(v)),
+                   'median_s': float(np.median(v)), 'max_s': float(np.max(v))} for k, v in durations.items()}
+    summary['peak_rss'] = peak_rss
+    return summary
+
+
+def trace_summary_entry_point():
+    import argparse
+    parser = argparse.ArgumentParser(description='Summarizes a trace written with -trace_file (per stage timings, '
+                                                 'peak RSS) and optionally converts it into a Chrome trace')
+    parser.add_argument('-i', type=str, required=True, help='trace file (jsonl)')
+    parser.add_argument('-chrome', type=str, required=False, default=None,
+                        help='write a Chrome trace (chrome://tracing, https://ui.perfetto.dev) to this file')
+    parser.add_argument('-o', type=str, required=False, default=None, help='save the summary as json')
+    args = parser.parse_args()
+    summary = summarize_trace(args.i)
+    peak_rss = summary.pop('peak_rss')
+    for k, v in sorted(summary.items(), key=lambda x: -x[1]['total_s']):
+        print(f"{k:>24}: {v['count']:6d} x, total {v['total_s']:9.3f} s, mean {v['mean_s']:8.4f} s, "
+              f"max {v['max_s']:8.4f} s")
+    print(f"peak RSS: {peak_rss['self_mb']:.0f} MB (main process), {peak_rss['children_mb']:.0f} MB (largest child)")
+    if args.o is not None:
+        with open(args.o, 'w') as f:
+            json.dump(dict(summary, peak_rss=peak_rss), f, indent=4)
+    if args.chrome is not None:
+        write_chrome_trace(args.i, args.chrome)